@@ -11,6 +11,13 @@ setup(
     author_email="dev@praekeltfoundation.org",
     packages=find_packages(),
     scripts=[],
+    entry_points={
+        'console_scripts': [
+            'vxtwinio-lint-twiml = vxtwinio.twiml_lint:main',
+            'vxtwinio-replay = vxtwinio.replay:main',
+            'vxtwinio-simulate = vxtwinio.simulator:main',
+        ],
+    },
     install_requires=[
         'vumi',
         'klein',
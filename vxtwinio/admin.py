@@ -0,0 +1,271 @@
+from collections import Counter
+import gc
+import json
+import os
+import resource
+import sys
+import thread
+import threading
+import time
+
+from klein import Klein
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
+
+
+class SamplingProfiler(object):
+    """Samples the stack of a thread at an interval, and counts how often
+    each stack is seen. The counts are the input for a flame graph.
+
+    Samples are taken from a separate thread, so the profiled thread only
+    pays for the time the sampler holds the interpreter lock, and nothing
+    is traced while the profiler isn't running."""
+
+    def __init__(self, thread_id=None, max_stacks=10000):
+        """
+        :param int thread_id: The thread to sample. Defaults to the thread
+            the profiler is made on.
+        :param int max_stacks: The number of different stacks to count at
+            most. Samples of any more stacks are counted together, so that a
+            long profile can't take up an unbounded amount of memory.
+        """
+        if thread_id is None:
+            thread_id = thread.get_ident()
+        self.thread_id = thread_id
+        self.max_stacks = max_stacks
+        self.started = None
+        self.seconds = None
+        self.interval = None
+        self.samples = 0
+        # Stacks, outermost frame first, mapped to the number of samples
+        self._stacks = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval=0.01):
+        """Starts sampling every ``interval`` seconds for ``seconds``
+        seconds, discarding the samples of any previous profile"""
+        if self.running:
+            raise RuntimeError('The profiler is already running')
+        with self._lock:
+            self._stacks = {}
+            self.samples = 0
+        self.started = time.time()
+        self.seconds = seconds
+        self.interval = interval
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._sample_until, args=(self.started + seconds,),
+            name='vxtwinio-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling, keeping the samples taken so far"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample_until(self, deadline):
+        while time.time() < deadline and not self._stopping.is_set():
+            self.sample()
+            self._stopping.wait(self.interval)
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%d)' % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno))
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        with self._lock:
+            if stack not in self._stacks and (
+                    len(self._stacks) >= self.max_stacks):
+                stack = ('(other stacks)',)
+            self._stacks[stack] = self._stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def folded(self):
+        """Returns the samples as folded stacks, one ``frame;frame count``
+        line for each stack, as read by flamegraph.pl and speedscope"""
+        with self._lock:
+            stacks = sorted(self._stacks.iteritems())
+        return ''.join(
+            '%s %d\n' % (';'.join(stack), count) for stack, count in stacks)
+
+    def status(self):
+        return {
+            'running': self.running,
+            'started': self.started,
+            'seconds': self.seconds,
+            'interval': self.interval,
+            'samples': self.samples,
+            'stacks': len(self._stacks),
+        }
+
+
+def object_counts(limit=20):
+    """Returns the number of live objects of the ``limit`` most common
+    types, and the number of Deferreds.
+
+    Python 2 has no tracemalloc to trace allocations with, so this counts
+    the objects tracked by the garbage collector instead. That covers every
+    container and instance, but not strings and numbers."""
+    counts = Counter()
+    deferreds = 0
+    for obj in gc.get_objects():
+        cls = type(obj)
+        counts['%s.%s' % (cls.__module__, cls.__name__)] += 1
+        if isinstance(obj, Deferred):
+            deferreds += 1
+    return {
+        'objects': sum(counts.itervalues()),
+        'deferreds': deferreds,
+        'top_types': counts.most_common(limit),
+    }
+
+
+class AdminServer(object):
+    """Endpoints for looking inside and tuning a running worker, served on
+    their own port so that they aren't exposed with the API"""
+    app = Klein()
+
+    def __init__(self, vumi_worker, max_profile_seconds=300):
+        """
+        :param vumi_worker: The TwilioAPIWorker to report on
+        :param float max_profile_seconds: The longest a profile can run for
+        """
+        self.vumi_worker = vumi_worker
+        self.max_profile_seconds = max_profile_seconds
+        self.profiler = SamplingProfiler()
+
+    def _json(self, request, data, code=200):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(data)
+
+    def _get_float(self, request, field, default):
+        return float(request.args.get(field, [default])[0])
+
+    @app.route('/profile', methods=['POST'])
+    def start_profile(self, request):
+        """Starts profiling the worker for ``seconds`` seconds, sampling its
+        stack every ``interval`` seconds"""
+        try:
+            seconds = self._get_float(request, 'seconds', 30)
+            interval = self._get_float(request, 'interval', 0.01)
+        except ValueError:
+            return self._json(
+                request, {'error': 'seconds and interval must be numbers'},
+                400)
+        if not (0 < seconds <= self.max_profile_seconds and interval > 0):
+            return self._json(request, {
+                'error': 'seconds must be more than 0 and at most %s, and '
+                         'interval more than 0' % (self.max_profile_seconds,),
+            }, 400)
+        if self.profiler.running:
+            return self._json(
+                request, {'error': 'The profiler is already running'}, 409)
+        self.profiler.start(seconds, interval)
+        return self._json(request, self.profiler.status(), 202)
+
+    @app.route('/profile', methods=['DELETE'])
+    def stop_profile(self, request):
+        """Stops the profile early"""
+        self.profiler.stop()
+        return self._json(request, self.profiler.status())
+
+    @app.route('/profile', methods=['GET'])
+    def get_profile(self, request):
+        """Returns the folded stacks of the current or last profile"""
+        request.setHeader('Content-Type', 'text/plain')
+        request.setHeader(
+            'X-Profile-Samples', str(self.profiler.samples))
+        return self.profiler.folded()
+
+    @app.route('/memory', methods=['GET'])
+    def get_memory(self, request):
+        """Reports the memory used by the worker, the live objects of the
+        most common types, and the size of the worker's sessions, work in
+        progress and caches. The objects are counted in a thread so that
+        the worker carries on while they are."""
+        try:
+            limit = int(request.args.get('limit', [20])[0])
+        except ValueError:
+            return self._json(
+                request, {'error': 'limit must be a number'}, 400)
+        worker = self.vumi_worker
+        memory = {
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'gc_counts': gc.get_count(),
+            'live_sessions': len(worker._live_sessions),
+            'in_flight': len(worker.in_flight),
+            'prompt_waits': len(worker._prompt_waits),
+            'timers': len(worker.scheduler),
+            'caches': {
+                'config': len(worker.config_cache),
+                'applications': len(worker.application_store),
+                'redirects': len(worker.redirect_graph),
+                'media': (
+                    len(worker.media_cache)
+                    if worker.media_cache is not None else 0),
+            },
+        }
+
+        def respond(counts):
+            memory.update(counts)
+            return self._json(request, memory)
+
+        return deferToThread(object_counts, limit).addCallback(respond)
+
+    @app.route('/config-cache', methods=['DELETE'])
+    def invalidate_config_cache(self, request):
+        """Drops the cached config of the tenant given by ``transport_name``,
+        ``endpoint`` and ``to_addr``, or every cached config if no tenant is
+        given, so that config changes are picked up straight away"""
+        to_addr = request.args.get('to_addr', [None])[0]
+        if to_addr is None:
+            key = None
+        else:
+            transport_name = request.args.get('transport_name', [None])[0]
+            if transport_name is None:
+                return self._json(request, {
+                    'error': 'transport_name is needed with to_addr'}, 400)
+            endpoint = request.args.get('endpoint', ['default'])[0]
+            key = (transport_name, endpoint, to_addr)
+        count = self.vumi_worker.config_cache.invalidate(key)
+        return self._json(request, {'invalidated': count})
+
+    @app.route('/limits', methods=['GET'])
+    def get_limits(self, request):
+        """Reports the load shedding limits and their usage"""
+        return self._json(request, self.vumi_worker.load_shedder.status())
+
+    @app.route('/limits/<string:name>', methods=['PUT'])
+    def set_limit(self, request, name):
+        """Changes the ``maximum`` of a load shedding limit. 0 removes the
+        limit."""
+        try:
+            maximum = int(request.args.get('maximum', [None])[0])
+        except (TypeError, ValueError):
+            maximum = -1
+        if maximum < 0:
+            return self._json(request, {
+                'error': 'maximum must be a number that is at least 0'}, 400)
+        load_shedder = self.vumi_worker.load_shedder
+        try:
+            load_shedder.set_maximum(name, maximum)
+        except KeyError:
+            return self._json(
+                request, {'error': 'No limit named %r' % (name,)}, 404)
+        return self._json(request, load_shedder.status()['limits'][name])
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+from hashlib import sha1
+import json
+
+from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
+
+
+class ApplicationStore(object):
+    """Stores the Applications of each account in a Redis hash, and caches
+    the formatted bodies of the responses that list and fetch them.
+
+    Every change to an account's Applications increments a version number
+    for the account, so a cached body is only used while the version it was
+    made from is current. Checking the version is a single ``GET``, instead
+    of loading, sorting and formatting every Application again."""
+
+    def __init__(self, redis, max_cached=1000):
+        """
+        :param redis: Redis manager
+        :param int max_cached: The maximum number of response bodies to keep
+        """
+        self.redis = redis
+        self.max_cached = max_cached
+        # (account_sid, key) mapped to (version, body, etag), least recently
+        # used first
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _key(self, account_sid):
+        return 'applications:%s' % (account_sid,)
+
+    def _version_key(self, account_sid):
+        return 'applications_version:%s' % (account_sid,)
+
+    def get_version(self, account_sid):
+        """Returns a deferred that fires with the current version of the
+        account's Applications, or ``None`` if they have never been stored"""
+        return self.redis.get(self._version_key(account_sid))
+
+    @inlineCallbacks
+    def list(self, account_sid):
+        """Returns the fields of each of the account's Applications"""
+        data = yield self.redis.hgetall(self._key(account_sid))
+        returnValue([json.loads(value) for value in data.itervalues()])
+
+    @inlineCallbacks
+    def get(self, account_sid, sid):
+        """Returns the fields of an Application, or ``None`` if it doesn't
+        exist"""
+        data = yield self.redis.hget(self._key(account_sid), sid)
+        returnValue(json.loads(data) if data is not None else None)
+
+    def _changed(self, account_sid):
+        for key in [key for key in self._cache if key[0] == account_sid]:
+            del self._cache[key]
+        return self.redis.incr(self._version_key(account_sid))
+
+    def save(self, account_sid, fields):
+        """Stores an Application, replacing any with the same Sid"""
+        return gatherResults([
+            self.redis.hset(
+                self._key(account_sid), fields['Sid'], json.dumps(fields)),
+            self._changed(account_sid),
+            ], consumeErrors=True)
+
+    @inlineCallbacks
+    def delete(self, account_sid, sid):
+        """Removes an Application. Returns whether it existed."""
+        deleted = yield self.redis.hdel(self._key(account_sid), sid)
+        if deleted:
+            yield self._changed(account_sid)
+        returnValue(bool(deleted))
+
+    def get_cached(self, account_sid, key, version):
+        """Returns the ``(body, etag)`` cached under ``key``, such as the
+        format and URI of a request, or ``None`` if there is nothing cached
+        for the given version"""
+        key = (account_sid, key)
+        cached = self._cache.get(key)
+        if cached is None or cached[0] != version:
+            return None
+        self._cache[key] = self._cache.pop(key)
+        return cached[1:]
+
+    def set_cached(self, account_sid, key, version, body):
+        """Caches the body of a response. Returns its ETag."""
+        etag = '"%s"' % (sha1(body).hexdigest(),)
+        self._cache.pop((account_sid, key), None)
+        self._cache[(account_sid, key)] = (version, body, etag)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return etag
@@ -0,0 +1,159 @@
+from collections import Counter, OrderedDict, deque
+from urlparse import urlparse
+
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class CircuitBreaker(object):
+    """Tracks the outcome of recent requests to a host, and stops sending it
+    requests while too many of them fail or are slow.
+
+    The breaker opens once ``error_rate`` of the last ``window`` requests
+    have failed. While it is open, requests aren't made. After
+    ``reset_timeout`` seconds it is half open, and lets one request through
+    as a probe: the breaker closes again if the probe succeeds, and opens
+    for another ``reset_timeout`` seconds if it doesn't."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, host, window=20, min_requests=10, error_rate=0.5,
+                 slow_seconds=5, reset_timeout=30, clock=reactor):
+        """
+        :param str host: The host the breaker is for
+        :param int window: The number of recent requests to count
+        :param int min_requests: The number of requests needed in the window
+            before the breaker can open
+        :param float error_rate: The share of failed requests at which the
+            breaker opens
+        :param float slow_seconds: Requests that take longer than this count
+            as failed
+        :param float reset_timeout: Seconds to wait after opening before
+            probing the host
+        :param clock: Provider of the current time
+        """
+        self.host = host
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        # Whether each recent request failed, oldest first
+        self._outcomes = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self._opened_at = None
+        self._probing = False
+        self.opened = 0
+        self.short_circuited = 0
+
+    def allow(self):
+        """Returns whether a request to the host should be made. Requests
+        that aren't are counted as short circuited."""
+        if self.state == self.OPEN and (
+                self.clock.seconds() >= self._opened_at + self.reset_timeout):
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        self.short_circuited += 1
+        return False
+
+    def record(self, ok, seconds):
+        """Records the outcome of a request that took ``seconds``"""
+        failed = not ok or seconds > self.slow_seconds
+        self._latencies.append(seconds)
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+            if failed:
+                self._open()
+            else:
+                self._outcomes.clear()
+                self._set_state(self.CLOSED)
+            return
+        self._outcomes.append(failed)
+        if (self.state == self.CLOSED and
+                len(self._outcomes) >= self.min_requests and
+                sum(self._outcomes) >= self.error_rate * len(self._outcomes)):
+            self._open()
+
+    def _open(self):
+        self._opened_at = self.clock.seconds()
+        self.opened += 1
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        log.msg('Circuit breaker for %s is now %s (was %s)' % (
+            self.host, state, self.state))
+        self.state = state
+
+    def status(self):
+        requests = len(self._outcomes)
+        failures = sum(self._outcomes)
+        return {
+            'state': self.state,
+            'requests': requests,
+            'failures': failures,
+            'error_rate': float(failures) / requests if requests else 0.0,
+            'mean_latency': (
+                sum(self._latencies) / len(self._latencies)
+                if self._latencies else 0.0),
+            'opened': self.opened,
+            'short_circuited': self.short_circuited,
+        }
+
+
+class CircuitBreakers(object):
+    """The CircuitBreaker of each host that requests are made to"""
+
+    def __init__(self, max_hosts=1000, clock=reactor, **config):
+        """
+        :param int max_hosts: The number of hosts to keep breakers for. The
+            breakers of the hosts least recently requested from are dropped
+            first.
+        :param clock: Provider of the current time
+        :param config: The config of each CircuitBreaker
+        """
+        self.max_hosts = max_hosts
+        self.clock = clock
+        self.config = config
+        # Hosts mapped to their breakers, least recently used first
+        self._breakers = OrderedDict()
+
+    def __len__(self):
+        return len(self._breakers)
+
+    def get(self, url):
+        """Returns the breaker for the host of ``url``"""
+        host = urlparse(url).netloc
+        breaker = self._breakers.pop(host, None)
+        if breaker is None:
+            breaker = CircuitBreaker(host, clock=self.clock, **self.config)
+            while len(self._breakers) >= self.max_hosts:
+                self._breakers.popitem(last=False)
+        self._breakers[host] = breaker
+        return breaker
+
+    def hosts(self):
+        return sorted(self._breakers)
+
+    def status(self, host):
+        return self._breakers[host].status()
+
+    def counts(self):
+        """Returns the number of breakers in each state, and the number of
+        requests that have been short circuited"""
+        counts = Counter(
+            (breaker.state for breaker in self._breakers.itervalues()))
+        return {
+            'closed': counts[CircuitBreaker.CLOSED],
+            'open': counts[CircuitBreaker.OPEN],
+            'half_open': counts[CircuitBreaker.HALF_OPEN],
+            'short_circuited': sum(
+                breaker.short_circuited
+                for breaker in self._breakers.itervalues()),
+        }
@@ -0,0 +1,169 @@
+from collections import OrderedDict
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import log
+
+
+class DurableQueue(object):
+    """A queue of JSON items kept in an append-only journal on local disk,
+    so that items that were put but not acknowledged survive a restart.
+
+    Writes made in the same reactor turn are synced to disk together, so a
+    burst of items costs a single fsync. Once most of the journal is made up
+    of acknowledged items, it is compacted by writing the items that are
+    left to a new journal, which replaces the old one."""
+
+    def __init__(self, path, compact_after=10000, clock=reactor):
+        """
+        :param str path: The journal file
+        :param int compact_after: The number of records the journal may hold
+            before it is compacted. 0 disables compaction.
+        :param clock: The reactor used to schedule syncs
+        """
+        self.path = path
+        self.compact_after = compact_after
+        self.clock = clock
+        self._items = OrderedDict()
+        self._file = None
+        self._lines = []
+        self._records = 0
+        self._puts = 0
+        self._waiting = []
+        self._sync_call = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def open(self):
+        """Loads the items left in the journal, and opens it for writing"""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    self._records += 1
+                    self._replay(line)
+        self._file = open(self.path, 'ab')
+        self._maybe_compact()
+
+    def _replay(self, line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # A write that was cut short by a crash
+            return
+        if 'put' in record:
+            self._items[record['put']] = record['item']
+        else:
+            self._items.pop(record['ack'], None)
+
+    def close(self):
+        if self._sync_call is not None:
+            self._sync_call.cancel()
+            self._sync()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def get(self, item_id):
+        """Returns the item with the given ID, or ``None`` if it isn't
+        queued"""
+        return self._items.get(item_id)
+
+    def pending(self, limit=None):
+        """Returns up to ``limit`` ``(item_id, item)`` tuples, oldest
+        first"""
+        items = self._items.items()
+        return items if limit is None else items[:limit]
+
+    def put(self, item_id, item):
+        """Queues an item. Returns a deferred that fires once it is on
+        disk."""
+        self._puts += 1
+        d = self._write({'put': item_id, 'item': item})
+        d.addCallback(lambda _: self._items.__setitem__(item_id, item))
+        return d
+
+    def ack(self, item_ids):
+        """Removes items from the queue. Returns a deferred that fires once
+        the removal is on disk."""
+        for item_id in item_ids:
+            self._items.pop(item_id, None)
+            self._lines.append(
+                json.dumps({'ack': item_id}, separators=(',', ':')))
+        return self._wait_for_sync()
+
+    def _write(self, record):
+        self._lines.append(json.dumps(record, separators=(',', ':')))
+        return self._wait_for_sync()
+
+    def _wait_for_sync(self):
+        d = Deferred()
+        self._waiting.append(d)
+        if self._sync_call is None:
+            self._sync_call = self.clock.callLater(0, self._sync)
+        return d
+
+    def _sync(self):
+        self._sync_call = None
+        lines, self._lines = self._lines, []
+        waiting, self._waiting = self._waiting, []
+        puts, self._puts = self._puts, 0
+        try:
+            if not self._items and not puts:
+                # Nothing is left in the journal that needs replaying, so
+                # start it again rather than letting it grow
+                self._file.seek(0)
+                self._file.truncate()
+                self._records = 0
+            else:
+                self._file.write(''.join('%s\n' % line for line in lines))
+                self._records += len(lines)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception as e:
+            for d in waiting:
+                d.errback(e)
+        else:
+            for d in waiting:
+                d.callback(None)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        """Compacts the journal if it has grown past ``compact_after``
+        records, and most of them are no longer needed"""
+        if not self.compact_after or self._records <= self.compact_after:
+            return
+        if self._records <= 2 * len(self._items):
+            return
+        try:
+            self._compact()
+        except Exception:
+            log.err(None, "Failed to compact journal %s" % (self.path,))
+
+    def _compact(self):
+        """Writes the queued items to a new journal, and moves it over the
+        old one. Items that are still waiting to be synced are written to
+        the new journal by the next sync."""
+        tmp_path = '%s.tmp' % (self.path,)
+        with open(tmp_path, 'wb') as f:
+            for item_id, item in self._items.iteritems():
+                f.write('%s\n' % json.dumps(
+                    {'put': item_id, 'item': item}, separators=(',', ':')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        # The rename has to be on disk before anything is appended to the
+        # new journal, or a crash could lose those writes
+        directory = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        old_file, self._file = self._file, open(self.path, 'ab')
+        old_file.close()
+        self._records = len(self._items)
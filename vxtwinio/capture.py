@@ -0,0 +1,85 @@
+"""Records the traffic a worker handles, so that it can be replayed later
+with :mod:`vxtwinio.replay` to reproduce a performance problem.
+
+A capture is a gzipped file with a JSON object on each line. Every record
+has a ``type`` and the time ``t`` it was seen at, in seconds since the
+capture started:
+
+* ``inbound``: a ``message`` from the transport
+* ``event``: an ack, nack or delivery report ``event`` from the transport
+* ``outbound``: a ``message`` the worker sent to the transport
+* ``call``: the ``fields`` of a call made through the API
+* ``twiml``: a TwiML document fetched from ``url`` with ``method``, the
+  ``code`` and ``body`` of the response, and the seconds it took"""
+
+import gzip
+import json
+
+from twisted.internet import reactor
+from vumi.message import JSONMessageEncoder, date_time_decoder
+
+
+class CaptureWriter(object):
+    """Writes the traffic a worker handles to a capture file"""
+
+    def __init__(self, path, clock=reactor):
+        """
+        :param str path: The file to write the capture to. It is replaced
+            if it exists.
+        :param clock: Provider of the current time
+        """
+        self.path = path
+        self.clock = clock
+        self.started = None
+        self.records = 0
+        self._file = None
+
+    def open(self):
+        self._file = gzip.open(self.path, 'wb')
+        self.started = self.clock.seconds()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, type_, **fields):
+        if self._file is None:
+            return
+        fields['type'] = type_
+        fields['t'] = round(self.clock.seconds() - self.started, 6)
+        self._file.write(json.dumps(
+            fields, cls=JSONMessageEncoder, separators=(',', ':')))
+        self._file.write('\n')
+        self.records += 1
+
+    def inbound(self, message):
+        self._write('inbound', message=message.payload)
+
+    def event(self, event):
+        self._write('event', event=event.payload)
+
+    def outbound(self, message):
+        self._write('outbound', message=message.payload)
+
+    def call(self, fields):
+        self._write('call', fields=fields)
+
+    def twiml(self, url, method, code, body, elapsed):
+        if isinstance(body, str):
+            body = body.decode('utf-8', 'replace')
+        self._write(
+            'twiml', url=url, method=method, code=code, body=body,
+            elapsed=round(elapsed, 6))
+
+
+def read_capture(path):
+    """Yields the records in a capture file, in the order they were
+    written"""
+    f = gzip.open(path, 'rb')
+    try:
+        for line in f:
+            if line.strip():
+                yield json.loads(line, object_hook=date_time_decoder)
+    finally:
+        f.close()
@@ -0,0 +1,100 @@
+from math import ceil
+import json
+import os
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+def _get_time(session, field):
+    value = session.get(field)
+    if value in (None, '', 'None'):
+        return None
+    return float(value)
+
+
+def call_duration(session):
+    """Returns the number of seconds that the call was answered for"""
+    answer_time = _get_time(session, 'AnswerTime')
+    end_time = _get_time(session, 'EndTime')
+    if answer_time is None or end_time is None:
+        return 0
+    return int(ceil(max(end_time - answer_time, 0)))
+
+
+def make_cdr(session):
+    """Returns the call detail record for an ended call session"""
+    return {
+        'CallSid': session.get('CallId'),
+        'AccountSid': session.get('AccountSid'),
+        'From': session.get('From'),
+        'To': session.get('To'),
+        'Direction': session.get('Direction'),
+        'Status': session.get('Status'),
+        'StartTime': _get_time(session, 'StartTime'),
+        'AnswerTime': _get_time(session, 'AnswerTime'),
+        'EndTime': _get_time(session, 'EndTime'),
+        'Duration': call_duration(session),
+    }
+
+
+class CDRWriter(object):
+    """Appends call detail records to a local log file, one JSON object per
+    line.
+
+    Records are buffered in memory and written, then synced to disk, once
+    per ``flush_interval`` or as soon as ``batch_size`` records are waiting,
+    so that many calls ending at once cost one write and one fsync."""
+
+    def __init__(self, path, flush_interval=1.0, batch_size=1000,
+                 clock=reactor):
+        """
+        :param str path: The file to append records to
+        :param float flush_interval: Seconds between writes
+        :param int batch_size: The number of waiting records that causes an
+            immediate write
+        :param clock: The reactor used to schedule writes
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._buffer = []
+        self._file = None
+        self._looping_call = LoopingCall(self.flush)
+        self._looping_call.clock = clock
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def start(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._file = open(self.path, 'ab')
+        self._looping_call.start(self.flush_interval, now=False)
+
+    def stop(self):
+        if self._looping_call.running:
+            self._looping_call.stop()
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def write(self, record):
+        self._buffer.append(json.dumps(record, separators=(',', ':')))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes and syncs any waiting records"""
+        if not self._buffer or self._file is None:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            self._file.write(''.join('%s\n' % line for line in lines))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except (IOError, OSError):
+            log.err(None, "Error writing %s call detail records" % len(lines))
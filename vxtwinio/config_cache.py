@@ -0,0 +1,95 @@
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+from twisted.python.failure import Failure
+
+
+class ConfigCache(object):
+    """Caches the config resolved for each tenant, so that it isn't built
+    again for every message.
+
+    Configs are kept for a limited time, so that changes to a tenant's
+    config are picked up without a restart, and can be dropped sooner with
+    :meth:`invalidate`."""
+
+    def __init__(self, build, ttl, max_entries=1000, clock=reactor):
+        """
+        :param build: Callable that is given a message and returns a
+            deferred that fires with the config for it
+        :param int ttl: Seconds to keep each config for. Nothing is cached
+            if this is 0.
+        :param int max_entries: The maximum number of configs to keep
+        :param clock: Provider of the current time
+        """
+        self.build = build
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        # Keys mapped to (config, expiry), least recently used first
+        self._entries = OrderedDict()
+        # Keys mapped to the deferreds waiting for a config being built
+        self._pending = {}
+        self.hits = 0
+        self.builds = 0
+        self.expired = 0
+        self.invalidated = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, msg):
+        """Returns a deferred that fires with the config cached under
+        ``key``, building it from ``msg`` if it isn't cached"""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            config, expiry = entry
+            if expiry > self.clock.seconds():
+                self._entries[key] = entry
+                self.hits += 1
+                return succeed(config)
+            self.expired += 1
+        if key in self._pending:
+            # Share the build that is already in progress
+            self.hits += 1
+            d = Deferred()
+            self._pending[key].append(d)
+            return d
+        self._pending[key] = []
+        self.builds += 1
+        # A build that raises must still clear the pending entry, or every
+        # later request for the key would wait on it forever
+        d = maybeDeferred(self.build, msg)
+        d.addBoth(self._built, key)
+        return d
+
+    def _built(self, result, key):
+        waiting = self._pending.pop(key)
+        if self.ttl > 0 and not isinstance(result, Failure):
+            self._entries[key] = (result, self.clock.seconds() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        for d in waiting:
+            d.callback(result)
+        return result
+
+    def invalidate(self, key=None):
+        """Drops the config cached under ``key``, or every config if no key
+        is given. Returns the number of configs dropped."""
+        if key is None:
+            count = len(self._entries)
+            self._entries.clear()
+        else:
+            count = 1 if self._entries.pop(key, None) is not None else 0
+        self.invalidated += count
+        return count
+
+    def stats(self):
+        """Returns the counts of configs served from the cache and built"""
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'builds': self.builds,
+            'expired': self.expired,
+            'invalidated': self.invalidated,
+        }
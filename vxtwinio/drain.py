@@ -0,0 +1,58 @@
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+
+
+class InFlightTracker(object):
+    """Keeps track of the work in progress on a worker, so that it can be
+    waited for before the worker stops."""
+
+    def __init__(self, clock=reactor):
+        """
+        :param clock: The reactor used to time out waits
+        """
+        self.clock = clock
+        # Deferreds of work in progress mapped to what they're working on
+        self._in_flight = {}
+        self._waiting = []
+
+    def __len__(self):
+        return len(self._in_flight)
+
+    def track(self, d, subject=None):
+        """Tracks the work that ``d`` fires for, until it fires. ``subject``
+        is what the work is on, such as a call session. Returns ``d``."""
+        if d.called:
+            return d
+        self._in_flight[d] = subject
+
+        def done(result):
+            del self._in_flight[d]
+            if not self._in_flight:
+                waiting, self._waiting = self._waiting, []
+                for waiter, timeout in waiting:
+                    timeout.cancel()
+                    waiter.callback(True)
+            return result
+
+        d.addBoth(done)
+        return d
+
+    def subjects(self):
+        """Returns the subjects of the work in progress that have one"""
+        return [s for s in self._in_flight.itervalues() if s is not None]
+
+    def wait(self, timeout):
+        """Returns a deferred that fires with ``True`` once there is no work
+        in progress, or with ``False`` if there still is after ``timeout``
+        seconds"""
+        if not self._in_flight:
+            return succeed(True)
+        waiter = Deferred()
+
+        def timed_out():
+            self._waiting.remove((waiter, call))
+            waiter.callback(False)
+
+        call = self.clock.callLater(timeout, timed_out)
+        self._waiting.append((waiter, call))
+        return waiter
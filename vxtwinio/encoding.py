@@ -0,0 +1,106 @@
+from collections import defaultdict
+import gzip
+from StringIO import StringIO
+import zlib
+
+
+# Media types mapped to the response format they ask for
+FORMATS = {
+    'application/xml': 'xml',
+    'text/xml': 'xml',
+    'application/json': 'json',
+    'text/json': 'json',
+}
+
+ENCODINGS = ['gzip', 'deflate']
+
+
+def parse_accept(header):
+    """Returns the values of an Accept style header mapped to their quality,
+    for example ``{'gzip': 1.0, 'deflate': 0.5}``"""
+    values = {}
+    for part in (header or '').split(','):
+        params = part.strip().split(';')
+        value = params[0].strip().lower()
+        if not value:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, q = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(q)
+                except ValueError:
+                    quality = 0.0
+        values[value] = quality
+    return values
+
+
+def negotiate_format(header, default='xml'):
+    """Returns the response format that the given Accept header prefers, or
+    ``default`` if it doesn't ask for one we support"""
+    best, best_quality = default, 0.0
+    for media_type, quality in parse_accept(header).iteritems():
+        format_ = FORMATS.get(media_type)
+        if format_ is not None and quality > best_quality:
+            best, best_quality = format_, quality
+    return best
+
+
+def negotiate_encoding(header):
+    """Returns the content encoding that the given Accept-Encoding header
+    prefers, or ``None`` if it doesn't accept one we support"""
+    accepted = parse_accept(header)
+    wildcard = accepted.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def compress(data, encoding, level=6):
+    """Returns ``data`` compressed with the given content encoding"""
+    if encoding == 'deflate':
+        return zlib.compress(data, level)
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class CompressionStats(object):
+    """Counts the bytes that compression saves, per route"""
+
+    def __init__(self):
+        self.routes = defaultdict(lambda: {
+            'responses': 0,
+            'compressed': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        })
+
+    def record(self, route, size, compressed_size=None):
+        """Records a response of ``size`` bytes, and its size after
+        compression if it was compressed"""
+        stats = self.routes[route]
+        stats['responses'] += 1
+        stats['bytes_in'] += size
+        if compressed_size is None:
+            stats['bytes_out'] += size
+        else:
+            stats['compressed'] += 1
+            stats['bytes_out'] += compressed_size
+
+    def bytes_saved(self, route):
+        stats = self.routes.get(route)
+        if stats is None:
+            return 0
+        return stats['bytes_in'] - stats['bytes_out']
+
+    def summary(self):
+        """Returns the stats for each route, including the bytes saved"""
+        return dict(
+            (route, dict(stats, bytes_saved=self.bytes_saved(route)))
+            for route, stats in self.routes.iteritems())
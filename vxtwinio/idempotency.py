@@ -0,0 +1,63 @@
+from hashlib import sha1
+import json
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+
+def fingerprint(fields):
+    """Returns a digest of request fields, to tell whether a request that
+    reuses an idempotency key is the same as the one that first used it"""
+    return sha1(json.dumps(fields, sort_keys=True)).hexdigest()
+
+
+class IdempotencyStore(object):
+    """Remembers the result of requests made with an idempotency key, so
+    that a client retrying a request gets the original result back instead
+    of the request being carried out again.
+
+    A key is claimed with ``SETNX`` before the request is carried out, so
+    that only one of several concurrent requests with the same key goes
+    ahead. The claim is then replaced by the result of the request."""
+
+    def __init__(self, redis, ttl, namespace='idempotency'):
+        """
+        :param redis: Redis manager
+        :param int ttl: Seconds to remember keys for
+        :param str namespace: The prefix of the Redis keys
+        """
+        self.redis = redis
+        self.ttl = ttl
+        self.namespace = namespace
+
+    def _key(self, account_sid, key):
+        return '%s:%s:%s' % (self.namespace, account_sid, key)
+
+    @inlineCallbacks
+    def claim(self, account_sid, key, fingerprint):
+        """Claims an idempotency key for a request with the given
+        fingerprint. Returns ``None`` if the key was claimed, otherwise the
+        record stored under it by an earlier request, which has a
+        ``fingerprint`` and, once that request has finished, a ``result``."""
+        redis_key = self._key(account_sid, key)
+        claimed = yield self.redis.setnx(
+            redis_key, json.dumps({'fingerprint': fingerprint}))
+        if claimed:
+            yield self.redis.expire(redis_key, self.ttl)
+            returnValue(None)
+        record = yield self.redis.get(redis_key)
+        if record is None:
+            # The earlier request expired or failed since we tried, so try
+            # again
+            record = yield self.claim(account_sid, key, fingerprint)
+            returnValue(record)
+        returnValue(json.loads(record))
+
+    def complete(self, account_sid, key, fingerprint, result):
+        """Stores the result of the request that claimed a key"""
+        return self.redis.setex(
+            self._key(account_sid, key), self.ttl,
+            json.dumps({'fingerprint': fingerprint, 'result': result}))
+
+    def release(self, account_sid, key):
+        """Releases a claimed key, so that the request can be retried"""
+        return self.redis.delete(self._key(account_sid, key))
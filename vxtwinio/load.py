@@ -0,0 +1,67 @@
+from collections import Counter, OrderedDict
+
+
+class LoadShedder(object):
+    """Measures the work in progress on a worker against configured limits,
+    so that new work can be turned away while the worker is overloaded,
+    instead of every live call slowing down together."""
+
+    def __init__(self):
+        # Limit names mapped to (maximum, usage), where usage is a callable
+        # that returns the amount of work in progress
+        self._limits = OrderedDict()
+        self.rejected = Counter()
+        # Set to False to turn away all new work, such as while draining
+        self.accepting = True
+
+    def add_limit(self, name, maximum, usage):
+        """
+        :param str name: The name of the limit
+        :param int maximum: The amount of work at which new work is turned
+            away. 0 means there is no limit.
+        :param usage: A callable that returns the amount of work in progress
+        """
+        self._limits[name] = (maximum, usage)
+
+    def set_maximum(self, name, maximum):
+        """Changes the maximum of a limit, for example while tuning a running
+        worker"""
+        _, usage = self._limits[name]
+        self._limits[name] = (maximum, usage)
+
+    def exceeded(self):
+        """Returns the name of the first limit that has been reached, or
+        ``None`` if there is room for more work. Returns ``'draining'``
+        once new work is no longer being accepted."""
+        if not self.accepting:
+            return 'draining'
+        for name, (maximum, usage) in self._limits.iteritems():
+            if maximum and usage() >= maximum:
+                return name
+        return None
+
+    def admit(self, kind):
+        """Returns whether new work of the given kind can be started,
+        counting it as rejected if it can't"""
+        if self.exceeded() is None:
+            return True
+        self.rejected[kind] += 1
+        return False
+
+    def status(self):
+        """Returns the usage of each limit, and the number of times each kind
+        of work has been rejected"""
+        limits = {}
+        for name, (maximum, usage) in self._limits.iteritems():
+            in_use = usage()
+            limits[name] = {
+                'in_use': in_use,
+                'limit': maximum,
+                'utilisation': float(in_use) / maximum if maximum else 0.0,
+            }
+        return {
+            'accepting': self.accepting,
+            'overloaded': self.exceeded() is not None,
+            'limits': limits,
+            'rejected': dict(self.rejected),
+        }
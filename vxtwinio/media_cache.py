@@ -0,0 +1,187 @@
+from collections import OrderedDict
+from hashlib import sha1
+import os
+from urlparse import urlparse
+
+import treq
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, succeed)
+from twisted.python import log
+from twisted.web.static import File
+
+
+class MediaFetchError(Exception):
+    """Raised when remote media could not be fetched"""
+
+
+class UnlistedFile(File):
+    """Serves the files in a directory, without listing what they are. A
+    request for a directory is answered with a 404."""
+    indexNames = []
+
+    def directoryListing(self):
+        return self.childNotFound
+
+    def render_GET(self, request):
+        if self.isdir():
+            return self.childNotFound.render(request)
+        return File.render_GET(self, request)
+
+
+class MediaCache(object):
+    """Caches remote media, such as the URLs of Play verbs, on local disk so
+    that the transport fetches them from the worker instead of from the
+    customer's servers.
+
+    The least recently used files are removed once either the entry limit or
+    the size limit is reached. If media can't be fetched in time, the
+    original URL is used instead, and is used straight away for a while
+    after."""
+
+    def __init__(self, directory, base_url, max_entries=1000,
+                 max_bytes=512 * 1024 * 1024, fetch_timeout=5,
+                 failure_ttl=60, clock=reactor):
+        """
+        :param str directory: The directory to store media in
+        :param str base_url: The URL that the directory is served on
+        :param int max_entries: The maximum number of files to keep
+        :param int max_bytes: The maximum total size of files to keep
+        :param float fetch_timeout: Seconds to wait for media to download
+        :param float failure_ttl: Seconds to use the original URL for
+            without fetching it again, once fetching it has failed
+        :param clock: Provider of the current time
+        """
+        self.directory = directory
+        self.base_url = base_url.rstrip('/')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.fetch_timeout = fetch_timeout
+        self.failure_ttl = failure_ttl
+        self.clock = clock
+        self.total_bytes = 0
+        # Filenames mapped to file sizes, least recently used first
+        self._entries = OrderedDict()
+        self._pending = {}
+        # URLs that couldn't be fetched mapped to when they can be fetched
+        # again, oldest first
+        self._failed = OrderedDict()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._load_entries()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load_entries(self):
+        """Picks up files left by a previous run, oldest first"""
+        paths = [
+            os.path.join(self.directory, filename)
+            for filename in os.listdir(self.directory)
+            if not filename.endswith('.tmp')]
+        for path in sorted(paths, key=os.path.getmtime):
+            self._add_entry(os.path.basename(path), os.path.getsize(path))
+        self._evict()
+
+    def _get_filename(self, url):
+        # Keep the extension, so that the file is served with the right
+        # content type
+        _, extension = os.path.splitext(urlparse(url).path)
+        return '%s%s' % (sha1(url).hexdigest(), extension[:8])
+
+    def _get_path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _get_url(self, filename):
+        return '%s/%s' % (self.base_url, filename)
+
+    def _add_entry(self, filename, size):
+        self._entries[filename] = size
+        self.total_bytes += size
+
+    def _touch(self, filename):
+        self._entries[filename] = self._entries.pop(filename)
+
+    def _evict(self):
+        while self._entries and (
+                len(self._entries) > self.max_entries or
+                self.total_bytes > self.max_bytes):
+            filename, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._get_path(filename))
+            except OSError:
+                pass
+
+    def _fetch(self, url):
+        return treq.get(url, persistent=False)
+
+    @inlineCallbacks
+    def _download(self, url, filename):
+        response = yield self._fetch(url)
+        if response.code < 200 or response.code >= 300:
+            raise MediaFetchError(
+                "Fetching %r returned status %r" % (url, response.code))
+        data = yield response.content()
+        if len(data) > self.max_bytes:
+            raise MediaFetchError(
+                "Media %r is larger than the cache size" % url)
+        # Write to a temporary file first so that the transport never sees
+        # a partially written file
+        path = self._get_path(filename)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+        self._add_entry(filename, len(data))
+        self._evict()
+        returnValue(self._get_url(filename))
+
+    def _download_failed(self, failure, url):
+        log.msg("Not caching media %r: %s" % (url, failure.getErrorMessage()))
+        self._failed.pop(url, None)
+        self._failed[url] = self.clock.seconds() + self.failure_ttl
+        while len(self._failed) > self.max_entries:
+            self._failed.popitem(last=False)
+        return url
+
+    def _recently_failed(self, url):
+        retry_at = self._failed.get(url)
+        if retry_at is None:
+            return False
+        if retry_at <= self.clock.seconds():
+            del self._failed[url]
+            return False
+        return True
+
+    def _download_done(self, result, filename):
+        for d in self._pending.pop(filename):
+            d.callback(result)
+
+    def get_url(self, url):
+        """Returns a deferred that fires with the local URL for ``url``,
+        fetching it first if it isn't already cached. Fires with ``url``
+        itself if it can't be fetched."""
+        filename = self._get_filename(url)
+        if filename in self._entries:
+            self._touch(filename)
+            return succeed(self._get_url(filename))
+        if self._recently_failed(url):
+            return succeed(url)
+
+        d = Deferred()
+        if filename in self._pending:
+            self._pending[filename].append(d)
+        else:
+            self._pending[filename] = [d]
+            download = self._download(url, filename)
+            download.addTimeout(self.fetch_timeout, self.clock)
+            download.addErrback(self._download_failed, url)
+            download.addCallback(self._download_done, filename)
+        return d
+
+    def resource(self):
+        """Returns a web resource that serves the cached media. Range
+        requests are supported, and files are streamed to the client rather
+        than read into memory."""
+        return UnlistedFile(self.directory)
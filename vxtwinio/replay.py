@@ -0,0 +1,278 @@
+"""Replays a capture recorded by a worker with ``capture_path`` set, to
+reproduce the load it handled.
+
+The captured messages, events and calls are fed into a worker at the speed
+they were captured at, a multiple of it, or as fast as the worker can take
+them. The worker sends its messages to a stub transport instead of AMQP,
+and is served the captured TwiML instead of fetching it from the client,
+so that a replay doesn't depend on anything outside the worker but
+Redis."""
+
+import argparse
+from collections import defaultdict
+import sys
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import (
+    DeferredList, inlineCallbacks, maybeDeferred, returnValue, succeed)
+from twisted.python import log
+from vumi.message import TransportEvent, TransportUserMessage
+import yaml
+
+from vxtwinio.capture import read_capture
+from vxtwinio.twilio_api import TwilioAPIWorker
+
+
+class StubResponse(object):
+    """A captured HTTP response"""
+
+    def __init__(self, code, body):
+        self.code = code
+        self.body = body
+
+    def content(self):
+        return succeed(self.body)
+
+
+class StubHTTP(object):
+    """Serves the TwiML responses in a capture in place of the client. Each
+    URL gets the responses captured for it in turn, and then the last one
+    again. Requests for anything else get a 404."""
+
+    def __init__(self, records, speed=None, clock=reactor):
+        """
+        :param records: The records of a capture
+        :param float speed: The speed of the replay, as a multiple of the
+            speed it was captured at. Responses are delayed by the time
+            they took when they were captured, divided by this. Responses
+            aren't delayed if this is ``None``.
+        :param clock: The reactor used to delay responses
+        """
+        self.speed = speed
+        self.clock = clock
+        self.requests = []
+        # (url, method) mapped to the (code, body, elapsed) responses
+        self._responses = defaultdict(list)
+        for record in records:
+            if record['type'] == 'twiml':
+                self._responses[record['url'], record['method']].append((
+                    record['code'], record['body'].encode('utf-8'),
+                    record['elapsed']))
+
+    def request(self, url='', method='GET', data={}):
+        self.requests.append((url, method, data))
+        responses = self._responses.get((url, method))
+        if not responses:
+            return succeed(StubResponse(404, ''))
+        if len(responses) > 1:
+            code, body, elapsed = responses.pop(0)
+        else:
+            [(code, body, elapsed)] = responses
+        response = StubResponse(code, body)
+        if self.speed is None:
+            return succeed(response)
+        return task.deferLater(
+            self.clock, elapsed / float(self.speed), lambda: response)
+
+
+class StubTransport(object):
+    """Takes the place of a worker's transport connector, keeping the
+    messages the worker sends"""
+
+    def __init__(self):
+        self.outbound = []
+        # Addresses mapped to the IDs of the messages sent to them, in order
+        self.sent_ids = defaultdict(list)
+        self.paused = True
+
+    def publish_outbound(self, message, endpoint_name=None):
+        self.outbound.append(message)
+        self.sent_ids[message['to_addr']].append(message['message_id'])
+        return succeed(message)
+
+    def pause(self):
+        self.paused = True
+        return succeed(None)
+
+    def unpause(self):
+        self.paused = False
+
+
+class Replayer(object):
+    """Feeds the messages, events and calls in a capture into a worker"""
+
+    def __init__(self, records, speed=None, drain_timeout=30):
+        """
+        :param records: The records of a capture
+        :param float speed: The speed to replay at, as a multiple of the
+            speed it was captured at. If this is ``None``, each record is
+            replayed as soon as the one before it has been handled.
+        :param float drain_timeout: Seconds to wait for the worker to finish
+            what it is doing once everything has been replayed
+        """
+        self.records = records
+        self.speed = speed
+        self.drain_timeout = drain_timeout
+        self.worker = None
+        self.transport = StubTransport()
+        self.http = None
+        self.replayed = 0
+        self.errors = 0
+        # Captured outbound message IDs mapped to the address they were
+        # sent to, and how many messages were sent to it before them, so
+        # that events for them can be given to the messages sent in their
+        # place
+        self._captured_ids = {}
+        self.captured_outbound = 0
+        sent = defaultdict(int)
+        for record in records:
+            if record['type'] == 'outbound':
+                to_addr = record['message']['to_addr']
+                self._captured_ids[record['message']['message_id']] = (
+                    to_addr, sent[to_addr])
+                sent[to_addr] += 1
+                self.captured_outbound += 1
+
+    @inlineCallbacks
+    def start_worker(self, config):
+        """Starts a worker with the given config to replay the capture into.
+        It sends messages to a :class:`StubTransport` and is served TwiML
+        by a :class:`StubHTTP`."""
+        config = dict(config)
+        config.setdefault('transport_name', 'replay')
+        config.setdefault('redis_manager', {'FAKE_REDIS': True})
+        config.setdefault('web_port', 0)
+        worker = TwilioAPIWorker({}, config)
+        worker._validate_config()
+        worker.connectors[worker.transport_name] = self.transport
+        self.http = StubHTTP(self.records, self.speed, clock=worker.clock)
+        worker._http_request = self.http.request
+        yield worker.setup_worker()
+        self.worker = worker
+        returnValue(worker)
+
+    def stop_worker(self):
+        return self.worker.teardown_worker()
+
+    def _replayed_id(self, message_id):
+        """Returns the ID of the message sent in place of the captured
+        message with the given ID"""
+        if message_id not in self._captured_ids:
+            return message_id
+        to_addr, index = self._captured_ids[message_id]
+        sent = self.transport.sent_ids.get(to_addr, [])
+        if index < len(sent):
+            return sent[index]
+        return message_id
+
+    def _replay(self, record):
+        if record['type'] == 'inbound':
+            return self.worker.dispatch_user_message(
+                TransportUserMessage(**record['message']))
+        if record['type'] == 'event':
+            payload = dict(record['event'])
+            payload['user_message_id'] = self._replayed_id(
+                payload['user_message_id'])
+            return self.worker.dispatch_event(TransportEvent(**payload))
+        return self.worker.start_call(dict(record['fields']))
+
+    def _replayed(self, result, record):
+        self.replayed += 1
+        return result
+
+    def _failed(self, failure, record):
+        self.errors += 1
+        log.err(failure, "Error replaying %s record at %ss" % (
+            record['type'], record['t']))
+
+    def replay(self, record):
+        d = maybeDeferred(self._replay, record)
+        d.addCallback(self._replayed, record)
+        d.addErrback(self._failed, record)
+        return d
+
+    @inlineCallbacks
+    def run(self):
+        """Replays the capture, and returns a summary of the replay once the
+        worker has handled everything"""
+        clock = self.worker.clock
+        started = clock.seconds()
+        replaying = []
+        for record in self.records:
+            if record['type'] not in ('inbound', 'event', 'call'):
+                continue
+            if self.speed is None:
+                yield self.replay(record)
+                continue
+            delay = (
+                started + record['t'] / float(self.speed) - clock.seconds())
+            if delay > 0:
+                yield task.deferLater(clock, delay, lambda: None)
+            replaying.append(self.replay(record))
+        yield DeferredList(replaying)
+        finished = yield self.worker.in_flight.wait(self.drain_timeout)
+        returnValue({
+            'replayed': self.replayed,
+            'errors': self.errors,
+            'outbound': len(self.transport.outbound),
+            'captured_outbound': self.captured_outbound,
+            'twiml_requests': len(self.http.requests),
+            'elapsed': clock.seconds() - started,
+            'finished': finished,
+        })
+
+
+def format_summary(summary):
+    return (
+        "Replayed %(replayed)s records in %(elapsed).2fs with %(errors)s "
+        "errors. Sent %(outbound)s messages (%(captured_outbound)s when "
+        "captured) and made %(twiml_requests)s TwiML requests.%(unfinished)s"
+        % dict(summary, unfinished=(
+            '' if summary['finished'] else
+            ' Work was still in progress when the replay ended.')))
+
+
+@inlineCallbacks
+def _run(reactor, options, stdout):
+    config = {}
+    if options.config is not None:
+        with open(options.config, 'rb') as f:
+            config = yaml.safe_load(f) or {}
+    records = list(read_capture(options.capture))
+    speed = None if options.max_speed else options.speed
+    replayer = Replayer(records, speed)
+    yield replayer.start_worker(config)
+    try:
+        summary = yield replayer.run()
+    finally:
+        yield replayer.stop_worker()
+    stdout.write('%s\n' % (format_summary(summary),))
+    if summary['errors']:
+        raise SystemExit(1)
+
+
+def main(args=None, stdout=sys.stdout):
+    parser = argparse.ArgumentParser(
+        description="Replay traffic captured by a vxtwinio worker")
+    parser.add_argument(
+        'capture', metavar='CAPTURE',
+        help="The file the worker's capture_path was set to")
+    parser.add_argument(
+        '--config',
+        help="YAML config for the worker that the capture is replayed into. "
+             "Fake Redis is used if it has no redis_manager.")
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help="The speed to replay at, as a multiple of the speed the "
+             "traffic was captured at. Defaults to 1.")
+    parser.add_argument(
+        '--max-speed', action='store_true',
+        help="Replay each record as soon as the one before it is handled")
+    options = parser.parse_args(args)
+    if options.speed <= 0:
+        parser.error("--speed must be greater than 0")
+    task.react(_run, [options, stdout])
+
+
+if __name__ == '__main__':
+    main()
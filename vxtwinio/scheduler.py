@@ -0,0 +1,255 @@
+import json
+from math import ceil
+import uuid
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredList, inlineCallbacks, maybeDeferred)
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+class Timer(object):
+    """A single timer on a :class:`TimerWheel`"""
+
+    def __init__(self, wheel, deadline, func, args, kw):
+        self.wheel = wheel
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.bucket = None
+        self.cancelled = False
+        self.called = False
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+
+class TimerWheel(object):
+    """A hierarchical timing wheel.
+
+    Timers are kept in buckets of increasingly coarse resolution, and are
+    moved down to finer buckets as their deadline approaches. Adding and
+    cancelling a timer costs the same no matter how many are pending, and a
+    single reactor call per tick drives all of them."""
+
+    def __init__(self, resolution=0.1, slots=(256, 64, 64, 64),
+                 clock=reactor):
+        """
+        :param float resolution: Seconds per tick
+        :param tuple slots: The number of buckets in each level
+        :param clock: The reactor used to drive the wheel
+        """
+        self.resolution = resolution
+        self.clock = clock
+        self._slots = slots
+        self._units = [1]
+        for size in slots[:-1]:
+            self._units.append(self._units[-1] * size)
+        self._span = self._units[-1] * slots[-1]
+        self._levels = [[set() for _ in range(size)] for size in slots]
+        # Timers too far in the future for the top level
+        self._overflow = set()
+        self._count = 0
+        self._tick = self._current_tick()
+        self._looping_call = LoopingCall(self.advance)
+        self._looping_call.clock = clock
+
+    def __len__(self):
+        return self._count
+
+    def _current_tick(self):
+        return int(self.clock.seconds() / self.resolution)
+
+    def start(self):
+        self._tick = self._current_tick()
+        self._looping_call.start(self.resolution, now=False)
+
+    def stop(self):
+        if self._looping_call.running:
+            self._looping_call.stop()
+
+    def call_later(self, delay, func, *args, **kw):
+        """Calls ``func`` after ``delay`` seconds. Returns a :class:`Timer`
+        that can be cancelled."""
+        deadline = int(ceil(
+            (self.clock.seconds() + delay) / self.resolution))
+        timer = Timer(self, deadline, func, args, kw)
+        self._count += 1
+        self._insert(timer, self._tick + 1)
+        return timer
+
+    def cancel(self, timer):
+        """Cancels ``timer``, if it hasn't already run or been cancelled"""
+        if not timer.active():
+            return
+        if timer.bucket is not None:
+            timer.bucket.discard(timer)
+            timer.bucket = None
+        timer.cancelled = True
+        self._count -= 1
+
+    def _insert(self, timer, earliest):
+        deadline = max(timer.deadline, earliest)
+        for size, unit, level in zip(self._slots, self._units, self._levels):
+            if deadline // unit - self._tick // unit < size:
+                bucket = level[(deadline // unit) % size]
+                break
+        else:
+            bucket = self._overflow
+        timer.bucket = bucket
+        bucket.add(timer)
+
+    def advance(self):
+        """Runs every timer that is due"""
+        target = self._current_tick()
+        if self._count == 0:
+            self._tick = max(self._tick, target)
+            return
+        while self._tick < target:
+            self._process_tick(self._tick + 1)
+
+    def _process_tick(self, tick):
+        # Move timers from coarser buckets whose time has come down to finer
+        # ones, before expiring the finest bucket
+        self._tick = tick
+        for level in range(len(self._levels) - 1, 0, -1):
+            unit = self._units[level]
+            if tick % unit == 0:
+                bucket = self._levels[level][
+                    (tick // unit) % self._slots[level]]
+                self._reinsert(bucket)
+        if tick % self._span == 0:
+            self._reinsert(self._overflow)
+
+        bucket = self._levels[0][tick % self._slots[0]]
+        expired = list(bucket)
+        bucket.clear()
+        for timer in expired:
+            timer.bucket = None
+            self._call(timer)
+
+    def _reinsert(self, bucket):
+        timers = list(bucket)
+        bucket.clear()
+        for timer in timers:
+            self._insert(timer, self._tick)
+
+    def _call(self, timer):
+        timer.called = True
+        self._count -= 1
+        try:
+            timer.func(*timer.args, **timer.kw)
+        except Exception:
+            log.err(None, "Error running timer")
+
+
+class Scheduler(object):
+    """Named timers run on a :class:`TimerWheel`, and persisted to a Redis
+    sorted set scored by deadline.
+
+    A timer only runs for whoever removes it from the sorted set, so timers
+    that are overdue because the worker that scheduled them has gone away can
+    safely be taken over by another worker with :meth:`recover`."""
+
+    def __init__(self, redis, wheel, key='timers', recovery_interval=30,
+                 recovery_grace=30):
+        """
+        :param redis: Redis manager
+        :param TimerWheel wheel: The wheel that runs local timers
+        :param str key: The Redis key of the sorted set
+        :param int recovery_interval: Seconds between checks for timers to
+            take over. 0 disables the checks.
+        :param int recovery_grace: Seconds a timer has to be overdue by before
+            it is taken over
+        """
+        self.redis = redis
+        self.wheel = wheel
+        self.key = key
+        self.recovery_interval = recovery_interval
+        self.recovery_grace = recovery_grace
+        self._handlers = {}
+        self._timers = {}
+        self._running = set()
+        self._recovery_call = LoopingCall(self.recover)
+        self._recovery_call.clock = wheel.clock
+
+    def __len__(self):
+        return len(self._timers)
+
+    def register(self, kind, handler):
+        """Sets the function called with ``(timer_id, payload)`` when a timer
+        of the given kind runs."""
+        self._handlers[kind] = handler
+
+    def start(self):
+        self.wheel.start()
+        if self.recovery_interval:
+            self._recovery_call.start(self.recovery_interval, now=True)
+
+    def stop(self):
+        """Stops running timers. Returns a deferred that fires once the timers
+        that are already running have finished."""
+        self.wheel.stop()
+        if self._recovery_call.running:
+            self._recovery_call.stop()
+        return self.wait_for_running()
+
+    def wait_for_running(self):
+        """Returns a deferred that fires once the timers that are running have
+        finished"""
+        return DeferredList(list(self._running))
+
+    def schedule(self, delay, kind, payload):
+        """Schedules a timer. Returns a deferred that fires with the timer ID
+        once the timer has been stored."""
+        timer_id = json.dumps(
+            [kind, uuid.uuid4().hex, payload], separators=(',', ':'))
+        deadline = self.wheel.clock.seconds() + delay
+        self._timers[timer_id] = self.wheel.call_later(
+            delay, self._run, timer_id)
+        d = self.redis.zadd(self.key, **{timer_id: deadline})
+        d.addCallback(lambda _: timer_id)
+        return d
+
+    def cancel(self, timer_id):
+        """Cancels a timer, wherever it was scheduled"""
+        timer = self._timers.pop(timer_id, None)
+        if timer is not None:
+            timer.cancel()
+        return self.redis.zrem(self.key, timer_id)
+
+    def _run(self, timer_id):
+        self._timers.pop(timer_id, None)
+        d = self._claim_and_run(timer_id)
+        d.addErrback(log.err, "Error running timer %r" % (timer_id,))
+        self._running.add(d)
+        d.addBoth(self._finished, d)
+        return d
+
+    def _finished(self, result, d):
+        self._running.discard(d)
+        return result
+
+    @inlineCallbacks
+    def _claim_and_run(self, timer_id):
+        claimed = yield self.redis.zrem(self.key, timer_id)
+        if not claimed:
+            # Cancelled, or already run by another worker
+            return
+        kind, _, payload = json.loads(timer_id)
+        yield maybeDeferred(self._handlers[kind], timer_id, payload)
+
+    @inlineCallbacks
+    def recover(self):
+        """Runs timers that are overdue by more than the grace period and that
+        aren't scheduled locally"""
+        cutoff = self.wheel.clock.seconds() - self.recovery_grace
+        timer_ids = yield self.redis.zrangebyscore(self.key, '-inf', cutoff)
+        for timer_id in timer_ids:
+            if timer_id not in self._timers:
+                yield self._run(timer_id)
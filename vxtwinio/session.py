@@ -0,0 +1,93 @@
+import time
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from vumi.components.session import SessionManager
+
+
+class CallSession(dict):
+    """Session data for a single call that remembers which fields have been
+    changed since it was last written to Redis."""
+
+    def __init__(self, session_id, data=None, new=False):
+        """
+        :param str session_id: The key the session is stored under
+        :param dict data: The session fields
+        :param bool new: If True, every field is considered changed
+        """
+        super(CallSession, self).__init__(data or {})
+        self.session_id = session_id
+        self.dirty = set(self) if new else set()
+        self.cleared = False
+        # The (url, method) redirect targets followed in the current turn
+        self.redirects = []
+
+    def __setitem__(self, key, value):
+        if key in self and self[key] == value:
+            return
+        super(CallSession, self).__setitem__(key, value)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        raise TypeError("Fields cannot be removed from a CallSession")
+
+    def update(self, *args, **kw):
+        for key, value in dict(*args, **kw).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def changes(self):
+        """Returns a dictionary of the fields changed since the last write"""
+        return dict((key, self[key]) for key in self.dirty)
+
+
+class CallSessionManager(SessionManager):
+    """Session manager that writes :class:`CallSession` changes back to
+    Redis as a single ``HMSET`` per flush, instead of one ``HSET`` per
+    field."""
+
+    def _session_key(self, session_id):
+        return "%s:%s" % ('session', session_id)
+
+    @inlineCallbacks
+    def load_call_session(self, session_id):
+        data = yield self.load_session(session_id)
+        returnValue(CallSession(session_id, data))
+
+    @inlineCallbacks
+    def create_call_session(self, session_id, **fields):
+        """Replaces any existing session for ``session_id`` with a new one
+        containing ``fields``. The new session is written immediately."""
+        yield self.clear_session(session_id)
+        session = CallSession(session_id, new=True)
+        session['created_at'] = time.time()
+        session.update(fields)
+        yield self.flush(session)
+        if self.max_session_length:
+            yield self.schedule_session_expiry(
+                session_id, int(self.max_session_length))
+        returnValue(session)
+
+    def get_field(self, session_id, field):
+        """Returns a single field of a session, or ``None`` if the session or
+        the field doesn't exist"""
+        return self.redis.hget(self._session_key(session_id), field)
+
+    def flush(self, session):
+        """Writes the changed fields of ``session`` to Redis. Does nothing if
+        no fields have changed or the session has been cleared."""
+        if session.cleared or not session.dirty:
+            return succeed(session)
+        changes = session.changes()
+        session.dirty.clear()
+        d = self.redis.hmset(self._session_key(session.session_id), changes)
+        d.addCallback(lambda _: session)
+        return d
+
+    def clear_call_session(self, session):
+        """Removes the session from Redis. Any further changes to
+        ``session`` will not be written."""
+        session.cleared = True
+        return self.clear_session(session.session_id)
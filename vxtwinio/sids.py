@@ -0,0 +1,64 @@
+import os
+
+from twisted.internet import reactor
+
+
+class SIDGenerator(object):
+    """Generates Twilio style SIDs, such as ``CA`` followed by 32 hex digits,
+    that sort in the order they were created in.
+
+    The hex digits are made up of:
+
+    - 12 digits for the creation time in milliseconds
+    - 4 digits for the shard that created the SID
+    - 6 digits for a counter of the SIDs created in the same millisecond
+    - 10 random digits, so that processes sharing a shard ID don't clash
+    """
+
+    def __init__(self, shard_id=0, clock=reactor):
+        """
+        :param int shard_id: The shard to embed in SIDs, from 0 to 65535
+        :param clock: The reactor used to get the current time
+        """
+        if not 0 <= shard_id <= 0xffff:
+            raise ValueError("Shard ID %r is out of range" % (shard_id,))
+        self.shard_id = shard_id
+        self.clock = clock
+        self._last_ms = 0
+        self._counter = 0
+
+    def generate(self, prefix):
+        """Returns a new SID starting with ``prefix``"""
+        # Never go backwards, even if the clock does
+        now_ms = max(int(self.clock.seconds() * 1000), self._last_ms)
+        if now_ms == self._last_ms:
+            self._counter += 1
+            if self._counter > 0xffffff:
+                now_ms += 1
+                self._counter = 0
+        else:
+            self._counter = 0
+        self._last_ms = now_ms
+        return '%s%012x%04x%06x%s' % (
+            prefix, now_ms, self.shard_id, self._counter,
+            os.urandom(5).encode('hex'))
+
+
+def parse_sid(sid):
+    """Returns the ``(prefix, timestamp_ms, shard_id, counter)`` of a SID
+    made by :class:`SIDGenerator`"""
+    prefix, digits = sid[:2], sid[2:]
+    if len(digits) != 32:
+        raise ValueError("%r is not a valid SID" % (sid,))
+    try:
+        return (
+            prefix, int(digits[:12], 16), int(digits[12:16], 16),
+            int(digits[16:22], 16))
+    except ValueError:
+        raise ValueError("%r is not a valid SID" % (sid,))
+
+
+def min_sid(prefix, timestamp):
+    """Returns a SID that sorts before every SID with the given prefix that
+    was created at or after ``timestamp`` seconds, for range scans"""
+    return '%s%012x%s' % (prefix, int(timestamp * 1000), '0' * 20)
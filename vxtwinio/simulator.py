@@ -0,0 +1,482 @@
+"""A stand-in voice transport that behaves like a network of callers, so
+that the worker's scheduler, timeouts and load shedding can be measured
+under realistic conditions.
+
+Messages are acked after a delay drawn from a latency distribution, a
+share of them are nacked, and each call follows a caller script that says
+whether it is answered, which digits are entered and how long the caller
+waits before each, and when the caller hangs up.
+
+The simulator can run as a separate vumi transport worker::
+
+    $ twistd -n vumi_worker \\
+        --worker-class vxtwinio.simulator.SimulatedVoiceTransport \\
+        --config simulator.yaml
+
+or in the same process as a worker, in place of its transport::
+
+    $ vxtwinio-simulate --config worker.yaml --simulator simulator.yaml
+
+Latencies are given as a number of seconds, or as a dict with the ``type``
+of the distribution and its parameters:
+
+* ``{"type": "constant", "value": 0.1}``
+* ``{"type": "uniform", "min": 0.05, "max": 0.2}``
+* ``{"type": "exponential", "mean": 0.1}``
+* ``{"type": "normal", "mean": 0.1, "stddev": 0.02}``
+* ``{"type": "lognormal", "median": 0.1, "sigma": 0.5}``"""
+
+import argparse
+from collections import Counter
+import json
+import math
+from random import Random
+import sys
+
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, succeed
+from twisted.python import log
+from vumi.config import (
+    ConfigField, ConfigFloat, ConfigInt, ConfigList, ConfigText)
+from vumi.message import TransportEvent, TransportUserMessage
+from vumi.transports import Transport
+import yaml
+
+from vxtwinio.twilio_api import TwilioAPIWorker
+
+
+class Distribution(object):
+    """A distribution of delays, in seconds"""
+
+    TYPES = ('constant', 'uniform', 'exponential', 'normal', 'lognormal')
+
+    def __init__(self, spec):
+        """
+        :param spec: A number of seconds, or a dict with the ``type`` of the
+            distribution and its parameters
+        """
+        if isinstance(spec, (int, float)):
+            spec = {'type': 'constant', 'value': spec}
+        elif not isinstance(spec, dict):
+            raise ValueError("Invalid distribution %r" % (spec,))
+        if spec.get('type') not in self.TYPES:
+            raise ValueError(
+                "Unknown distribution %r, should be one of %s" % (
+                    spec.get('type'), ', '.join(self.TYPES)))
+        self.spec = spec
+
+    def sample(self, random):
+        """Returns a delay drawn from the distribution. Delays are never
+        negative."""
+        spec = self.spec
+        if spec['type'] == 'constant':
+            value = spec['value']
+        elif spec['type'] == 'uniform':
+            value = random.uniform(spec['min'], spec['max'])
+        elif spec['type'] == 'exponential':
+            value = random.expovariate(1.0 / spec['mean'])
+        elif spec['type'] == 'normal':
+            value = random.gauss(spec['mean'], spec['stddev'])
+        else:
+            value = random.lognormvariate(
+                math.log(spec['median']), spec['sigma'])
+        return max(value, 0)
+
+
+class CallerScript(object):
+    """How a simulated caller behaves during a call"""
+
+    def __init__(self, weight=1, answer_rate=1.0, digits=(), digit_delay=0,
+                 hangup_after=None):
+        """
+        :param weight: How often this script is chosen for a call, relative
+            to the weights of the other scripts
+        :param float answer_rate: The share of outbound calls that are
+            answered. The rest are nacked.
+        :param digits: The digits entered for each Gather, in turn. Gathers
+            after the last of these time out.
+        :param digit_delay: The distribution of the seconds between the
+            caller being prompted for digits and entering them
+        :param hangup_after: The distribution of the seconds between the
+            call being answered and the caller hanging up. The caller
+            doesn't hang up if this is ``None``.
+        """
+        self.weight = weight
+        self.answer_rate = answer_rate
+        self.digits = list(digits)
+        self.digit_delay = Distribution(digit_delay)
+        self.hangup_after = (
+            Distribution(hangup_after) if hangup_after is not None else None)
+
+
+class SimulatedCall(object):
+    """A call between a simulated caller at ``address`` and the worker's
+    ``local_addr``"""
+
+    def __init__(self, address, local_addr, script):
+        self.address = address
+        self.local_addr = local_addr
+        self.script = script
+        self.digits = list(script.digits)
+        self.hangup = None
+        # When the caller last did something that the worker responds to
+        self.waiting_since = None
+
+
+def summarize(samples):
+    """Returns the count, mean and percentiles of a list of numbers"""
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[max(int(math.ceil(p * len(samples))) - 1, 0)]
+
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': percentile(0.5),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'max': samples[-1],
+    }
+
+
+class CallSimulator(object):
+    """Plays the part of the callers on the other side of a transport.
+
+    The transport is given the messages the worker sends with
+    :meth:`handle_outbound`, and the simulator publishes the callers'
+    messages and events with the transport's ``publish_message``,
+    ``publish_ack`` and ``publish_nack``."""
+
+    def __init__(self, transport, ack_latency=0, nack_rate=0.0, scripts=None,
+                 call_rate=0.0, to_addr='+12345', clock=reactor,
+                 random=None):
+        """
+        :param transport: The transport to publish messages and events with
+        :param ack_latency: The distribution of the seconds between the
+            worker sending a message and it being acked or nacked
+        :param float nack_rate: The share of messages that are nacked
+        :param scripts: Dicts of the :class:`CallerScript` parameters, one
+            of which is chosen for each call by weight
+        :param float call_rate: The average number of inbound calls to make
+            each second. No calls are made if this is 0.
+        :param str to_addr: The address inbound calls are made to
+        :param clock: The reactor used to schedule the callers' actions
+        :param random: The source of randomness, which can be seeded to
+            repeat a simulation
+        """
+        self.transport = transport
+        self.ack_latency = Distribution(ack_latency)
+        self.nack_rate = nack_rate
+        self.scripts = [
+            CallerScript(**script) for script in (scripts or [{}])]
+        self.call_rate = call_rate
+        self.to_addr = to_addr
+        self.clock = clock
+        self.random = random if random is not None else Random()
+        # Caller addresses mapped to their live calls
+        self.calls = {}
+        self.counts = Counter()
+        # Seconds between the callers doing something and the worker
+        # responding
+        self.response_times = []
+        self._delayed = set()
+        self._addresses = 0
+
+    def _later(self, delay, f, *args):
+        def run():
+            self._delayed.discard(call)
+            f(*args)
+
+        call = self.clock.callLater(delay, run)
+        self._delayed.add(call)
+        return call
+
+    def start(self):
+        """Starts making inbound calls, if there is a call rate"""
+        if self.call_rate:
+            self._schedule_arrival()
+
+    def stop(self):
+        """Cancels everything that is scheduled"""
+        for call in self._delayed:
+            if call.active():
+                call.cancel()
+        self._delayed.clear()
+
+    def _schedule_arrival(self):
+        self._later(self.random.expovariate(self.call_rate), self._arrive)
+
+    def _arrive(self):
+        self._schedule_arrival()
+        self.place_call()
+
+    def _choose_script(self):
+        choice = self.random.uniform(
+            0, sum(script.weight for script in self.scripts))
+        for script in self.scripts:
+            choice -= script.weight
+            if choice <= 0:
+                break
+        return script
+
+    def _start(self, address, local_addr, script):
+        call = SimulatedCall(address, local_addr, script)
+        call.waiting_since = self.clock.seconds()
+        if script.hangup_after is not None:
+            call.hangup = self._later(
+                script.hangup_after.sample(self.random), self._hang_up, call)
+        self.calls[address] = call
+        return call
+
+    def _end(self, call):
+        del self.calls[call.address]
+        if call.hangup is not None and call.hangup.active():
+            call.hangup.cancel()
+
+    def _is_live(self, call):
+        return self.calls.get(call.address) is call
+
+    def place_call(self, from_addr=None):
+        """Makes an inbound call to the worker from ``from_addr``, or from
+        a new address if it isn't given"""
+        if from_addr is None:
+            self._addresses += 1
+            from_addr = '+1555%07d' % (self._addresses,)
+        self._start(from_addr, self.to_addr, self._choose_script())
+        self.counts['inbound_calls'] += 1
+        return self.transport.publish_message(
+            from_addr=from_addr, to_addr=self.to_addr, content='',
+            session_event=TransportUserMessage.SESSION_NEW,
+            transport_type='voice')
+
+    def handle_outbound(self, message):
+        """Handles a message sent by the worker"""
+        call = self.calls.get(message['to_addr'])
+        if call is not None and call.waiting_since is not None:
+            self.response_times.append(
+                self.clock.seconds() - call.waiting_since)
+            call.waiting_since = None
+        self._later(
+            self.ack_latency.sample(self.random), self._deliver, message)
+        return succeed(None)
+
+    def _deliver(self, message):
+        if self.random.random() < self.nack_rate:
+            self.counts['nacked'] += 1
+            return self.transport.publish_nack(
+                message['message_id'], 'Simulated failure')
+        if message['session_event'] == TransportUserMessage.SESSION_NEW:
+            script = self._choose_script()
+            if self.random.random() >= script.answer_rate:
+                self.counts['unanswered'] += 1
+                return self.transport.publish_nack(
+                    message['message_id'], 'No answer')
+            self.counts['outbound_calls'] += 1
+            self._start(message['to_addr'], message['from_addr'], script)
+        else:
+            self._heard(message)
+        self.counts['acked'] += 1
+        return self.transport.publish_ack(
+            message['message_id'], message['message_id'])
+
+    def _heard(self, message):
+        call = self.calls.get(message['to_addr'])
+        if call is None:
+            return
+        if message['session_event'] == TransportUserMessage.SESSION_CLOSE:
+            self.counts['closed_by_worker'] += 1
+            self._end(call)
+            return
+        voice = (message['helper_metadata'] or {}).get('voice', {})
+        if 'wait_for' in voice and call.digits:
+            self._later(
+                call.script.digit_delay.sample(self.random),
+                self._enter_digits, call, call.digits.pop(0))
+
+    def _enter_digits(self, call, digits):
+        if not self._is_live(call):
+            return
+        call.waiting_since = self.clock.seconds()
+        self.counts['digits'] += 1
+        return self.transport.publish_message(
+            from_addr=call.address, to_addr=call.local_addr, content=digits,
+            session_event=TransportUserMessage.SESSION_RESUME,
+            transport_type='voice')
+
+    def _hang_up(self, call):
+        if not self._is_live(call):
+            return
+        self.counts['hung_up'] += 1
+        self._end(call)
+        return self.transport.publish_message(
+            from_addr=call.address, to_addr=call.local_addr, content='',
+            session_event=TransportUserMessage.SESSION_CLOSE,
+            transport_type='voice')
+
+    def summary(self):
+        """Returns the counts of what has happened, and how long the worker
+        took to respond to the callers"""
+        return dict(
+            self.counts, live_calls=len(self.calls),
+            response_time=summarize(self.response_times))
+
+
+class InProcessTransport(object):
+    """Connects a :class:`CallSimulator` to a worker in the same process,
+    in place of the worker's transport connector"""
+
+    def __init__(self, worker):
+        """
+        :param worker: The worker, which must not have been set up yet
+        """
+        self.worker = worker
+        self.simulator = None
+        self.paused = True
+        worker._validate_config()
+        worker.connectors[worker.transport_name] = self
+
+    def publish_outbound(self, message, endpoint_name=None):
+        return self.simulator.handle_outbound(message)
+
+    def pause(self):
+        self.paused = True
+        return succeed(None)
+
+    def unpause(self):
+        self.paused = False
+
+    def _dispatch(self, handler, message):
+        d = maybeDeferred(handler, message)
+        d.addErrback(log.err, "Error handling simulated %s" % (
+            message['message_type'],))
+        return d
+
+    def publish_message(self, **kw):
+        kw.setdefault('transport_name', self.worker.transport_name)
+        kw.setdefault('transport_metadata', {})
+        return self._dispatch(
+            self.worker.dispatch_user_message, TransportUserMessage(**kw))
+
+    def publish_ack(self, user_message_id, sent_message_id):
+        return self._dispatch(self.worker.dispatch_event, TransportEvent(
+            event_type='ack', user_message_id=user_message_id,
+            sent_message_id=sent_message_id,
+            transport_name=self.worker.transport_name))
+
+    def publish_nack(self, user_message_id, reason):
+        return self._dispatch(self.worker.dispatch_event, TransportEvent(
+            event_type='nack', user_message_id=user_message_id,
+            nack_reason=reason, transport_name=self.worker.transport_name))
+
+
+class ConfigDistribution(ConfigField):
+    """A distribution of delays, given as a number of seconds or as a dict
+    with the ``type`` of the distribution and its parameters"""
+    field_type = 'distribution'
+
+    def clean(self, value):
+        try:
+            Distribution(value)
+        except ValueError as e:
+            self.raise_config_error("is not a distribution: %s" % (e,))
+        return value
+
+
+class SimulatedVoiceTransportConfig(Transport.CONFIG_CLASS):
+    """Config for the simulated voice transport"""
+    ack_latency = ConfigDistribution(
+        "The distribution of the seconds between a message being sent and "
+        "it being acked or nacked",
+        default=0, static=True)
+    nack_rate = ConfigFloat(
+        "The share of messages that are nacked", default=0.0, static=True)
+    scripts = ConfigList(
+        "How the callers behave. Each script is a dict with its weight, "
+        "answer_rate, digits, digit_delay and hangup_after.",
+        default=[{}], static=True)
+    call_rate = ConfigFloat(
+        "The average number of inbound calls to make each second",
+        default=0.0, static=True)
+    to_addr = ConfigText(
+        "The address inbound calls are made to",
+        default='+12345', static=True)
+    seed = ConfigInt(
+        "Seed for the simulation, so that it can be repeated",
+        default=None, static=True)
+
+
+class SimulatedVoiceTransport(Transport):
+    """A voice transport with simulated callers on the other side"""
+    CONFIG_CLASS = SimulatedVoiceTransportConfig
+    clock = reactor
+
+    def setup_transport(self):
+        config = self.get_static_config()
+        self.simulator = CallSimulator(
+            self, ack_latency=config.ack_latency, nack_rate=config.nack_rate,
+            scripts=config.scripts, call_rate=config.call_rate,
+            to_addr=config.to_addr, clock=self.clock,
+            random=Random(config.seed))
+        self.simulator.start()
+
+    def teardown_transport(self):
+        self.simulator.stop()
+        log.msg("Simulation summary: %s" % (
+            json.dumps(self.simulator.summary(), sort_keys=True),))
+
+    def handle_outbound_message(self, message):
+        return self.simulator.handle_outbound(message)
+
+
+@inlineCallbacks
+def _run(reactor, options, stdout):
+    config = {}
+    if options.config is not None:
+        with open(options.config, 'rb') as f:
+            config = yaml.safe_load(f) or {}
+    config.setdefault('transport_name', 'simulator')
+    config.setdefault('redis_manager', {'FAKE_REDIS': True})
+    config.setdefault('web_port', 0)
+    with open(options.simulator, 'rb') as f:
+        simulation = yaml.safe_load(f) or {}
+
+    worker = TwilioAPIWorker({}, config)
+    transport = InProcessTransport(worker)
+    transport.simulator = CallSimulator(
+        transport, random=Random(simulation.pop('seed', None)),
+        **simulation)
+    yield worker.setup_worker()
+    transport.simulator.start()
+    yield task.deferLater(reactor, options.duration, lambda: None)
+    transport.simulator.stop()
+    summary = {
+        'simulator': transport.simulator.summary(),
+        'worker': worker.load_shedder.status(),
+    }
+    yield worker.teardown_worker()
+    stdout.write('%s\n' % (json.dumps(summary, indent=2, sort_keys=True),))
+
+
+def main(args=None, stdout=sys.stdout):
+    parser = argparse.ArgumentParser(
+        description="Run a vxtwinio worker against simulated callers")
+    parser.add_argument(
+        '--config',
+        help="YAML config for the worker. Fake Redis is used if it has no "
+             "redis_manager.")
+    parser.add_argument(
+        '--simulator', required=True,
+        help="YAML config for the simulated callers, with the same fields "
+             "as the SimulatedVoiceTransport config")
+    parser.add_argument(
+        '--duration', type=float, default=60,
+        help="Seconds to run the simulation for. Defaults to 60.")
+    options = parser.parse_args(args)
+    task.react(_run, [options, stdout])
+
+
+if __name__ == '__main__':
+    main()
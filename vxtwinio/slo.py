@@ -0,0 +1,137 @@
+from bisect import bisect_left
+from collections import OrderedDict
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class PromptWait(object):
+    """A caller waiting for the next prompt of a call"""
+
+    def __init__(self, account_sid, metric, started):
+        self.account_sid = account_sid
+        self.metric = metric
+        self.started = started
+        # Seconds of the wait spent fetching TwiML
+        self.fetch_time = 0.0
+
+
+class LatencyStats(object):
+    """How long callers of one account waited for one kind of prompt"""
+
+    def __init__(self):
+        self.count = 0
+        self.slow = 0
+        self.total = 0.0
+        self.fetch_total = 0.0
+        self.max = 0.0
+        # The count in each of BUCKETS, and then of waits longer than them
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds, fetch_seconds, threshold):
+        self.count += 1
+        if seconds > threshold:
+            self.slow += 1
+        self.total += seconds
+        self.fetch_total += fetch_seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket that the ``p`` percentile
+        falls in, or the longest wait if it is past the last bucket"""
+        rank = p * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self, threshold):
+        return {
+            'count': self.count,
+            'threshold': threshold,
+            'slow': self.slow,
+            'slow_fraction': (
+                float(self.slow) / self.count if self.count else 0.0),
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'max': self.max,
+            'twiml_fetch_share': (
+                self.fetch_total / self.total if self.total else 0.0),
+            'buckets': dict(
+                zip([str(bound) for bound in BUCKETS] + ['inf'],
+                    self.buckets)),
+        }
+
+
+class SLOTracker(object):
+    """Keeps count, for each account, of how long callers wait to hear a
+    prompt, against a latency objective for each kind of wait. Accounts
+    whose callers wait too long too often are flagged as slow, which is
+    usually down to a slow TwiML endpoint.
+
+    Only the most recently active accounts are kept, so that the tracker
+    can't grow without bound."""
+
+    def __init__(self, thresholds, slow_fraction=0.05, min_samples=20,
+                 max_accounts=1000):
+        """
+        :param dict thresholds: The names of the kinds of wait mapped to the
+            number of seconds that callers should wait at most
+        :param float slow_fraction: The share of waits that are longer than
+            their threshold at which an account is flagged as slow
+        :param int min_samples: The number of waits of a kind an account
+            needs before it can be flagged as slow
+        :param int max_accounts: The number of accounts to keep at most. The
+            account that has gone longest without a wait is dropped first.
+        """
+        self.thresholds = thresholds
+        self.slow_fraction = slow_fraction
+        self.min_samples = min_samples
+        self.max_accounts = max_accounts
+        # Account SIDs mapped to the LatencyStats of each kind of wait, least
+        # recently active first
+        self._accounts = OrderedDict()
+
+    def record(self, account_sid, metric, seconds, fetch_seconds=0.0):
+        """Counts a wait of ``seconds``, of which ``fetch_seconds`` were
+        spent fetching TwiML"""
+        stats = self._accounts.pop(account_sid, {})
+        self._accounts[account_sid] = stats
+        while len(self._accounts) > self.max_accounts:
+            self._accounts.popitem(last=False)
+        if metric not in stats:
+            stats[metric] = LatencyStats()
+        stats[metric].add(seconds, fetch_seconds, self.thresholds[metric])
+
+    def accounts(self):
+        return sorted(self._accounts)
+
+    def is_slow(self, account_sid):
+        for stats in self._accounts.get(account_sid, {}).itervalues():
+            if (stats.count >= self.min_samples and
+                    stats.slow > self.slow_fraction * stats.count):
+                return True
+        return False
+
+    def account(self, account_sid):
+        """Returns the latency of each kind of wait for an account, and
+        whether it is slow"""
+        stats = self._accounts.get(account_sid, {})
+        return {
+            'slow': self.is_slow(account_sid),
+            'metrics': dict(
+                (metric, stats.get(metric, LatencyStats()).summary(
+                    threshold))
+                for metric, threshold in self.thresholds.iteritems()),
+        }
+
+    def export(self):
+        """Returns the latencies of every account"""
+        return dict(
+            (account_sid, self.account(account_sid))
+            for account_sid in self._accounts)
@@ -0,0 +1,215 @@
+import time
+import treq
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import deferLater
+from twisted.trial.unittest import TestCase
+from vumi.application.tests.helpers import ApplicationHelper
+from vumi.tests.helpers import VumiTestCase
+
+from vxtwinio.admin import SamplingProfiler, object_counts
+from vxtwinio.twilio_api import TwilioAPIWorker
+
+
+def busy_loop(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        pass
+
+
+class TestSamplingProfiler(TestCase):
+    def setUp(self):
+        self.profiler = SamplingProfiler()
+        self.addCleanup(self.profiler.stop)
+
+    def test_profile(self):
+        """The stacks of the profiled thread are counted, outermost frame
+        first"""
+        self.profiler.start(10, interval=0.001)
+        busy_loop(0.1)
+        self.profiler.stop()
+        self.assertFalse(self.profiler.running)
+        self.assertTrue(self.profiler.samples > 0)
+        lines = self.profiler.folded().splitlines()
+        busy = [line for line in lines if 'busy_loop (test_admin.py' in line]
+        self.assertNotEqual(busy, [])
+        stack, count = busy[0].rsplit(' ', 1)
+        self.assertTrue(stack.split(';')[-1].startswith('busy_loop'))
+        self.assertEqual(
+            sum(int(line.rsplit(' ', 1)[1]) for line in lines),
+            self.profiler.samples)
+
+    def test_max_stacks(self):
+        """Samples past the maximum number of stacks are counted together"""
+        self.profiler.max_stacks = 0
+        self.profiler.sample()
+        self.assertEqual(self.profiler.folded(), '(other stacks) 1\n')
+
+    def test_already_running(self):
+        self.profiler.start(10)
+        self.assertRaises(RuntimeError, self.profiler.start, 10)
+
+    def test_restart(self):
+        """Starting a profile discards the samples of the last one"""
+        self.profiler.sample()
+        self.profiler.sample()
+        self.profiler.start(10, interval=10)
+        self.profiler.stop()
+        self.assertTrue(self.profiler.samples <= 1)
+
+
+class TestObjectCounts(TestCase):
+    def test_object_counts(self):
+        deferreds = [Deferred() for _ in range(3)]
+        counts = object_counts(limit=5)
+        self.assertTrue(counts['deferreds'] >= len(deferreds))
+        self.assertEqual(len(counts['top_types']), 5)
+        self.assertTrue(counts['objects'] >= counts['top_types'][0][1])
+
+
+class TestAdminServer(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.app_helper = self.add_helper(ApplicationHelper(TwilioAPIWorker))
+        self.worker = yield self.app_helper.get_application({
+            'web_path': '/api',
+            'web_port': 0,
+            'admin_port': 0,
+            'admin_max_profile_seconds': 60,
+            'client_path': 'http://localhost/',
+            'speech_cache_dir': self.mktemp(),
+            'call_queue_path': self.mktemp(),
+        })
+        addr = self.worker.admin_webserver.getHost()
+        self.url = 'http://%s:%s' % (addr.host, addr.port)
+
+    def request(self, path, method='GET', **kw):
+        return treq.request(
+            method, '%s/%s' % (self.url, path), persistent=False, **kw)
+
+    def test_local_only(self):
+        self.assertEqual(self.worker.admin_webserver.getHost().host,
+                         '127.0.0.1')
+
+    def test_separate_port(self):
+        self.assertNotEqual(
+            self.worker.admin_webserver.getHost().port,
+            self.worker.webserver.getHost().port)
+
+    @inlineCallbacks
+    def test_profile(self):
+        response = yield self.request(
+            'profile', 'POST', params={'seconds': 10, 'interval': 0.001})
+        self.assertEqual(response.code, 202)
+        status = yield response.json()
+        self.assertEqual(status['running'], True)
+        self.assertEqual(status['seconds'], 10)
+
+        response = yield self.request('profile', 'POST')
+        self.assertEqual(response.code, 409)
+        yield response.content()
+
+        yield deferLater(reactor, 0.05, lambda: None)
+        response = yield self.request('profile', 'DELETE')
+        status = yield response.json()
+        self.assertEqual(status['running'], False)
+        self.assertTrue(status['samples'] > 0)
+
+        response = yield self.request('profile')
+        self.assertEqual(
+            response.headers.getRawHeaders('Content-Type'), ['text/plain'])
+        self.assertEqual(
+            response.headers.getRawHeaders('X-Profile-Samples'),
+            [str(status['samples'])])
+        folded = yield response.content()
+        self.assertEqual(
+            sum(int(line.rsplit(' ', 1)[1])
+                for line in folded.splitlines()),
+            status['samples'])
+
+    @inlineCallbacks
+    def test_profile_too_long(self):
+        response = yield self.request(
+            'profile', 'POST', params={'seconds': 61})
+        self.assertEqual(response.code, 400)
+        error = yield response.json()
+        self.assertIn('at most 60', error['error'])
+        self.assertFalse(self.worker.admin_server.profiler.running)
+
+    @inlineCallbacks
+    def test_profile_invalid(self):
+        response = yield self.request(
+            'profile', 'POST', params={'seconds': 'soon'})
+        self.assertEqual(response.code, 400)
+        yield response.content()
+
+    @inlineCallbacks
+    def test_memory(self):
+        self.worker._live_sessions['session1'] = 'CA1'
+        response = yield self.request('memory', params={'limit': 3})
+        self.assertEqual(response.code, 200)
+        memory = yield response.json()
+        self.assertEqual(memory['live_sessions'], 1)
+        self.assertEqual(memory['in_flight'], 0)
+        self.assertEqual(memory['caches'], {
+            'config': 0, 'applications': 0, 'redirects': 0, 'media': 0})
+        self.assertEqual(len(memory['top_types']), 3)
+        self.assertTrue(memory['deferreds'] > 0)
+        self.assertTrue(memory['max_rss_kb'] > 0)
+
+    @inlineCallbacks
+    def test_invalidate_config_cache(self):
+        cache = self.worker.config_cache
+        for to_addr in ('+12345', '+54321'):
+            msg = self.app_helper.make_inbound(None, to_addr=to_addr)
+            yield self.worker.get_config(msg)
+        self.assertEqual(len(cache), 2)
+
+        response = yield self.request('config-cache', 'DELETE', params={
+            'transport_name': msg['transport_name'], 'to_addr': '+12345'})
+        self.assertEqual(response.code, 200)
+        result = yield response.json()
+        self.assertEqual(result, {'invalidated': 1})
+        self.assertEqual(len(cache), 1)
+
+        response = yield self.request('config-cache', 'DELETE')
+        result = yield response.json()
+        self.assertEqual(result, {'invalidated': 1})
+        self.assertEqual(len(cache), 0)
+
+    @inlineCallbacks
+    def test_invalidate_config_cache_invalid(self):
+        response = yield self.request(
+            'config-cache', 'DELETE', params={'to_addr': '+12345'})
+        self.assertEqual(response.code, 400)
+        yield response.content()
+
+    @inlineCallbacks
+    def test_limits(self):
+        response = yield self.request(
+            'limits/live_sessions', 'PUT', params={'maximum': 10})
+        self.assertEqual(response.code, 200)
+        limit = yield response.json()
+        self.assertEqual(limit, {
+            'in_use': 0, 'limit': 10, 'utilisation': 0.0})
+
+        response = yield self.request('limits')
+        status = yield response.json()
+        self.assertEqual(status['limits']['live_sessions']['limit'], 10)
+        self.assertEqual(status['overloaded'], False)
+
+    @inlineCallbacks
+    def test_limits_invalid(self):
+        response = yield self.request(
+            'limits/live_sessions', 'PUT', params={'maximum': 'lots'})
+        self.assertEqual(response.code, 400)
+        yield response.content()
+        response = yield self.request(
+            'limits/live_sessions', 'PUT', params={'maximum': -1})
+        self.assertEqual(response.code, 400)
+        yield response.content()
+        response = yield self.request(
+            'limits/unknown', 'PUT', params={'maximum': 1})
+        self.assertEqual(response.code, 404)
+        yield response.content()
@@ -0,0 +1,74 @@
+from twisted.internet.defer import inlineCallbacks
+from vumi.tests.helpers import PersistenceHelper, VumiTestCase
+
+from vxtwinio.applications import ApplicationStore
+
+
+class TestApplicationStore(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.store = ApplicationStore(self.redis, max_cached=2)
+
+    @inlineCallbacks
+    def test_save_and_load(self):
+        version = yield self.store.get_version('AC1')
+        self.assertEqual(version, None)
+
+        yield self.store.save('AC1', {'Sid': 'AP1', 'FriendlyName': 'one'})
+        yield self.store.save('AC1', {'Sid': 'AP2', 'FriendlyName': 'two'})
+        yield self.store.save('AC2', {'Sid': 'AP3', 'FriendlyName': 'three'})
+        version = yield self.store.get_version('AC1')
+        self.assertEqual(version, '2')
+
+        applications = yield self.store.list('AC1')
+        self.assertEqual(
+            sorted(a['Sid'] for a in applications), ['AP1', 'AP2'])
+        application = yield self.store.get('AC1', 'AP2')
+        self.assertEqual(application, {'Sid': 'AP2', 'FriendlyName': 'two'})
+        application = yield self.store.get('AC1', 'AP3')
+        self.assertEqual(application, None)
+
+    @inlineCallbacks
+    def test_delete(self):
+        yield self.store.save('AC1', {'Sid': 'AP1'})
+        deleted = yield self.store.delete('AC1', 'AP1')
+        self.assertTrue(deleted)
+        applications = yield self.store.list('AC1')
+        self.assertEqual(applications, [])
+        version = yield self.store.get_version('AC1')
+        self.assertEqual(version, '2')
+
+        deleted = yield self.store.delete('AC1', 'AP1')
+        self.assertFalse(deleted)
+        version = yield self.store.get_version('AC1')
+        self.assertEqual(version, '2')
+
+    def test_cache_version(self):
+        """Cached bodies are only returned for the version they were made
+        from"""
+        etag = self.store.set_cached('AC1', '/uri', '1', 'body')
+        self.assertEqual(
+            self.store.get_cached('AC1', '/uri', '1'), ('body', etag))
+        self.assertEqual(self.store.get_cached('AC1', '/uri', '2'), None)
+        self.assertEqual(self.store.get_cached('AC1', '/other', '1'), None)
+
+    @inlineCallbacks
+    def test_cache_invalidated(self):
+        """Changes drop the cached bodies for the account"""
+        self.store.set_cached('AC1', '/uri', '1', 'body')
+        self.store.set_cached('AC2', '/uri', '1', 'body')
+        yield self.store.save('AC1', {'Sid': 'AP1'})
+        self.assertEqual(self.store.get_cached('AC1', '/uri', '1'), None)
+        self.assertNotEqual(self.store.get_cached('AC2', '/uri', '1'), None)
+
+    def test_cache_size(self):
+        """The least recently used bodies are dropped first"""
+        self.store.set_cached('AC1', '/1', '1', 'one')
+        self.store.set_cached('AC1', '/2', '1', 'two')
+        self.store.get_cached('AC1', '/1', '1')
+        self.store.set_cached('AC1', '/3', '1', 'three')
+        self.assertNotEqual(self.store.get_cached('AC1', '/1', '1'), None)
+        self.assertEqual(self.store.get_cached('AC1', '/2', '1'), None)
+        self.assertNotEqual(self.store.get_cached('AC1', '/3', '1'), None)
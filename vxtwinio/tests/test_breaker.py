@@ -0,0 +1,119 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.breaker import CircuitBreaker, CircuitBreakers
+
+
+class TestCircuitBreaker(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = CircuitBreaker(
+            'example.com', window=4, min_requests=4, error_rate=0.5,
+            slow_seconds=2, reset_timeout=30, clock=self.clock)
+
+    def fail_requests(self, count):
+        for _ in range(count):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(False, 0.1)
+
+    def test_opens(self):
+        """The breaker opens once enough of the recent requests fail"""
+        self.breaker.record(True, 0.1)
+        self.fail_requests(1)
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.fail_requests(1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.short_circuited, 1)
+        self.assertEqual(self.breaker.opened, 1)
+
+    def test_min_requests(self):
+        self.fail_requests(3)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_window(self):
+        """Only the most recent requests are counted"""
+        self.fail_requests(1)
+        for _ in range(4):
+            self.breaker.record(True, 0.1)
+        self.fail_requests(1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.status()['failures'], 1)
+
+    def test_slow(self):
+        """Slow requests count as failed"""
+        for _ in range(4):
+            self.breaker.record(True, 2.5)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.status()['mean_latency'], 2.5)
+
+    def test_probe_recovers(self):
+        """One request is let through once the reset timeout has passed,
+        and the breaker closes if it succeeds"""
+        self.fail_requests(4)
+        self.clock.advance(29)
+        self.assertFalse(self.breaker.allow())
+        self.clock.advance(1)
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.status()['requests'], 0)
+        self.assertTrue(self.breaker.allow())
+
+    def test_probe_fails(self):
+        """The breaker opens again if the probe fails"""
+        self.fail_requests(4)
+        self.clock.advance(30)
+        self.fail_requests(1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.opened, 2)
+        self.clock.advance(29)
+        self.assertFalse(self.breaker.allow())
+        self.clock.advance(1)
+        self.assertTrue(self.breaker.allow())
+
+    def test_status(self):
+        self.breaker.record(True, 0.5)
+        self.breaker.record(False, 1.5)
+        self.assertEqual(self.breaker.status(), {
+            'state': 'closed',
+            'requests': 2,
+            'failures': 1,
+            'error_rate': 0.5,
+            'mean_latency': 1.0,
+            'opened': 0,
+            'short_circuited': 0,
+        })
+
+
+class TestCircuitBreakers(TestCase):
+    def test_per_host(self):
+        breakers = CircuitBreakers(min_requests=1)
+        breaker = breakers.get('http://example.com/a.xml')
+        self.assertEqual(breaker.host, 'example.com')
+        self.assertEqual(breaker.min_requests, 1)
+        self.assertIs(breakers.get('http://example.com/b.xml'), breaker)
+        self.assertIsNot(breakers.get('http://example.org:8080/'), breaker)
+        self.assertEqual(breakers.hosts(), ['example.com', 'example.org:8080'])
+
+    def test_max_hosts(self):
+        """The breakers of the hosts least recently requested from are
+        dropped first"""
+        breakers = CircuitBreakers(max_hosts=2)
+        breakers.get('http://a/')
+        breakers.get('http://b/')
+        breakers.get('http://a/')
+        breakers.get('http://c/')
+        self.assertEqual(breakers.hosts(), ['a', 'c'])
+
+    def test_counts(self):
+        breakers = CircuitBreakers(min_requests=1)
+        breakers.get('http://a/')
+        breaker = breakers.get('http://b/')
+        breaker.record(False, 0.1)
+        breaker.allow()
+        self.assertEqual(breakers.counts(), {
+            'closed': 1, 'open': 1, 'half_open': 0, 'short_circuited': 1})
@@ -0,0 +1,156 @@
+import json
+import os
+
+from mock import patch
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.call_queue import DurableQueue
+
+
+class TestDurableQueue(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.path = os.path.join(self.mktemp(), 'calls.log')
+        self.queue = self.make_queue()
+
+    def make_queue(self, **kw):
+        queue = DurableQueue(self.path, clock=self.clock, **kw)
+        queue.open()
+        self.addCleanup(queue.close)
+        return queue
+
+    def read_journal(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_put(self):
+        """Items are only queued once they are on disk"""
+        d = self.queue.put('CA1', {'To': '+1'})
+        self.assertNoResult(d)
+        self.assertEqual(len(self.queue), 0)
+        self.clock.advance(0)
+        self.successResultOf(d)
+        self.assertEqual(self.queue.get('CA1'), {'To': '+1'})
+        self.assertEqual(
+            self.read_journal(), [{'put': 'CA1', 'item': {'To': '+1'}}])
+
+    def test_pending(self):
+        for i in range(3):
+            self.queue.put('CA%s' % i, {'i': i})
+        self.clock.advance(0)
+        self.assertEqual(
+            self.queue.pending(), [('CA0', {'i': 0}), ('CA1', {'i': 1}),
+                                   ('CA2', {'i': 2})])
+        self.assertEqual(
+            self.queue.pending(2), [('CA0', {'i': 0}), ('CA1', {'i': 1})])
+
+    def test_group_commit(self):
+        """Writes made together share a single sync"""
+        with patch('os.fsync') as fsync:
+            ds = [self.queue.put('CA%s' % i, {}) for i in range(10)]
+            self.clock.advance(0)
+        self.assertEqual(fsync.call_count, 1)
+        for d in ds:
+            self.successResultOf(d)
+        self.assertEqual(len(self.read_journal()), 10)
+
+    def test_reopen(self):
+        """Items that weren't acknowledged are loaded again"""
+        self.queue.put('CA1', {'To': '+1'})
+        self.queue.put('CA2', {'To': '+2'})
+        self.clock.advance(0)
+        d = self.queue.ack(['CA1'])
+        self.clock.advance(0)
+        self.successResultOf(d)
+        self.queue.close()
+
+        queue = self.make_queue()
+        self.assertEqual(queue.pending(), [('CA2', {'To': '+2'})])
+
+    def test_reopen_partial_write(self):
+        """A record that was cut short by a crash is ignored"""
+        self.queue.put('CA1', {'To': '+1'})
+        self.clock.advance(0)
+        self.queue.close()
+        with open(self.path, 'a') as f:
+            f.write('{"put":"CA2","ite')
+
+        queue = self.make_queue()
+        self.assertEqual(queue.pending(), [('CA1', {'To': '+1'})])
+
+    def test_truncate(self):
+        """The journal is emptied once every item is acknowledged"""
+        self.queue.put('CA1', {})
+        self.clock.advance(0)
+        self.queue.ack(['CA1'])
+        self.clock.advance(0)
+        self.assertEqual(self.read_journal(), [])
+
+        self.queue.put('CA2', {})
+        self.clock.advance(0)
+        self.assertEqual(self.read_journal(), [{'put': 'CA2', 'item': {}}])
+
+    def test_compact(self):
+        """The journal is compacted once it is large and mostly made up of
+        acknowledged items"""
+        self.queue.close()
+        queue = self.make_queue(compact_after=4)
+        queue.put('CA1', {'To': '+1'})
+        queue.put('CA2', {'To': '+2'})
+        queue.put('CA3', {'To': '+3'})
+        self.clock.advance(0)
+        queue.ack(['CA1'])
+        self.clock.advance(0)
+        # The journal isn't over the limit yet
+        self.assertEqual(len(self.read_journal()), 4)
+
+        queue.ack(['CA2'])
+        self.clock.advance(0)
+        self.assertEqual(
+            self.read_journal(), [{'put': 'CA3', 'item': {'To': '+3'}}])
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+        # Writes after compaction go to the new journal
+        queue.put('CA4', {'To': '+4'})
+        self.clock.advance(0)
+        self.assertEqual(self.read_journal(), [
+            {'put': 'CA3', 'item': {'To': '+3'}},
+            {'put': 'CA4', 'item': {'To': '+4'}},
+        ])
+        queue.close()
+        queue = self.make_queue()
+        self.assertEqual(
+            queue.pending(),
+            [('CA3', {'To': '+3'}), ('CA4', {'To': '+4'})])
+
+    def test_compact_on_open(self):
+        """A large journal left by an earlier run is compacted when it is
+        opened"""
+        self.queue.put('CA1', {})
+        self.queue.put('CA2', {})
+        self.clock.advance(0)
+        self.queue.ack(['CA1'])
+        self.clock.advance(0)
+        self.queue.close()
+
+        queue = self.make_queue(compact_after=2)
+        self.assertEqual(queue.pending(), [('CA2', {})])
+        self.assertEqual(self.read_journal(), [{'put': 'CA2', 'item': {}}])
+
+    def test_compact_disabled(self):
+        """The journal isn't compacted if compact_after is 0"""
+        self.queue.close()
+        queue = self.make_queue(compact_after=0)
+        queue.put('CA1', {})
+        queue.put('CA2', {})
+        self.clock.advance(0)
+        queue.ack(['CA1'])
+        self.clock.advance(0)
+        self.assertEqual(len(self.read_journal()), 3)
+
+    def test_close_syncs(self):
+        d = self.queue.put('CA1', {})
+        self.queue.close()
+        self.successResultOf(d)
+        self.assertEqual(self.read_journal(), [{'put': 'CA1', 'item': {}}])
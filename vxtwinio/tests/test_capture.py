@@ -0,0 +1,90 @@
+import gzip
+import json
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from vumi.message import TransportEvent, TransportUserMessage
+
+from vxtwinio.capture import CaptureWriter, read_capture
+
+
+class TestCaptureWriter(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(100)
+        self.path = self.mktemp()
+        self.capture = CaptureWriter(self.path, clock=self.clock)
+        self.capture.open()
+        self.addCleanup(self.capture.close)
+
+    def make_message(self):
+        return TransportUserMessage(
+            to_addr='+12345', from_addr='+54321', transport_name='voice',
+            transport_type='voice',
+            session_event=TransportUserMessage.SESSION_NEW)
+
+    def test_records(self):
+        """Each record has its type and the time since the capture
+        started"""
+        message = self.make_message()
+        self.clock.advance(1.5)
+        self.capture.inbound(message)
+        self.capture.call({'To': '+54321'})
+        self.capture.close()
+
+        [inbound, call] = list(read_capture(self.path))
+        self.assertEqual(inbound, {
+            'type': 'inbound', 't': 1.5, 'message': message.payload})
+        self.assertEqual(
+            call, {'type': 'call', 't': 1.5, 'fields': {'To': '+54321'}})
+        self.assertEqual(self.capture.records, 2)
+
+    def test_messages_round_trip(self):
+        """Captured messages can be turned back into messages"""
+        message = self.make_message()
+        event = TransportEvent(
+            event_type='ack', user_message_id=message['message_id'],
+            sent_message_id='abc', transport_name='voice')
+        self.capture.outbound(message)
+        self.capture.event(event)
+        self.capture.close()
+
+        [outbound, captured_event] = list(read_capture(self.path))
+        self.assertEqual(
+            TransportUserMessage(**outbound['message']), message)
+        self.assertEqual(TransportEvent(**captured_event['event']), event)
+
+    def test_twiml(self):
+        self.capture.twiml(
+            'http://example.com/', 'POST', 200, '<Response>\xc3\xa9',
+            0.25)
+        self.capture.close()
+
+        [record] = list(read_capture(self.path))
+        self.assertEqual(record, {
+            'type': 'twiml',
+            't': 0,
+            'url': 'http://example.com/',
+            'method': 'POST',
+            'code': 200,
+            'body': u'<Response>\xe9',
+            'elapsed': 0.25,
+        })
+
+    def test_compressed(self):
+        """Captures are gzipped JSON lines"""
+        self.capture.call({'To': '+54321'})
+        self.capture.close()
+        with gzip.open(self.path) as f:
+            [line] = f.readlines()
+        self.assertNotIn(' ', line)
+        self.assertEqual(
+            json.loads(line),
+            {'type': 'call', 't': 0, 'fields': {'To': '+54321'}})
+
+    def test_closed(self):
+        """Nothing is written once the capture is closed"""
+        self.capture.close()
+        self.capture.call({'To': '+54321'})
+        self.assertEqual(list(read_capture(self.path)), [])
+        self.assertEqual(self.capture.records, 0)
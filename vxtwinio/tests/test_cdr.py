@@ -0,0 +1,90 @@
+import json
+import os
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.cdr import CDRWriter, call_duration, make_cdr
+
+
+class TestMakeCDR(TestCase):
+    def test_make_cdr(self):
+        cdr = make_cdr({
+            'CallId': 'CA1',
+            'AccountSid': 'AC1',
+            'From': '+12345',
+            'To': '+54321',
+            'Direction': 'outbound-api',
+            'Status': 'completed',
+            'StartTime': '10.0',
+            'AnswerTime': '12.5',
+            'EndTime': '20.0',
+            'Url': 'http://example.com',
+        })
+        self.assertEqual(cdr, {
+            'CallSid': 'CA1',
+            'AccountSid': 'AC1',
+            'From': '+12345',
+            'To': '+54321',
+            'Direction': 'outbound-api',
+            'Status': 'completed',
+            'StartTime': 10.0,
+            'AnswerTime': 12.5,
+            'EndTime': 20.0,
+            'Duration': 8,
+        })
+
+    def test_call_duration_unanswered(self):
+        """Calls that were never answered have no duration"""
+        self.assertEqual(call_duration({'StartTime': 1, 'EndTime': 5}), 0)
+        self.assertEqual(
+            call_duration({'AnswerTime': 'None', 'EndTime': 5}), 0)
+
+
+class TestCDRWriter(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.path = os.path.join(self.mktemp(), 'cdrs.log')
+
+    def get_writer(self, **kw):
+        writer = CDRWriter(self.path, clock=self.clock, **kw)
+        writer.start()
+        self.addCleanup(writer.stop)
+        return writer
+
+    def read_records(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_flush_interval(self):
+        """Records are only written once the flush interval has passed"""
+        writer = self.get_writer(flush_interval=5)
+        writer.write({'CallSid': 'CA1'})
+        writer.write({'CallSid': 'CA2'})
+        self.assertEqual(len(writer), 2)
+        self.assertEqual(self.read_records(), [])
+        self.clock.advance(5)
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(
+            self.read_records(), [{'CallSid': 'CA1'}, {'CallSid': 'CA2'}])
+
+    def test_batch_size(self):
+        """Records are written straight away once a batch is full"""
+        writer = self.get_writer(batch_size=2)
+        writer.write({'CallSid': 'CA1'})
+        self.assertEqual(self.read_records(), [])
+        writer.write({'CallSid': 'CA2'})
+        self.assertEqual(
+            self.read_records(), [{'CallSid': 'CA1'}, {'CallSid': 'CA2'}])
+
+    def test_stop(self):
+        """Waiting records are written when the writer stops, and later
+        writers append to the same log"""
+        writer = self.get_writer()
+        writer.write({'CallSid': 'CA1'})
+        writer.stop()
+        writer = self.get_writer()
+        writer.write({'CallSid': 'CA2'})
+        writer.stop()
+        self.assertEqual(
+            self.read_records(), [{'CallSid': 'CA1'}, {'CallSid': 'CA2'}])
@@ -0,0 +1,102 @@
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.config_cache import ConfigCache
+
+
+class TestConfigCache(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.built = []
+        self.cache = ConfigCache(
+            self.build, 60, max_entries=2, clock=self.clock)
+
+    def build(self, msg):
+        self.built.append(msg)
+        return succeed({'msg': msg})
+
+    def test_get(self):
+        config = self.successResultOf(self.cache.get('a', 'msg1'))
+        self.assertEqual(config, {'msg': 'msg1'})
+        config = self.successResultOf(self.cache.get('a', 'msg2'))
+        self.assertEqual(config, {'msg': 'msg1'})
+        config = self.successResultOf(self.cache.get('b', 'msg3'))
+        self.assertEqual(config, {'msg': 'msg3'})
+        self.assertEqual(self.built, ['msg1', 'msg3'])
+        self.assertEqual(self.cache.stats(), {
+            'entries': 2,
+            'hits': 1,
+            'builds': 2,
+            'expired': 0,
+            'invalidated': 0,
+        })
+
+    def test_ttl(self):
+        self.cache.get('a', 'msg1')
+        self.clock.advance(59)
+        self.cache.get('a', 'msg2')
+        self.clock.advance(1)
+        config = self.successResultOf(self.cache.get('a', 'msg3'))
+        self.assertEqual(config, {'msg': 'msg3'})
+        self.assertEqual(self.cache.expired, 1)
+
+    def test_no_ttl(self):
+        """Nothing is cached if the TTL is 0"""
+        self.cache.ttl = 0
+        self.cache.get('a', 'msg1')
+        self.cache.get('a', 'msg2')
+        self.assertEqual(self.built, ['msg1', 'msg2'])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_max_entries(self):
+        """The least recently used configs are dropped first"""
+        self.cache.get('a', 'msg1')
+        self.cache.get('b', 'msg2')
+        self.cache.get('a', 'msg3')
+        self.cache.get('c', 'msg4')
+        self.cache.get('a', 'msg5')
+        self.cache.get('b', 'msg6')
+        self.assertEqual(self.built, ['msg1', 'msg2', 'msg4', 'msg6'])
+
+    def test_concurrent_builds(self):
+        """Requests for a config that is being built wait for that build"""
+        build = Deferred()
+        self.cache.build = lambda msg: build
+        d1 = self.cache.get('a', 'msg1')
+        d2 = self.cache.get('a', 'msg2')
+        build.callback({'msg': 'msg1'})
+        self.assertEqual(self.successResultOf(d1), {'msg': 'msg1'})
+        self.assertEqual(self.successResultOf(d2), {'msg': 'msg1'})
+        self.assertEqual(self.cache.builds, 1)
+
+    def test_build_failure(self):
+        """Configs that fail to build aren't cached"""
+        self.cache.build = lambda msg: fail(ValueError('bad config'))
+        self.failureResultOf(self.cache.get('a', 'msg1'), ValueError)
+        self.assertEqual(len(self.cache), 0)
+        self.cache.build = self.build
+        self.successResultOf(self.cache.get('a', 'msg2'))
+        self.assertEqual(self.built, ['msg2'])
+
+    def test_build_error(self):
+        """A build that raises is treated like one that fails"""
+        def build(msg):
+            raise ValueError('bad config')
+        self.cache.build = build
+        self.failureResultOf(self.cache.get('a', 'msg1'), ValueError)
+        self.cache.build = self.build
+        config = self.successResultOf(self.cache.get('a', 'msg2'))
+        self.assertEqual(config, {'msg': 'msg2'})
+
+    def test_invalidate(self):
+        self.cache.get('a', 'msg1')
+        self.cache.get('b', 'msg2')
+        self.assertEqual(self.cache.invalidate('a'), 1)
+        self.assertEqual(self.cache.invalidate('a'), 0)
+        self.cache.get('a', 'msg3')
+        self.assertEqual(self.built, ['msg1', 'msg2', 'msg3'])
+
+        self.assertEqual(self.cache.invalidate(), 2)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.invalidated, 3)
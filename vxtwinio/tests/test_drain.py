@@ -0,0 +1,53 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.drain import InFlightTracker
+
+
+class TestInFlightTracker(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.tracker = InFlightTracker(clock=self.clock)
+
+    def test_track(self):
+        d = Deferred()
+        self.assertIdentical(self.tracker.track(d, 'session'), d)
+        self.assertEqual(len(self.tracker), 1)
+        self.assertEqual(self.tracker.subjects(), ['session'])
+        d.callback('result')
+        self.assertEqual(len(self.tracker), 0)
+        self.assertEqual(self.successResultOf(d), 'result')
+
+    def test_track_failure(self):
+        """Failures are passed on to whoever is waiting for the work"""
+        d = self.tracker.track(Deferred())
+        d.errback(ValueError('failed'))
+        self.assertEqual(len(self.tracker), 0)
+        self.failureResultOf(d, ValueError)
+
+    def test_track_fired(self):
+        self.tracker.track(succeed(None))
+        self.assertEqual(len(self.tracker), 0)
+
+    def test_wait(self):
+        self.assertTrue(self.successResultOf(self.tracker.wait(10)))
+
+        d1 = self.tracker.track(Deferred())
+        d2 = self.tracker.track(Deferred())
+        wait = self.tracker.wait(10)
+        d1.callback(None)
+        self.assertNoResult(wait)
+        d2.callback(None)
+        self.assertTrue(self.successResultOf(wait))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_wait_timeout(self):
+        d = self.tracker.track(Deferred(), 'session')
+        wait = self.tracker.wait(10)
+        self.clock.advance(9)
+        self.assertNoResult(wait)
+        self.clock.advance(1)
+        self.assertFalse(self.successResultOf(wait))
+        self.assertEqual(self.tracker.subjects(), ['session'])
+        d.callback(None)
@@ -0,0 +1,72 @@
+import gzip
+from StringIO import StringIO
+import zlib
+
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.encoding import (
+    CompressionStats, compress, negotiate_encoding, negotiate_format,
+    parse_accept)
+
+
+class TestNegotiation(TestCase):
+    def test_parse_accept(self):
+        self.assertEqual(
+            parse_accept('gzip;q=0.5, Deflate, br;q=foo'),
+            {'gzip': 0.5, 'deflate': 1.0, 'br': 0.0})
+        self.assertEqual(parse_accept(None), {})
+
+    def test_negotiate_format(self):
+        self.assertEqual(negotiate_format('application/json'), 'json')
+        self.assertEqual(negotiate_format('text/xml'), 'xml')
+        self.assertEqual(
+            negotiate_format('application/xml;q=0.5, application/json'),
+            'json')
+        self.assertEqual(
+            negotiate_format('application/xml, application/json;q=0.9'),
+            'xml')
+
+    def test_negotiate_format_default(self):
+        """Requests that don't ask for a supported format get the default"""
+        self.assertEqual(negotiate_format(None), 'xml')
+        self.assertEqual(negotiate_format('*/*'), 'xml')
+        self.assertEqual(negotiate_format('text/html', default='json'), 'json')
+
+    def test_negotiate_encoding(self):
+        self.assertEqual(negotiate_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(negotiate_encoding('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(negotiate_encoding('*'), 'gzip')
+        self.assertEqual(negotiate_encoding('*, gzip;q=0'), 'deflate')
+        self.assertEqual(negotiate_encoding('br'), None)
+        self.assertEqual(negotiate_encoding(None), None)
+
+
+class TestCompress(TestCase):
+    def test_gzip(self):
+        data = 'a' * 1000
+        compressed = compress(data, 'gzip')
+        self.assertTrue(len(compressed) < len(data))
+        f = gzip.GzipFile(fileobj=StringIO(compressed))
+        self.assertEqual(f.read(), data)
+
+    def test_deflate(self):
+        data = 'a' * 1000
+        self.assertEqual(zlib.decompress(compress(data, 'deflate')), data)
+
+
+class TestCompressionStats(TestCase):
+    def test_record(self):
+        stats = CompressionStats()
+        stats.record('/a', 100, 40)
+        stats.record('/a', 10)
+        stats.record('/b', 10)
+        self.assertEqual(stats.bytes_saved('/a'), 60)
+        self.assertEqual(stats.bytes_saved('/c'), 0)
+        self.assertEqual(stats.summary(), {
+            '/a': {
+                'responses': 2, 'compressed': 1, 'bytes_in': 110,
+                'bytes_out': 50, 'bytes_saved': 60},
+            '/b': {
+                'responses': 1, 'compressed': 0, 'bytes_in': 10,
+                'bytes_out': 10, 'bytes_saved': 0},
+        })
@@ -0,0 +1,54 @@
+from twisted.internet.defer import inlineCallbacks
+from vumi.tests.helpers import PersistenceHelper, VumiTestCase
+
+from vxtwinio.idempotency import IdempotencyStore, fingerprint
+
+
+class TestFingerprint(VumiTestCase):
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint({'To': '+1', 'From': '+2'}),
+            fingerprint({'From': '+2', 'To': '+1'}))
+        self.assertNotEqual(
+            fingerprint({'To': '+1', 'From': '+2'}),
+            fingerprint({'To': '+1', 'From': '+3'}))
+
+
+class TestIdempotencyStore(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.store = IdempotencyStore(self.redis, 60)
+
+    @inlineCallbacks
+    def test_claim(self):
+        record = yield self.store.claim('AC1', 'key', 'abc')
+        self.assertEqual(record, None)
+        ttl = yield self.redis.ttl('idempotency:AC1:key')
+        self.assertEqual(ttl, 60)
+
+        # Only the first request gets the key
+        record = yield self.store.claim('AC1', 'key', 'abc')
+        self.assertEqual(record, {'fingerprint': 'abc'})
+
+        # Keys belong to an account
+        record = yield self.store.claim('AC2', 'key', 'abc')
+        self.assertEqual(record, None)
+
+    @inlineCallbacks
+    def test_complete(self):
+        yield self.store.claim('AC1', 'key', 'abc')
+        yield self.store.complete('AC1', 'key', 'abc', {'code': 200})
+        record = yield self.store.claim('AC1', 'key', 'def')
+        self.assertEqual(
+            record, {'fingerprint': 'abc', 'result': {'code': 200}})
+        ttl = yield self.redis.ttl('idempotency:AC1:key')
+        self.assertEqual(ttl, 60)
+
+    @inlineCallbacks
+    def test_release(self):
+        yield self.store.claim('AC1', 'key', 'abc')
+        yield self.store.release('AC1', 'key')
+        record = yield self.store.claim('AC1', 'key', 'abc')
+        self.assertEqual(record, None)
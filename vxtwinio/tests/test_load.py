@@ -0,0 +1,60 @@
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.load import LoadShedder
+
+
+class TestLoadShedder(TestCase):
+    def setUp(self):
+        self.usage = {'fetches': 0, 'sessions': 0}
+        self.shedder = LoadShedder()
+        self.shedder.add_limit('fetches', 2, lambda: self.usage['fetches'])
+        self.shedder.add_limit('sessions', 0, lambda: self.usage['sessions'])
+
+    def test_exceeded(self):
+        self.assertEqual(self.shedder.exceeded(), None)
+        self.usage['fetches'] = 2
+        self.assertEqual(self.shedder.exceeded(), 'fetches')
+
+    def test_no_limit(self):
+        """Limits with a maximum of 0 are never reached"""
+        self.usage['sessions'] = 1000
+        self.assertEqual(self.shedder.exceeded(), None)
+
+    def test_set_maximum(self):
+        self.usage['sessions'] = 1
+        self.shedder.set_maximum('sessions', 1)
+        self.assertEqual(self.shedder.exceeded(), 'sessions')
+
+    def test_not_accepting(self):
+        self.shedder.accepting = False
+        self.assertEqual(self.shedder.exceeded(), 'draining')
+        self.assertFalse(self.shedder.admit('inbound'))
+        self.assertTrue(self.shedder.status()['overloaded'])
+
+    def test_admit(self):
+        self.assertTrue(self.shedder.admit('inbound'))
+        self.usage['fetches'] = 3
+        self.assertFalse(self.shedder.admit('inbound'))
+        self.assertFalse(self.shedder.admit('inbound'))
+        self.assertFalse(self.shedder.admit('make_call'))
+        self.assertEqual(
+            self.shedder.rejected, {'inbound': 2, 'make_call': 1})
+
+    def test_status(self):
+        self.usage['fetches'] = 1
+        self.usage['sessions'] = 5
+        self.shedder.admit('inbound')
+        self.assertEqual(self.shedder.status(), {
+            'accepting': True,
+            'overloaded': False,
+            'limits': {
+                'fetches': {'in_use': 1, 'limit': 2, 'utilisation': 0.5},
+                'sessions': {'in_use': 5, 'limit': 0, 'utilisation': 0.0},
+            },
+            'rejected': {},
+        })
+        self.usage['fetches'] = 2
+        self.shedder.admit('inbound')
+        status = self.shedder.status()
+        self.assertTrue(status['overloaded'])
+        self.assertEqual(status['rejected'], {'inbound': 1})
@@ -0,0 +1,190 @@
+import os
+
+import treq
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.web.server import Site
+from vumi.tests.helpers import VumiTestCase
+
+from .helpers import TwiMLServer
+from vxtwinio.media_cache import MediaCache
+
+
+class TestMediaCache(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.media_server = yield self.add_helper(TwiMLServer())
+        self.directory = self.mktemp()
+
+    def get_cache(self, **kw):
+        return MediaCache(self.directory, 'http://example.com/media/', **kw)
+
+    def add_media(self, filename, data):
+        self.media_server.add_response(filename, data)
+        return '%s%s' % (self.media_server.url, filename)
+
+    @inlineCallbacks
+    def test_get_url_fetches_once(self):
+        """Media is only fetched once, and served from the cache after"""
+        url = self.add_media('prompt.wav', 'audio')
+        cache = self.get_cache()
+        d1 = cache.get_url(url)
+        d2 = cache.get_url(url)
+        local_url1 = yield d1
+        local_url2 = yield d2
+        local_url3 = yield cache.get_url(url)
+        self.assertEqual(local_url1, local_url2)
+        self.assertEqual(local_url1, local_url3)
+        self.assertTrue(local_url1.startswith('http://example.com/media/'))
+        self.assertTrue(local_url1.endswith('.wav'))
+        self.assertEqual(len(self.media_server.requests), 1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.total_bytes, 5)
+
+        [filename] = os.listdir(self.directory)
+        with open(os.path.join(self.directory, filename)) as f:
+            self.assertEqual(f.read(), 'audio')
+
+    @inlineCallbacks
+    def test_get_url_fetch_error(self):
+        """The original URL is used if the media can't be fetched"""
+        self.media_server.add_err('missing.wav', 'Not found')
+        url = '%smissing.wav' % self.media_server.url
+        cache = self.get_cache()
+        result = yield cache.get_url(url)
+        self.assertEqual(result, url)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    @inlineCallbacks
+    def test_get_url_fetch_error_remembered(self):
+        """Media that can't be fetched isn't fetched again for a while"""
+        clock = Clock()
+        self.media_server.add_err('missing.wav', 'Not found')
+        url = '%smissing.wav' % self.media_server.url
+        cache = self.get_cache(failure_ttl=60, clock=clock)
+        yield cache.get_url(url)
+        clock.advance(59)
+        result = yield cache.get_url(url)
+        self.assertEqual(result, url)
+        self.assertEqual(len(self.media_server.requests), 1)
+
+        clock.advance(1)
+        yield cache.get_url(url)
+        self.assertEqual(len(self.media_server.requests), 2)
+
+    def test_get_url_fetch_timeout(self):
+        """The original URL is used if the media takes too long to fetch"""
+        clock = Clock()
+        cache = self.get_cache(fetch_timeout=5, clock=clock)
+        fetch = Deferred()
+        cache._fetch = lambda url: fetch
+        d = cache.get_url('http://example.org/slow.wav')
+        clock.advance(4)
+        self.assertNoResult(d)
+        clock.advance(1)
+        self.assertEqual(
+            self.successResultOf(d), 'http://example.org/slow.wav')
+        # The download was cancelled
+        self.assertTrue(fetch.called)
+
+        # It isn't fetched again while the failure is remembered
+        cache._fetch = lambda url: self.fail('Fetched again')
+        self.assertEqual(
+            self.successResultOf(cache.get_url('http://example.org/slow.wav')),
+            'http://example.org/slow.wav')
+
+    @inlineCallbacks
+    def test_evict_max_entries(self):
+        """The least recently used media is removed once there are too many
+        entries"""
+        url1 = self.add_media('1.wav', 'a')
+        url2 = self.add_media('2.wav', 'b')
+        url3 = self.add_media('3.wav', 'c')
+        cache = self.get_cache(max_entries=2)
+        yield cache.get_url(url1)
+        yield cache.get_url(url2)
+        # Using url1 again makes url2 the least recently used
+        yield cache.get_url(url1)
+        yield cache.get_url(url3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+        yield cache.get_url(url1)
+        yield cache.get_url(url2)
+        self.assertEqual(
+            [r['filename'] for r in self.media_server.requests],
+            ['1.wav', '2.wav', '3.wav', '2.wav'])
+
+    @inlineCallbacks
+    def test_evict_max_bytes(self):
+        """The least recently used media is removed once the cache is too
+        large"""
+        url1 = self.add_media('1.wav', 'a' * 6)
+        url2 = self.add_media('2.wav', 'b' * 6)
+        cache = self.get_cache(max_bytes=10)
+        yield cache.get_url(url1)
+        yield cache.get_url(url2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.total_bytes, 6)
+
+    @inlineCallbacks
+    def test_too_large(self):
+        """Media larger than the whole cache isn't cached"""
+        url = self.add_media('1.wav', 'a' * 11)
+        cache = self.get_cache(max_bytes=10)
+        result = yield cache.get_url(url)
+        self.assertEqual(result, url)
+        self.assertEqual(len(cache), 0)
+
+    @inlineCallbacks
+    def test_load_existing_entries(self):
+        """Media cached by a previous run is used"""
+        url = self.add_media('prompt.wav', 'audio')
+        cache = self.get_cache()
+        local_url = yield cache.get_url(url)
+
+        cache = self.get_cache()
+        self.assertEqual(len(cache), 1)
+        result = yield cache.get_url(url)
+        self.assertEqual(result, local_url)
+        self.assertEqual(len(self.media_server.requests), 1)
+
+    @inlineCallbacks
+    def test_resource_range_request(self):
+        """The cached media is served, with support for range requests"""
+        url = self.add_media('prompt.wav', '0123456789')
+        cache = self.get_cache()
+        port = reactor.listenTCP(
+            0, Site(cache.resource()), interface='127.0.0.1')
+        self.add_cleanup(port.stopListening)
+        cache.base_url = 'http://127.0.0.1:%s' % port.getHost().port
+        local_url = yield cache.get_url(url)
+
+        response = yield treq.get(
+            local_url, headers={'Range': 'bytes=2-5'}, persistent=False)
+        self.assertEqual(response.code, 206)
+        content = yield response.content()
+        self.assertEqual(content, '2345')
+
+    @inlineCallbacks
+    def test_resource_no_directory_listing(self):
+        """The cached media isn't listed when the directory is requested"""
+        url = self.add_media('prompt.wav', '0123456789')
+        cache = self.get_cache()
+        port = reactor.listenTCP(
+            0, Site(cache.resource()), interface='127.0.0.1')
+        self.add_cleanup(port.stopListening)
+        base_url = 'http://127.0.0.1:%s' % port.getHost().port
+        cache.base_url = base_url
+        local_url = yield cache.get_url(url)
+
+        response = yield treq.get(base_url + '/', persistent=False)
+        self.assertEqual(response.code, 404)
+        content = yield response.content()
+        self.assertNotIn(os.path.basename(local_url), content)
+
+        response = yield treq.get(local_url, persistent=False)
+        self.assertEqual(response.code, 200)
@@ -0,0 +1,180 @@
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock, deferLater
+from twisted.trial.unittest import TestCase
+from vumi.message import TransportEvent, TransportUserMessage
+
+from vxtwinio.replay import Replayer, StubHTTP, StubTransport
+from vxtwinio.twilio_api import TwilioAPIWorker
+
+
+PLAY = '<Response><Play>%s</Play></Response>'
+
+
+def twiml_record(t, url, body, code=200, elapsed=0.5):
+    return {
+        'type': 'twiml', 't': t, 'url': url, 'method': 'POST', 'code': code,
+        'body': body, 'elapsed': elapsed}
+
+
+class TestStubHTTP(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_responses_in_turn(self):
+        """Each URL gets its responses in the order they were captured, and
+        then the last one again"""
+        http = StubHTTP([
+            twiml_record(0, 'http://a/', u'first'),
+            twiml_record(1, 'http://b/', u'other'),
+            twiml_record(2, 'http://a/', u'second', code=500),
+        ])
+        bodies = []
+        for _ in range(3):
+            response = self.successResultOf(http.request('http://a/', 'POST'))
+            bodies.append(
+                (response.code, self.successResultOf(response.content())))
+        self.assertEqual(
+            bodies, [(200, 'first'), (500, 'second'), (500, 'second')])
+        self.assertEqual(len(http.requests), 3)
+
+    def test_unknown(self):
+        http = StubHTTP([twiml_record(0, 'http://a/', u'first')])
+        response = self.successResultOf(http.request('http://a/', 'GET'))
+        self.assertEqual(response.code, 404)
+
+    def test_delay(self):
+        """Responses take as long as they did when captured, divided by the
+        speed of the replay"""
+        http = StubHTTP(
+            [twiml_record(0, 'http://a/', u'first', elapsed=0.5)], speed=2,
+            clock=self.clock)
+        d = http.request('http://a/', 'POST')
+        self.clock.advance(0.2)
+        self.assertNoResult(d)
+        self.clock.advance(0.05)
+        self.assertEqual(self.successResultOf(d).code, 200)
+
+
+class TestStubTransport(TestCase):
+    def test_sent_ids(self):
+        """The IDs of sent messages are kept for each address, in order"""
+        transport = StubTransport()
+        messages = [
+            TransportUserMessage.send(to_addr, '', transport_name='voice')
+            for to_addr in ('+1', '+2', '+1')]
+        for message in messages:
+            transport.publish_outbound(message)
+        self.assertEqual(transport.outbound, messages)
+        self.assertEqual(transport.sent_ids['+1'], [
+            messages[0]['message_id'], messages[2]['message_id']])
+        self.assertEqual(
+            transport.sent_ids['+2'], [messages[1]['message_id']])
+
+
+class TestReplayer(TestCase):
+    def make_records(self):
+        """Returns the capture of an inbound call, and an outbound call to
+        +99999 that is answered a second later"""
+        inbound = TransportUserMessage(
+            to_addr='+12345', from_addr='+54321', transport_name='voice',
+            transport_type='voice',
+            session_event=TransportUserMessage.SESSION_NEW)
+        outbound = TransportUserMessage.send(
+            '+99999', '', from_addr='+12345', transport_name='voice',
+            session_event=TransportUserMessage.SESSION_NEW)
+        ack = TransportEvent(
+            event_type='ack', user_message_id=outbound['message_id'],
+            sent_message_id='abc', transport_name='voice')
+        fields = {
+            'CallId': 'CA1', 'AccountSid': 'AC1', 'To': '+99999',
+            'From': '+12345', 'Url': 'http://client/call.xml',
+            'Method': 'POST', 'FallbackUrl': None, 'FallbackMethod': 'POST',
+            'StatusCallback': None, 'StatusCallbackMethod': 'POST',
+            'Timeout': 60, 'Status': 'queued', 'Direction': 'outbound-api',
+        }
+        return [
+            {'type': 'inbound', 't': 0, 'message': inbound.payload},
+            twiml_record(0, 'http://client/', PLAY % ('inbound.wav',)),
+            {'type': 'outbound', 't': 0.5, 'message': {
+                'to_addr': '+54321', 'message_id': 'reply'}},
+            {'type': 'call', 't': 1, 'fields': fields},
+            {'type': 'outbound', 't': 1, 'message': outbound.payload},
+            {'type': 'event', 't': 2, 'event': ack.payload},
+            twiml_record(2, 'http://client/call.xml', PLAY % ('call.wav',)),
+        ]
+
+    @inlineCallbacks
+    def start_replayer(self, records, speed=None):
+        replayer = Replayer(records, speed)
+        yield replayer.start_worker({
+            'web_path': '/api',
+            'client_path': 'http://client/',
+            'speech_cache_dir': self.mktemp(),
+            'call_queue_path': self.mktemp(),
+        })
+        self.addCleanup(replayer.stop_worker)
+        returnValue(replayer)
+
+    def speech_urls(self, replayer):
+        return [
+            (message['to_addr'],
+             message['helper_metadata'].get('voice', {}).get('speech_url'))
+            for message in replayer.transport.outbound]
+
+    @inlineCallbacks
+    def test_max_speed(self):
+        """Each record is replayed once the one before it is handled, and
+        events are given to the messages sent in place of the captured
+        ones"""
+        replayer = yield self.start_replayer(self.make_records())
+        summary = yield replayer.run()
+        self.assertEqual(self.speech_urls(replayer), [
+            ('+54321', 'inbound.wav'),
+            ('+99999', None),
+            ('+99999', 'call.wav'),
+        ])
+        self.assertEqual(summary['replayed'], 3)
+        self.assertEqual(summary['errors'], 0)
+        self.assertEqual(summary['outbound'], 3)
+        self.assertEqual(summary['captured_outbound'], 2)
+        self.assertEqual(summary['twiml_requests'], 2)
+        self.assertTrue(summary['finished'])
+
+    @inlineCallbacks
+    def test_speed(self):
+        """Records are replayed at the times they were captured at, divided
+        by the speed"""
+        clock = Clock()
+        self.patch(TwilioAPIWorker, 'clock', clock)
+        replayer = yield self.start_replayer(self.make_records(), speed=2)
+        replayed = []
+        replay = replayer.replay
+
+        def record_replay(record):
+            replayed.append((record['type'], clock.seconds()))
+            return replay(record)
+
+        self.patch(replayer, 'replay', record_replay)
+        d = replayer.run()
+        while not d.called:
+            # Give Redis and the TwiML responses time to answer
+            clock.advance(0.25)
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(
+            replayed, [('inbound', 0), ('call', 0.5), ('event', 1)])
+        summary = yield d
+        self.assertEqual(summary['replayed'], 3)
+        self.assertEqual(
+            self.speech_urls(replayer)[-1], ('+99999', 'call.wav'))
+
+    @inlineCallbacks
+    def test_errors(self):
+        """Records that can't be replayed are counted"""
+        replayer = yield self.start_replayer([
+            {'type': 'call', 't': 0, 'fields': {}},
+        ])
+        summary = yield replayer.run()
+        self.assertEqual(summary['errors'], 1)
+        self.assertEqual(summary['replayed'], 0)
+        self.flushLoggedErrors(KeyError)
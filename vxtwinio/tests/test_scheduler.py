@@ -0,0 +1,160 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from vumi.tests.helpers import PersistenceHelper, VumiTestCase
+
+from vxtwinio.scheduler import Scheduler, TimerWheel
+
+
+class TestTimerWheel(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.wheel = TimerWheel(1, slots=(4, 4, 4), clock=self.clock)
+        self.wheel.start()
+        self.addCleanup(self.wheel.stop)
+        self.calls = []
+
+    def advance_to(self, seconds):
+        while self.clock.seconds() < seconds:
+            self.clock.advance(1)
+
+    def test_call_later(self):
+        self.wheel.call_later(2, self.calls.append, 'a')
+        self.assertEqual(len(self.wheel), 1)
+        self.advance_to(1)
+        self.assertEqual(self.calls, [])
+        self.advance_to(2)
+        self.assertEqual(self.calls, ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel(self):
+        timer = self.wheel.call_later(2, self.calls.append, 'a')
+        self.assertTrue(timer.active())
+        timer.cancel()
+        self.assertFalse(timer.active())
+        self.assertEqual(len(self.wheel), 0)
+        self.advance_to(3)
+        self.assertEqual(self.calls, [])
+
+    def test_cancel_twice(self):
+        """Cancelling a timer that has already run or been cancelled doesn't
+        change the count"""
+        cancelled = self.wheel.call_later(2, self.calls.append, 'a')
+        called = self.wheel.call_later(1, self.calls.append, 'b')
+        self.wheel.call_later(3, self.calls.append, 'c')
+        cancelled.cancel()
+        cancelled.cancel()
+        self.advance_to(1)
+        called.cancel()
+        self.assertEqual(self.calls, ['b'])
+        self.assertEqual(len(self.wheel), 1)
+
+    def test_long_delays(self):
+        """Timers on coarser levels are moved down and run on time"""
+        for delay in (3, 5, 17, 40, 63):
+            self.wheel.call_later(delay, self.calls.append, delay)
+        fired = []
+        for seconds in range(1, 64):
+            self.advance_to(seconds)
+            if self.calls:
+                fired.append((seconds, self.calls.pop()))
+        self.assertEqual(fired, [(3, 3), (5, 5), (17, 17), (40, 40), (63, 63)])
+
+    def test_overflow(self):
+        """Timers beyond the top level are kept until they fit"""
+        self.wheel.call_later(100, self.calls.append, 'a')
+        self.advance_to(99)
+        self.assertEqual(self.calls, [])
+        self.advance_to(100)
+        self.assertEqual(self.calls, ['a'])
+
+    def test_timer_error(self):
+        """An error in one timer doesn't stop the others"""
+        self.wheel.call_later(1, lambda: 1 / 0)
+        self.wheel.call_later(1, self.calls.append, 'a')
+        self.advance_to(1)
+        self.assertEqual(self.calls, ['a'])
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+
+class TestScheduler(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.clock = Clock()
+        self.calls = []
+
+    def get_scheduler(self, **kw):
+        wheel = TimerWheel(1, clock=self.clock)
+        scheduler = Scheduler(self.redis, wheel, **kw)
+        scheduler.register(
+            'test', lambda timer_id, payload: self.calls.append(payload))
+        scheduler.start()
+        self.add_cleanup(scheduler.stop)
+        return scheduler
+
+    @inlineCallbacks
+    def test_schedule(self):
+        """Timers are stored in the sorted set until they run"""
+        scheduler = self.get_scheduler()
+        timer_id = yield scheduler.schedule(5, 'test', {'a': 1})
+        [(stored, score)] = yield self.redis.zrange(
+            'timers', 0, -1, withscores=True)
+        self.assertEqual(stored, timer_id)
+        self.assertEqual(score, 5)
+
+        self.clock.advance(5)
+        yield scheduler.wait_for_running()
+        self.assertEqual(self.calls, [{'a': 1}])
+        stored = yield self.redis.zrange('timers', 0, -1)
+        self.assertEqual(stored, [])
+        self.assertEqual(len(scheduler), 0)
+
+    @inlineCallbacks
+    def test_cancel(self):
+        scheduler = self.get_scheduler()
+        timer_id = yield scheduler.schedule(5, 'test', {})
+        cancelled = yield scheduler.cancel(timer_id)
+        self.assertTrue(cancelled)
+        self.clock.advance(5)
+        yield scheduler.wait_for_running()
+        self.assertEqual(self.calls, [])
+        stored = yield self.redis.zrange('timers', 0, -1)
+        self.assertEqual(stored, [])
+
+        cancelled = yield scheduler.cancel(timer_id)
+        self.assertFalse(cancelled)
+
+    @inlineCallbacks
+    def test_runs_once(self):
+        """A timer only runs for the worker that claims it"""
+        scheduler1 = self.get_scheduler(recovery_interval=0)
+        scheduler2 = self.get_scheduler(recovery_interval=0)
+        timer_id = yield scheduler1.schedule(5, 'test', {})
+        yield self.redis.zrem('timers', timer_id)
+        self.clock.advance(5)
+        yield scheduler1.wait_for_running()
+        self.assertEqual(self.calls, [])
+
+        timer_id = yield scheduler1.schedule(5, 'test', {})
+        yield scheduler2._run(timer_id)
+        self.clock.advance(5)
+        yield scheduler1.wait_for_running()
+        self.assertEqual(self.calls, [{}])
+
+    @inlineCallbacks
+    def test_recover(self):
+        """Overdue timers from other workers are taken over"""
+        crashed = self.get_scheduler(recovery_interval=0)
+        yield crashed.schedule(5, 'test', {'a': 1})
+        crashed.stop()
+
+        scheduler = self.get_scheduler(
+            recovery_interval=0, recovery_grace=10)
+        self.clock.advance(10)
+        yield scheduler.recover()
+        self.assertEqual(self.calls, [])
+        self.clock.advance(10)
+        yield scheduler.recover()
+        self.assertEqual(self.calls, [{'a': 1}])
@@ -0,0 +1,107 @@
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+from vumi.tests.helpers import PersistenceHelper, VumiTestCase
+
+from vxtwinio.session import CallSession, CallSessionManager
+
+
+class TestCallSession(TestCase):
+    def test_loaded_session_clean(self):
+        """Fields given when loading a session are not marked as changed"""
+        session = CallSession('+12345', {'Status': 'queued'})
+        self.assertEqual(session['Status'], 'queued')
+        self.assertEqual(session.dirty, set())
+        self.assertEqual(session.changes(), {})
+
+    def test_new_session_dirty(self):
+        """Every field of a new session is marked as changed"""
+        session = CallSession('+12345', {'Status': 'queued'}, new=True)
+        self.assertEqual(session.changes(), {'Status': 'queued'})
+
+    def test_setting_fields(self):
+        """Setting and updating fields marks them as changed"""
+        session = CallSession('+12345', {'Status': 'queued', 'To': '+1'})
+        session['Status'] = 'in-progress'
+        session.update({'Gather_Action': 'url'}, Gather_Method='GET')
+        session.setdefault('To', '+2')
+        self.assertEqual(session.changes(), {
+            'Status': 'in-progress',
+            'Gather_Action': 'url',
+            'Gather_Method': 'GET',
+        })
+
+    def test_deleting_fields(self):
+        """Fields cannot be removed from a session"""
+        session = CallSession('+12345', {'Status': 'queued'})
+
+        def delete():
+            del session['Status']
+        self.assertRaises(TypeError, delete)
+
+
+class TestCallSessionManager(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.manager = CallSessionManager(self.redis)
+
+    @inlineCallbacks
+    def test_create_call_session(self):
+        """Creating a session replaces any existing session"""
+        yield self.manager.save_session('+12345', {'Old': 'value'})
+        session = yield self.manager.create_call_session(
+            '+12345', Status='queued')
+        self.assertEqual(session.dirty, set())
+        self.assertEqual(session['Status'], 'queued')
+        stored = yield self.manager.load_session('+12345')
+        self.assertEqual(stored['Status'], 'queued')
+        self.assertTrue('created_at' in stored)
+        self.assertFalse('Old' in stored)
+
+    @inlineCallbacks
+    def test_flush_writes_changes_once(self):
+        """Only changed fields are written, in a single call"""
+        yield self.manager.save_session('+12345', {
+            'Status': 'queued', 'To': '+1'})
+        session = yield self.manager.load_call_session('+12345')
+        session['Status'] = 'in-progress'
+        session['Gather_Action'] = 'url'
+
+        writes = []
+        hmset = self.redis.hmset
+
+        def record_hmset(key, mapping):
+            writes.append(mapping)
+            return hmset(key, mapping)
+        self.patch(self.redis, 'hmset', record_hmset)
+
+        yield self.manager.flush(session)
+        yield self.manager.flush(session)
+        self.assertEqual(
+            writes, [{'Status': 'in-progress', 'Gather_Action': 'url'}])
+        stored = yield self.manager.load_session('+12345')
+        self.assertEqual(stored, {
+            'Status': 'in-progress', 'To': '+1', 'Gather_Action': 'url'})
+
+    @inlineCallbacks
+    def test_flush_cleared_session(self):
+        """A cleared session is not written back"""
+        yield self.manager.save_session('+12345', {'Status': 'queued'})
+        session = yield self.manager.load_call_session('+12345')
+        yield self.manager.clear_call_session(session)
+        session['Status'] = 'completed'
+        yield self.manager.flush(session)
+        stored = yield self.manager.load_session('+12345')
+        self.assertEqual(stored, {})
+
+    @inlineCallbacks
+    def test_get_field(self):
+        yield self.manager.save_session('+12345', {'CallId': 'CA1'})
+        call_id = yield self.manager.get_field('+12345', 'CallId')
+        self.assertEqual(call_id, 'CA1')
+        missing = yield self.manager.get_field('+12345', 'Missing')
+        self.assertEqual(missing, None)
+        missing = yield self.manager.get_field('+54321', 'CallId')
+        self.assertEqual(missing, None)
@@ -0,0 +1,46 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.sids import SIDGenerator, min_sid, parse_sid
+
+
+class TestSIDGenerator(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1400000000)
+        self.generator = SIDGenerator(7, clock=self.clock)
+
+    def test_generate(self):
+        sid = self.generator.generate('CA')
+        self.assertTrue(sid.startswith('CA'))
+        self.assertEqual(len(sid), 34)
+        self.assertEqual(parse_sid(sid), ('CA', 1400000000000, 7, 0))
+
+    def test_creation_order(self):
+        """SIDs sort in the order they were created in, even within one
+        millisecond and if the clock goes backwards"""
+        sids = [self.generator.generate('CA') for _ in range(3)]
+        self.clock.advance(0.001)
+        sids.append(self.generator.generate('CA'))
+        self.clock.rightNow -= 1
+        sids.append(self.generator.generate('CA'))
+        self.assertEqual(sorted(sids), sids)
+        self.assertEqual(len(set(sids)), 5)
+        self.assertEqual(
+            [parse_sid(sid)[3] for sid in sids], [0, 1, 2, 0, 1])
+
+    def test_invalid_shard_id(self):
+        self.assertRaises(ValueError, SIDGenerator, 0x10000)
+        self.assertRaises(ValueError, SIDGenerator, -1)
+
+    def test_parse_sid_invalid(self):
+        self.assertRaises(ValueError, parse_sid, 'CA1234')
+        self.assertRaises(ValueError, parse_sid, 'CA' + 'z' * 32)
+
+    def test_min_sid(self):
+        """SIDs created at or after a time sort after its min_sid"""
+        before = self.generator.generate('CA')
+        self.clock.advance(1)
+        bound = min_sid('CA', self.clock.seconds())
+        after = self.generator.generate('CA')
+        self.assertTrue(before < bound <= after)
@@ -0,0 +1,281 @@
+from random import Random
+
+from twilio import twiml
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from vumi.config import ConfigError
+from vumi.message import TransportUserMessage
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.tests.helpers import TransportHelper
+
+from .helpers import TwiMLServer
+from vxtwinio.simulator import (
+    CallSimulator, Distribution, InProcessTransport, SimulatedVoiceTransport,
+    SimulatedVoiceTransportConfig, summarize)
+from vxtwinio.twilio_api import TwilioAPIWorker
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.published = []
+
+    def publish_message(self, **kw):
+        self.published.append(('message', kw))
+        return succeed(None)
+
+    def publish_ack(self, user_message_id, sent_message_id):
+        self.published.append(('ack', user_message_id))
+        return succeed(None)
+
+    def publish_nack(self, user_message_id, reason):
+        self.published.append(('nack', user_message_id, reason))
+        return succeed(None)
+
+
+class TestDistribution(TestCase):
+    def test_constant(self):
+        self.assertEqual(Distribution(0.5).sample(Random()), 0.5)
+        self.assertEqual(
+            Distribution({'type': 'constant', 'value': 2}).sample(Random()),
+            2)
+
+    def test_uniform(self):
+        distribution = Distribution({'type': 'uniform', 'min': 1, 'max': 2})
+        random = Random(1)
+        for _ in range(100):
+            self.assertTrue(1 <= distribution.sample(random) <= 2)
+
+    def test_never_negative(self):
+        distribution = Distribution(
+            {'type': 'normal', 'mean': 0, 'stddev': 1})
+        random = Random(1)
+        samples = [distribution.sample(random) for _ in range(100)]
+        self.assertEqual(min(samples), 0)
+
+    def test_repeatable(self):
+        distribution = Distribution(
+            {'type': 'lognormal', 'median': 0.1, 'sigma': 0.5})
+        self.assertEqual(
+            [distribution.sample(Random(3)) for _ in range(2)],
+            [distribution.sample(Random(3)) for _ in range(2)])
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, Distribution, {'type': 'pareto'})
+        self.assertRaises(ValueError, Distribution, 'fast')
+
+
+class TestSummarize(TestCase):
+    def test_summarize(self):
+        self.assertEqual(summarize(range(1, 101)), {
+            'count': 100, 'mean': 50, 'p50': 50, 'p95': 95, 'p99': 99,
+            'max': 100})
+
+    def test_empty(self):
+        self.assertEqual(summarize([]), {'count': 0})
+
+
+class TestCallSimulator(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.transport = FakeTransport()
+
+    def make_simulator(self, **kw):
+        kw.setdefault('ack_latency', 0.25)
+        simulator = CallSimulator(
+            self.transport, clock=self.clock, random=Random(1), **kw)
+        self.addCleanup(simulator.stop)
+        return simulator
+
+    def outbound(self, to_addr, session_event=None, wait_for=None):
+        helper_metadata = {'voice': {}}
+        if wait_for is not None:
+            helper_metadata['voice']['wait_for'] = wait_for
+        return TransportUserMessage.send(
+            to_addr, None, from_addr='+12345', session_event=session_event,
+            helper_metadata=helper_metadata)
+
+    def test_inbound_calls(self):
+        """Inbound calls arrive at the call rate"""
+        simulator = self.make_simulator(call_rate=10)
+        simulator.start()
+        self.clock.pump([0.01] * 1000)
+        messages = [kw for kind, kw in self.transport.published]
+        self.assertTrue(80 < len(messages) < 120)
+        self.assertEqual(len(set(kw['from_addr'] for kw in messages)),
+                         len(messages))
+        [session_event] = set(kw['session_event'] for kw in messages)
+        self.assertEqual(session_event, TransportUserMessage.SESSION_NEW)
+        self.assertEqual(simulator.counts['inbound_calls'], len(messages))
+
+    def test_ack_latency(self):
+        simulator = self.make_simulator()
+        message = self.outbound('+54321')
+        simulator.handle_outbound(message)
+        self.clock.advance(0.125)
+        self.assertEqual(self.transport.published, [])
+        self.clock.advance(0.125)
+        self.assertEqual(
+            self.transport.published, [('ack', message['message_id'])])
+
+    def test_nack_rate(self):
+        simulator = self.make_simulator(nack_rate=1)
+        message = self.outbound('+54321')
+        simulator.handle_outbound(message)
+        self.clock.advance(0.25)
+        self.assertEqual(self.transport.published, [
+            ('nack', message['message_id'], 'Simulated failure')])
+        self.assertEqual(simulator.counts['nacked'], 1)
+
+    def test_unanswered(self):
+        simulator = self.make_simulator(scripts=[{'answer_rate': 0}])
+        message = self.outbound(
+            '+54321', session_event=TransportUserMessage.SESSION_NEW)
+        simulator.handle_outbound(message)
+        self.clock.advance(0.25)
+        self.assertEqual(self.transport.published, [
+            ('nack', message['message_id'], 'No answer')])
+        self.assertEqual(simulator.calls, {})
+
+    def test_outbound_call(self):
+        """Answered outbound calls enter digits when prompted for them, and
+        hang up"""
+        simulator = self.make_simulator(scripts=[{
+            'digits': ['12'], 'digit_delay': 2, 'hangup_after': 10}])
+        call = self.outbound(
+            '+54321', session_event=TransportUserMessage.SESSION_NEW)
+        simulator.handle_outbound(call)
+        self.clock.advance(0.25)
+        self.assertEqual(
+            self.transport.published, [('ack', call['message_id'])])
+        self.assertEqual(simulator.counts['outbound_calls'], 1)
+
+        self.clock.advance(0.5)
+        gather = self.outbound('+54321', wait_for='#')
+        simulator.handle_outbound(gather)
+        self.assertEqual(simulator.response_times, [0.5])
+        self.clock.pump([0.25, 2])
+        [_, _, (kind, digits)] = self.transport.published
+        self.assertEqual(kind, 'message')
+        self.assertEqual(digits['content'], '12')
+        self.assertEqual(digits['from_addr'], '+54321')
+        self.assertEqual(digits['to_addr'], '+12345')
+
+        # There are no more digits to enter
+        simulator.handle_outbound(self.outbound('+54321', wait_for='#'))
+        self.clock.pump([0.25, 5])
+        self.assertEqual(len(self.transport.published), 4)
+
+        self.clock.advance(2)
+        (kind, hangup) = self.transport.published[-1]
+        self.assertEqual(
+            hangup['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(simulator.counts['hung_up'], 1)
+        self.assertEqual(simulator.calls, {})
+
+    def test_closed_by_worker(self):
+        simulator = self.make_simulator(scripts=[{'hangup_after': 10}])
+        simulator.place_call('+54321')
+        simulator.handle_outbound(self.outbound(
+            '+54321', session_event=TransportUserMessage.SESSION_CLOSE))
+        self.clock.pump([0.25, 20])
+        self.assertEqual(simulator.counts['closed_by_worker'], 1)
+        self.assertEqual(simulator.counts['hung_up'], 0)
+        self.assertEqual(simulator.summary()['live_calls'], 0)
+        self.assertEqual(
+            simulator.summary()['response_time']['count'], 1)
+
+    def test_scripts_by_weight(self):
+        simulator = self.make_simulator(scripts=[
+            {'weight': 3, 'digits': ['1']},
+            {'weight': 1, 'digits': ['2']},
+        ])
+        for i in range(400):
+            simulator.place_call('+%s' % (i,))
+        chosen = [call.script.digits for call in simulator.calls.values()]
+        self.assertTrue(250 < chosen.count(['1']) < 350)
+
+
+class TestInProcessTransport(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.twiml_server = yield self.add_helper(TwiMLServer())
+        self.worker = TwilioAPIWorker({}, {
+            'transport_name': 'simulator',
+            'redis_manager': {'FAKE_REDIS': True},
+            'web_path': '/api',
+            'web_port': 0,
+            'client_path': '%sinbound.xml' % (self.twiml_server.url,),
+            'speech_cache_dir': self.mktemp(),
+            'call_queue_path': self.mktemp(),
+        })
+        self.transport = InProcessTransport(self.worker)
+        self.simulator = self.transport.simulator = CallSimulator(
+            self.transport, random=Random(1))
+        yield self.worker.setup_worker()
+        self.add_cleanup(self.worker.teardown_worker)
+
+    @inlineCallbacks
+    def test_inbound_call(self):
+        response = twiml.Response()
+        response.play('test_url')
+        response.hangup()
+        self.twiml_server.add_response('inbound.xml', response)
+        yield self.simulator.place_call('+54321')
+        yield self.worker.in_flight.wait(10)
+        self.assertEqual(self.simulator.counts['closed_by_worker'], 1)
+        self.assertEqual(self.simulator.counts['acked'], 2)
+        self.assertEqual(
+            self.simulator.summary()['response_time']['count'], 1)
+
+
+class TestSimulatedVoiceTransport(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SimulatedVoiceTransport, 'clock', self.clock)
+        self.tx_helper = self.add_helper(
+            TransportHelper(SimulatedVoiceTransport))
+        self.transport = yield self.tx_helper.get_transport({
+            'ack_latency': 0.5,
+            'scripts': [{'digits': ['1'], 'digit_delay': 1}],
+            'seed': 1,
+        })
+
+    @inlineCallbacks
+    def test_outbound_call(self):
+        msg = yield self.tx_helper.make_dispatch_outbound(
+            None, to_addr='+54321', from_addr='+12345',
+            session_event=TransportUserMessage.SESSION_NEW)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+        self.clock.advance(0.5)
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], msg['message_id'])
+
+        yield self.tx_helper.make_dispatch_outbound(
+            None, to_addr='+54321', from_addr='+12345',
+            helper_metadata={'voice': {'wait_for': '#'}})
+        self.clock.pump([0.5, 1])
+        [digits] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(digits['content'], '1')
+        self.assertEqual(digits['from_addr'], '+54321')
+        self.assertEqual(digits['transport_type'], 'voice')
+
+    def test_config_ack_latency(self):
+        """The ack latency can be given as a number of seconds or as a
+        distribution"""
+        config = SimulatedVoiceTransportConfig({
+            'transport_name': 'simulator', 'ack_latency': 0.1})
+        self.assertEqual(config.ack_latency, 0.1)
+        config = SimulatedVoiceTransportConfig({
+            'transport_name': 'simulator',
+            'ack_latency': {'type': 'exponential', 'mean': 0.1}})
+        self.assertEqual(
+            config.ack_latency, {'type': 'exponential', 'mean': 0.1})
+        self.assertRaises(
+            ConfigError, SimulatedVoiceTransportConfig, {
+                'transport_name': 'simulator',
+                'ack_latency': {'type': 'pareto'}})
@@ -0,0 +1,85 @@
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.slo import LatencyStats, SLOTracker
+
+
+class TestLatencyStats(TestCase):
+    def test_summary(self):
+        stats = LatencyStats()
+        for seconds in [0.05, 0.2, 0.2, 3.0]:
+            stats.add(seconds, seconds / 2, threshold=1)
+        summary = stats.summary(1)
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['slow'], 1)
+        self.assertEqual(summary['slow_fraction'], 0.25)
+        self.assertAlmostEqual(summary['mean'], 0.8625)
+        self.assertEqual(summary['max'], 3)
+        self.assertEqual(summary['p50'], 0.25)
+        self.assertEqual(summary['p95'], 5)
+        self.assertAlmostEqual(summary['twiml_fetch_share'], 0.5)
+        self.assertEqual(summary['buckets']['0.25'], 2)
+        self.assertEqual(summary['buckets']['inf'], 0)
+
+    def test_past_last_bucket(self):
+        stats = LatencyStats()
+        stats.add(30, 0, threshold=1)
+        self.assertEqual(stats.percentile(0.5), 30)
+        self.assertEqual(stats.summary(1)['buckets']['inf'], 1)
+
+    def test_empty(self):
+        summary = LatencyStats().summary(1)
+        self.assertEqual(summary['count'], 0)
+        self.assertEqual(summary['mean'], 0.0)
+        self.assertEqual(summary['twiml_fetch_share'], 0.0)
+
+
+class TestSLOTracker(TestCase):
+    def setUp(self):
+        self.tracker = SLOTracker(
+            {'first_prompt': 2, 'next_prompt': 1}, slow_fraction=0.1,
+            min_samples=10)
+
+    def test_account(self):
+        self.tracker.record('AC1', 'first_prompt', 1.5, 1)
+        account = self.tracker.account('AC1')
+        self.assertEqual(account['slow'], False)
+        self.assertEqual(account['metrics']['first_prompt']['count'], 1)
+        self.assertEqual(account['metrics']['first_prompt']['threshold'], 2)
+        self.assertEqual(account['metrics']['next_prompt']['count'], 0)
+        self.assertEqual(self.tracker.accounts(), ['AC1'])
+
+    def test_unknown_account(self):
+        account = self.tracker.account('AC1')
+        self.assertEqual(account['slow'], False)
+        self.assertEqual(account['metrics']['first_prompt']['count'], 0)
+
+    def test_slow(self):
+        """Accounts are slow once too many of their waits are over the
+        threshold, with enough waits to tell"""
+        for _ in range(8):
+            self.tracker.record('AC1', 'next_prompt', 0.5)
+        self.tracker.record('AC1', 'next_prompt', 1.5)
+        self.assertFalse(self.tracker.is_slow('AC1'))
+        self.tracker.record('AC1', 'next_prompt', 0.5)
+        self.assertFalse(self.tracker.is_slow('AC1'))
+        self.tracker.record('AC1', 'next_prompt', 1.5)
+        self.assertTrue(self.tracker.is_slow('AC1'))
+
+    def test_max_accounts(self):
+        """The account that has gone longest without a wait is dropped"""
+        self.tracker.max_accounts = 2
+        self.tracker.record('AC1', 'first_prompt', 1)
+        self.tracker.record('AC2', 'first_prompt', 1)
+        self.tracker.record('AC1', 'next_prompt', 1)
+        self.tracker.record('AC3', 'first_prompt', 1)
+        self.assertEqual(self.tracker.accounts(), ['AC1', 'AC3'])
+        account = self.tracker.account('AC1')
+        self.assertEqual(account['metrics']['first_prompt']['count'], 1)
+
+    def test_export(self):
+        self.tracker.record('AC1', 'first_prompt', 1)
+        self.tracker.record('AC2', 'next_prompt', 1)
+        export = self.tracker.export()
+        self.assertEqual(sorted(export), ['AC1', 'AC2'])
+        self.assertEqual(
+            export['AC2']['metrics']['next_prompt']['count'], 1)
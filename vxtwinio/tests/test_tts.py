@@ -0,0 +1,115 @@
+import os
+from StringIO import StringIO
+import wave
+
+import treq
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.trial.unittest import TestCase
+from twisted.web.server import Site
+
+from vxtwinio.tts import SpeechCache, StubTTSEngine, TTSEngine
+
+
+class RecordingTTSEngine(TTSEngine):
+    """Engine that records requests, and only finishes rendering when told
+    to"""
+    def __init__(self, config=None):
+        super(RecordingTTSEngine, self).__init__(config)
+        self.requests = []
+
+    def synthesize(self, text, voice, language):
+        d = Deferred()
+        self.requests.append(((text, voice, language), d))
+        return d
+
+
+class TestStubTTSEngine(TestCase):
+    def test_synthesize(self):
+        """The stub engine renders valid audio whose length depends on the
+        text"""
+        engine = StubTTSEngine()
+        data = engine.synthesize('Hello', 'man', 'en')
+        audio = wave.open(StringIO(data), 'rb')
+        self.assertEqual(audio.getnchannels(), 1)
+        self.assertEqual(audio.getframerate(), 8000)
+        self.assertEqual(audio.getnframes(), 5 * 800)
+
+
+class TestSpeechCache(TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        self.engine = RecordingTTSEngine()
+        self.cache = SpeechCache(
+            self.engine, self.directory, 'http://example.com/speech/')
+
+    @inlineCallbacks
+    def test_get_url_renders_once(self):
+        """Speech is only rendered once for the same text, voice and
+        language"""
+        d1 = self.cache.get_url('Hello', 'man', 'en')
+        d2 = self.cache.get_url('Hello', 'man', 'en')
+        [(args, render)] = self.engine.requests
+        self.assertEqual(args, ('Hello', 'man', 'en'))
+        render.callback('audio')
+
+        url1 = yield d1
+        url2 = yield d2
+        self.assertEqual(url1, url2)
+        self.assertTrue(url1.startswith('http://example.com/speech/'))
+        self.assertTrue(url1.endswith('.wav'))
+
+        url3 = yield self.cache.get_url('Hello', 'man', 'en')
+        self.assertEqual(url3, url1)
+        self.assertEqual(len(self.engine.requests), 1)
+
+        [filename] = os.listdir(self.directory)
+        self.assertEqual(url1, 'http://example.com/speech/%s' % filename)
+        with open(os.path.join(self.directory, filename)) as f:
+            self.assertEqual(f.read(), 'audio')
+
+    def test_get_url_keyed_by_voice_and_language(self):
+        """Different voices and languages are rendered separately"""
+        self.cache.get_url('Hello', 'man', 'en')
+        self.cache.get_url('Hello', 'woman', 'en')
+        self.cache.get_url('Hello', 'man', 'fr')
+        self.assertEqual(len(self.engine.requests), 3)
+
+    @inlineCallbacks
+    def test_get_url_failure(self):
+        """A rendering failure is given to everyone waiting on it, and
+        nothing is cached"""
+        d1 = self.cache.get_url('Hello', 'man', 'en')
+        d2 = self.cache.get_url('Hello', 'man', 'en')
+        [(_, render)] = self.engine.requests
+        render.errback(ValueError('engine down'))
+        yield self.assertFailure(d1, ValueError)
+        yield self.assertFailure(d2, ValueError)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        self.cache.get_url('Hello', 'man', 'en')
+        self.assertEqual(len(self.engine.requests), 2)
+
+    @inlineCallbacks
+    def test_resource_no_directory_listing(self):
+        """Rendered speech is served, but isn't listed when the directory is
+        requested"""
+        port = reactor.listenTCP(
+            0, Site(self.cache.resource()), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        base_url = 'http://127.0.0.1:%s' % port.getHost().port
+        self.cache.base_url = base_url
+        d = self.cache.get_url('Hello', 'man', 'en')
+        [(_, render)] = self.engine.requests
+        render.callback('audio')
+        url = yield d
+
+        response = yield treq.get(base_url + '/', persistent=False)
+        self.assertEqual(response.code, 404)
+        content = yield response.content()
+        self.assertNotIn(url.rsplit('/', 1)[-1], content)
+
+        response = yield treq.get(url, persistent=False)
+        self.assertEqual(response.code, 200)
+        content = yield response.content()
+        self.assertEqual(content, 'audio')
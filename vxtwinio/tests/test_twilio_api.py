@@ -4,19 +4,31 @@ from math import ceil
 from mock import Mock
 import re
 import treq
+import zlib
 from twilio import twiml
 from twilio.rest import TwilioRestClient
 from twilio.rest.exceptions import TwilioRestException
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, TimeoutError, fail, inlineCallbacks, returnValue)
+from twisted.internet.task import Clock, deferLater
 from twisted.internet.threads import deferToThread
 from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.http_headers import Headers
+from urlparse import urlparse
 from vumi.application.tests.helpers import ApplicationHelper
 from vumi.message import TransportUserMessage
 from vumi.tests.helpers import VumiTestCase
 import xml.etree.ElementTree as ET
 
 from .helpers import TwiMLServer
-from vxtwinio.twilio_api import TwilioAPIWorker, Response, ListResponse
+from vxtwinio.breaker import CircuitBreakers
+from vxtwinio.capture import CaptureWriter, read_capture
+from vxtwinio.media_cache import MediaCache
+from vxtwinio.twilio_api import (
+    ListResponse, Response, TwilioAPIUsageException, TwilioAPIWorker)
+from vxtwinio.twiml_engine import TwiMLProgram
 
 
 class TestTwiMLServer(VumiTestCase):
@@ -50,6 +62,8 @@ class TestTwilioAPIServer(VumiTestCase):
     @inlineCallbacks
     def setUp(self):
         self.twiml_server = yield self.add_helper(TwiMLServer())
+        self.clock = Clock()
+        self.patch(TwilioAPIWorker, 'clock', self.clock)
 
         self.app_helper = self.add_helper(ApplicationHelper(
             TwilioAPIWorker, use_riak=True, transport_type='voice'))
@@ -59,6 +73,9 @@ class TestTwilioAPIServer(VumiTestCase):
             'api_version': 'v1',
             'client_path': '%s' % self.twiml_server.url,
             'status_callback_path': '%s/callback.xml' % self.twiml_server.url,
+            'speech_cache_dir': self.mktemp(),
+            'cdr_log_path': self.mktemp(),
+            'call_queue_path': self.mktemp(),
         })
         addr = self.worker.webserver.getHost()
         self.url = 'http://%s:%s%s' % (addr.host, addr.port, '/api')
@@ -80,9 +97,16 @@ class TestTwilioAPIServer(VumiTestCase):
 
         self.patch(resource, "request", request)
 
-    def _server_request(self, path='', method='GET', data={}):
+    def _server_request(self, path='', method='GET', data={}, headers=None):
         url = '%s/v1/%s' % (self.url, path)
-        return treq.request(method, url, persistent=False, data=data)
+        return treq.request(
+            method, url, persistent=False, data=data, headers=headers)
+
+    def _raw_request(self, url, headers, method='GET'):
+        """Makes a request without treq's handling of gzip responses"""
+        agent = Agent(reactor, pool=HTTPConnectionPool(reactor, False))
+        return agent.request(method, url, Headers(dict(
+            (key, [value]) for key, value in headers.iteritems())))
 
     def _twilio_client_create_call(self, filename, *args, **kwargs):
         url = '%s/%s' % (self.twiml_server.url, filename)
@@ -95,6 +119,11 @@ class TestTwilioAPIServer(VumiTestCase):
         return deferToThread(
             self.client.calls.create, *args, url=url, **kwargs)
     
+    def _twilio_client_update_call(self, sid, **kwargs):
+        if kwargs.get('url'):
+            kwargs['url'] = '%s/%s' % (self.twiml_server.url, kwargs['url'])
+        return deferToThread(self.client.calls.update, sid, **kwargs)
+
     def _twilio_client_get_application_list(self, *args, **kwargs):
         return deferToThread(
             self.client.applications.list, *args, **kwargs)
@@ -224,11 +253,100 @@ class TestTwilioAPIServer(VumiTestCase):
 
     @inlineCallbacks
     def test_applications_root_with_client(self):
-        applications = yield self._twilio_client_get_application_list(friendly_name='test name')
-        [app] = applications
+        [app] = yield self._twilio_client_get_application_list()
         self.assertEqual(app.sid, 'test_account')
+        self.assertEqual(app.friendly_name, None)
+
+        created = yield deferToThread(
+            self.client.applications.create, friendly_name='test name')
+        applications = yield self._twilio_client_get_application_list(
+            friendly_name='test name')
+        [app] = applications
+        self.assertEqual(app.sid, created.sid)
         self.assertEqual(app.friendly_name, 'test name')
 
+    @inlineCallbacks
+    def test_applications_crud(self):
+        created = yield deferToThread(
+            self.client.applications.create, friendly_name='app',
+            voice_url='http://example.com/voice.xml', voice_method='GET',
+            voice_caller_id_lookup=True)
+        self.assertEqual(created.friendly_name, 'app')
+        self.assertEqual(created.voice_caller_id_lookup, True)
+
+        app = yield deferToThread(self.client.applications.get, created.sid)
+        self.assertEqual(app.voice_url, 'http://example.com/voice.xml')
+        self.assertEqual(app.voice_method, 'GET')
+
+        app = yield deferToThread(
+            self.client.applications.update, created.sid,
+            friendly_name='renamed')
+        self.assertEqual(app.friendly_name, 'renamed')
+        self.assertEqual(app.voice_method, 'GET')
+        app = yield deferToThread(self.client.applications.get, created.sid)
+        self.assertEqual(app.friendly_name, 'renamed')
+
+        applications = yield self._twilio_client_get_application_list()
+        self.assertEqual(
+            sorted(a.sid for a in applications),
+            sorted([created.sid, 'test_account']))
+
+        yield deferToThread(self.client.applications.delete, created.sid)
+        e = yield self.assertFailure(
+            deferToThread(self.client.applications.get, created.sid),
+            TwilioRestException)
+        self.assertEqual(e.status, 404)
+        [app] = yield self._twilio_client_get_application_list()
+        self.assertEqual(app.sid, 'test_account')
+
+    @inlineCallbacks
+    def test_applications_create_missing_friendly_name(self):
+        yield self.assert_parameter_missing(
+            'Accounts/test-account/Applications.json', method='POST', error={
+                'error_type': 'TwilioAPIUsageException',
+                'error_message':
+                    "Required field 'FriendlyName' not supplied",
+            })
+
+    @inlineCallbacks
+    def test_applications_cached(self):
+        """Responses are only formatted again once an Application changes,
+        and clients that already have them get a 304"""
+        response = yield self._server_request(
+            'Accounts/test-account/Applications.json')
+        etag = response.headers.getRawHeaders('etag')[0]
+        body = yield response.content()
+
+        self.worker.server._get_timestamp = Mock(return_value='changed')
+        response = yield self._server_request(
+            'Accounts/test-account/Applications.json')
+        self.assertEqual(response.headers.getRawHeaders('etag'), [etag])
+        self.assertEqual(
+            response.headers.getRawHeaders('content-type'),
+            ['application/json'])
+        content = yield response.content()
+        self.assertEqual(content, body)
+
+        response = yield treq.get(
+            '%s/v1/Accounts/test-account/Applications.json' % self.url,
+            headers={'If-None-Match': etag}, persistent=False)
+        self.assertEqual(response.code, 304)
+        content = yield response.content()
+        self.assertEqual(content, '')
+
+        yield self._server_request(
+            'Accounts/test-account/Applications/test-account.json',
+            method='POST', data={'FriendlyName': 'renamed'})
+        response = yield treq.get(
+            '%s/v1/Accounts/test-account/Applications.json' % self.url,
+            headers={'If-None-Match': etag}, persistent=False)
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers.getRawHeaders('etag'), [etag])
+        content = yield response.json()
+        [app] = content['applications']
+        self.assertEqual(app['friendly_name'], 'renamed')
+        self.assertEqual(app['date_updated'], 'changed')
+
     @inlineCallbacks
     def test_applications_root_xml(self):
         response = yield self._server_request(
@@ -313,6 +431,70 @@ class TestTwilioAPIServer(VumiTestCase):
                 }]
             })
 
+    @inlineCallbacks
+    def test_accept_header_format(self):
+        """The Accept header picks the format if the URL has no suffix"""
+        response = yield treq.get(
+            '%s/v1/Accounts/test-account/Applications' % self.url,
+            headers={'Accept': 'application/json'}, persistent=False)
+        self.assertEqual(
+            response.headers.getRawHeaders('content-type'),
+            ['application/json'])
+        content = yield response.json()
+        [app] = content['applications']
+        self.assertEqual(app['sid'], 'test-account')
+
+        response = yield treq.get(
+            '%s/v1/Accounts/test-account/Applications.xml' % self.url,
+            headers={'Accept': 'application/json'}, persistent=False)
+        self.assertEqual(
+            response.headers.getRawHeaders('content-type'),
+            ['application/xml'])
+
+    @inlineCallbacks
+    def test_compressed_response(self):
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, compression_min_size=100))
+        url = '%s/v1/Accounts/test-account/Applications.json' % self.url
+        response = yield self._raw_request(url, {'Accept-Encoding': 'gzip'})
+        self.assertEqual(
+            response.headers.getRawHeaders('content-encoding'), ['gzip'])
+        etag = response.headers.getRawHeaders('etag')[0]
+        self.assertTrue(etag.endswith('-gzip"'))
+        content = yield treq.content(response)
+        content = json.loads(zlib.decompress(content, 16 + zlib.MAX_WBITS))
+        [app] = content['applications']
+        self.assertEqual(app['sid'], 'test-account')
+
+        response = yield self._raw_request(
+            url, {'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+
+        response = yield self._raw_request(
+            url, {'Accept-Encoding': 'gzip;q=0.5, deflate'})
+        self.assertEqual(
+            response.headers.getRawHeaders('content-encoding'), ['deflate'])
+        content = yield treq.content(response)
+        content = json.loads(zlib.decompress(content))
+        self.assertEqual(len(content['applications']), 1)
+
+        stats = self.worker.server.compression_stats.summary()
+        route = stats['/Accounts/<string:account_sid>/Applications'
+                      '<string:format_>']
+        self.assertEqual(route['compressed'], 2)
+        self.assertTrue(route['bytes_saved'] > 0)
+
+    @inlineCallbacks
+    def test_compression_min_size(self):
+        """Small responses aren't compressed"""
+        response = yield self._raw_request(
+            '%s/v1/.json' % self.url, {'Accept-Encoding': 'gzip'})
+        self.assertEqual(
+            response.headers.getRawHeaders('content-encoding'), None)
+        yield treq.json_content(response)
+        stats = self.worker.server.compression_stats.summary()
+        self.assertEqual(stats['/<string:format_>']['compressed'], 0)
+
     @inlineCallbacks
     def test_make_call_sid(self):
         res = self.worker.server._get_sid()
@@ -468,6 +650,132 @@ class TestTwilioAPIServer(VumiTestCase):
             message['error_message'],
             "IfMachine value must be one of [None, 'Continue', 'Hangup']")
 
+    @inlineCallbacks
+    def test_make_call_timeout_invalid(self):
+        e = yield self.assertFailure(
+            self._twilio_client_create_call(
+                'default.xml', from_='+12345', to='+54321', timeout='foo'),
+            TwilioRestException)
+        self.assertEqual(e.status, 400)
+        message = json.loads(e.msg)
+        self.assertEqual(
+            message['error_message'],
+            "Timeout value must be a positive integer")
+
+    @inlineCallbacks
+    def test_make_call_ring_timeout(self):
+        """Calls that aren't answered in time are hung up, and the client is
+        told that there was no answer"""
+        self.twiml_server.add_response('callback.xml', twiml.Response())
+        yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321', timeout=30,
+            status_callback='callback.xml')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+
+        yield self.advance_timers(29)
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 1)
+        yield self.advance_timers(1)
+        [_, close] = self.app_helper.get_dispatched_outbound()
+        self.assertEqual(
+            close['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(close['to_addr'], '+54321')
+        [callback] = self.twiml_server.requests
+        self.assertEqual(callback['filename'], 'callback.xml')
+        self.assertEqual(
+            callback['request'].args['CallStatus'], ['no-answer'])
+        sessions = yield self.worker.session_manager.active_sessions()
+        self.assertEqual(len(sessions), 0)
+        session_id = yield self.worker.session_lookup.get_address(
+            msg['message_id'])
+        self.assertEqual(session_id, None)
+        timers = yield self.worker.scheduler.redis.zrange('timers', 0, -1)
+        self.assertEqual(timers, [])
+
+        # An ack that arrives after the call was given up is ignored
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        self.assertEqual(len(self.twiml_server.requests), 1)
+
+    @inlineCallbacks
+    def test_make_call_ring_timeout_default(self):
+        yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.advance_timers(59)
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 1)
+        yield self.advance_timers(1)
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 2)
+
+    @inlineCallbacks
+    def test_make_call_ack_cancels_ring_timeout(self):
+        self.twiml_server.add_response('default.xml', twiml.Response())
+        yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        session = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(session['RingTimer'], '')
+        [timer] = yield self.worker.scheduler.redis.zrange('timers', 0, -1)
+        self.assertEqual(timer, session['ExpiryTimer'])
+
+        yield self.advance_timers(60)
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 1)
+
+    @inlineCallbacks
+    def test_start_call_session_before_send(self):
+        """The session of a call exists by the time the call is sent, so an
+        ack that arrives straight away finds it"""
+        sent = []
+        send_to = self.worker.send_to
+
+        @inlineCallbacks
+        def check_send_to(to_addr, content, **kw):
+            session_id = yield self.worker.session_lookup.get_address(
+                kw['message_id'])
+            session = yield self.worker.session_manager.load_session(
+                session_id)
+            sent.append(session)
+            message = yield send_to(to_addr, content, **kw)
+            returnValue(message)
+
+        self.worker.send_to = check_send_to
+        yield self.worker.start_call({
+            'CallId': 'CA1', 'AccountSid': 'AC1', 'To': '+54321',
+            'From': '+12345', 'Timeout': 60, 'Status': 'queued',
+            'Direction': 'outbound-api'})
+        [session] = sent
+        self.assertEqual(session['CallId'], 'CA1')
+        self.assertNotEqual(session['RingTimer'], '')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        session_id = yield self.worker.session_lookup.get_address(
+            msg['message_id'])
+        self.assertEqual(session_id, '+54321')
+
+    @inlineCallbacks
+    def test_start_call_send_error(self):
+        """The session of a call that couldn't be sent is removed"""
+        self.worker.send_to = Mock(
+            side_effect=lambda *a, **kw: fail(ValueError('No route')))
+        d = self.worker.start_call({
+            'CallId': 'CA1', 'AccountSid': 'AC1', 'To': '+54321',
+            'From': '+12345', 'Timeout': 60, 'Status': 'queued',
+            'Direction': 'outbound-api'})
+        yield self.assertFailure(d, ValueError)
+        _, kw = self.worker.send_to.call_args
+        session = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(session, {})
+        session_id = yield self.worker.session_lookup.get_address(
+            kw['message_id'])
+        self.assertEqual(session_id, None)
+        session = yield self.worker.load_call('CA1')
+        self.assertEqual(session, None)
+        timers = yield self.worker.scheduler.redis.zrange('timers', 0, -1)
+        self.assertEqual(timers, [])
+        self.assertEqual(len(self.worker.scheduler), 0)
+
     @inlineCallbacks
     def test_make_call_ack_fallback_url(self):
         self.twiml_server.add_err('err.xml', 'Error response')
@@ -482,6 +790,174 @@ class TestTwilioAPIServer(VumiTestCase):
         self.assertEqual(req['filename'], 'default.xml')
         self.assertEqual(bad['filename'], 'err.xml')
 
+    @inlineCallbacks
+    def answer_call(self, filename, to, **kw):
+        """Makes an outbound call to the given TwiML, and answers it"""
+        yield self._twilio_client_create_call(
+            filename, from_='+12345', to=to, **kw)
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.app_helper.clear_dispatched_outbound()
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+
+    @inlineCallbacks
+    def test_circuit_breaker(self):
+        """Once enough TwiML requests to a client host fail, calls go
+        straight to their FallbackUrl until the host is probed again"""
+        breaker_clock = Clock()
+        self.worker.circuit_breakers = CircuitBreakers(
+            window=2, min_requests=2, reset_timeout=30, clock=breaker_clock)
+        self.twiml_server.add_err('err.xml', 'Error response')
+        self.twiml_server.add_response('default.xml', twiml.Response())
+        for to in ['+54321', '+54322', '+54323']:
+            yield self.answer_call('err.xml', to, fallback_url='default.xml')
+        self.assertEqual(
+            [req['filename'] for req in self.twiml_server.requests],
+            ['err.xml', 'default.xml', 'err.xml', 'default.xml',
+             'default.xml'])
+
+        response = yield self._server_request('CircuitBreakers.json')
+        [breaker] = (yield response.json())['circuit_breakers']
+        self.assertEqual(breaker['sid'], urlparse(self.twiml_server.url)[1])
+        self.assertEqual(breaker['state'], 'open')
+        self.assertEqual(breaker['failures'], 2)
+        self.assertEqual(breaker['short_circuited'], 1)
+        response = yield self._server_request('Health.json')
+        health = yield response.json()
+        self.assertEqual(health['circuit_breakers'], {
+            'closed': 0, 'open': 1, 'half_open': 0, 'short_circuited': 1})
+
+        # The client host has recovered by the time it is probed
+        self.twiml_server.add_response('err.xml', twiml.Response())
+        breaker_clock.advance(30)
+        yield self.answer_call('err.xml', '+54324', fallback_url='default.xml')
+        self.assertEqual(
+            self.twiml_server.requests[-1]['filename'], 'err.xml')
+        response = yield self._server_request(
+            'CircuitBreakers.json?State=open')
+        self.assertEqual((yield response.json())['circuit_breakers'], [])
+        response = yield self._server_request('CircuitBreakers?State=closed')
+        root = ET.fromstring((yield response.content()))
+        [state] = root.findall('./CircuitBreakers/CircuitBreaker/State')
+        self.assertEqual(state.text, 'closed')
+
+    @inlineCallbacks
+    def test_circuit_breaker_default_twiml(self):
+        """Calls without a FallbackUrl use the default TwiML when their
+        TwiML can't be fetched"""
+        self.worker.app_config = self.worker.CONFIG_CLASS(dict(
+            self.worker.config,
+            default_twiml='<Response><Play>default_url</Play></Response>'))
+        self.worker.circuit_breakers = CircuitBreakers(
+            min_requests=1, clock=self.clock)
+        self.twiml_server.add_err('err.xml', 'Error response')
+        for to in ['+54321', '+54322']:
+            yield self.answer_call('err.xml', to)
+            [play] = yield self.app_helper.wait_for_dispatched_outbound(1)
+            self.assertEqual(
+                play['helper_metadata']['voice']['speech_url'],
+                'default_url')
+            self.app_helper.clear_dispatched_outbound()
+        # The second call doesn't wait on the client
+        self.assertEqual(
+            [req['filename'] for req in self.twiml_server.requests],
+            ['err.xml'])
+
+    @inlineCallbacks
+    def test_circuit_breaker_request_error(self):
+        """TwiML requests that error count as failed, and the FallbackUrl
+        is used instead"""
+        http_request = self.worker._http_request
+
+        def refused_http_request(url, *args, **kw):
+            if url.endswith('down.xml'):
+                return fail(Exception('Connection refused'))
+            return http_request(url, *args, **kw)
+
+        self.patch(self.worker, '_http_request', refused_http_request)
+        self.twiml_server.add_response('default.xml', twiml.Response())
+        yield self.answer_call(
+            'down.xml', '+54321', fallback_url='default.xml')
+        [req] = self.twiml_server.requests
+        self.assertEqual(req['filename'], 'default.xml')
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+        breaker = self.worker.circuit_breakers.get(self.twiml_server.url)
+        self.assertEqual(breaker.status()['failures'], 1)
+
+    def open_circuit_breaker(self):
+        """Opens the circuit breaker of the TwiML server's host"""
+        self.worker.circuit_breakers = CircuitBreakers(
+            min_requests=1, clock=self.clock)
+        breaker = self.worker.circuit_breakers.get(self.twiml_server.url)
+        breaker.record(False, 0)
+        self.assertEqual(breaker.status()['state'], 'open')
+
+    @inlineCallbacks
+    def test_circuit_breaker_inbound_no_fallback(self):
+        """Inbound calls are hung up if their TwiML can't be fetched and
+        there is nothing to fall back to"""
+        self.twiml_server.add_response('callback.xml', twiml.Response())
+        self.open_circuit_breaker()
+        yield self.receive_call()
+        [close] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(
+            close['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(close['to_addr'], '+54321')
+        # Only the status callback reaches the client
+        [callback] = self.twiml_server.requests
+        self.assertEqual(callback['filename'], 'callback.xml')
+        self.assertEqual(
+            callback['request'].args['CallStatus'], ['completed'])
+        session = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(session, {})
+        self.assertEqual(self.worker._live_sessions, {})
+
+    @inlineCallbacks
+    def test_circuit_breaker_gather_action_no_fallback(self):
+        """Calls are hung up if the TwiML for the digits they gathered can't
+        be fetched"""
+        response = twiml.Response()
+        response.gather(action='reply.xml')
+        self.twiml_server.add_response('', response)
+        self.twiml_server.add_response('callback.xml', twiml.Response())
+        yield self.receive_call()
+        [gather] = yield self.app_helper.wait_for_dispatched_outbound(1)
+
+        self.open_circuit_breaker()
+        yield self.app_helper.dispatch_inbound(gather.reply('123'))
+        [_, close] = yield self.app_helper.wait_for_dispatched_outbound(2)
+        self.assertEqual(
+            close['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(
+            [req['filename'] for req in self.twiml_server.requests],
+            ['', 'callback.xml'])
+        session = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(session, {})
+
+    def test_circuit_breaker_request_timeout(self):
+        """TwiML requests that hang are given up on and count as failed, so
+        that a probe that hangs doesn't leave the breaker half-open"""
+        self.worker.circuit_breakers = CircuitBreakers(
+            min_requests=1, reset_timeout=30, clock=self.clock)
+        self.patch(
+            self.worker, '_http_request', lambda *args, **kw: Deferred())
+        url = self.twiml_server.url + 'hung.xml'
+        breaker = self.worker.circuit_breakers.get(url)
+
+        d = self.worker._fetch_twiml_from_client(url, 'POST', {})
+        self.clock.advance(4.9)
+        self.assertNoResult(d)
+        self.clock.advance(0.1)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(breaker.status()['state'], 'open')
+
+        self.clock.advance(30)
+        d = self.worker._fetch_twiml_from_client(url, 'POST', {})
+        self.assertEqual(breaker.status()['state'], 'half_open')
+        self.clock.advance(5)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(breaker.status()['state'], 'open')
+        self.assertEqual(len(self.flushLoggedErrors(TimeoutError)), 2)
+
     @inlineCallbacks
     def test_make_call_ack_response(self):
         response = twiml.Response()
@@ -494,6 +970,42 @@ class TestTwilioAPIServer(VumiTestCase):
         self.assertEqual(req['filename'], 'default.xml')
         self.assertEqual(req['request'].args['CallStatus'], ['in-progress'])
 
+    @inlineCallbacks
+    def test_make_call_capture(self):
+        """The call, the messages and events for it, and the TwiML fetched
+        for it are captured"""
+        path = self.mktemp()
+        self.worker.capture = CaptureWriter(path, clock=self.clock)
+        self.worker.capture.open()
+        response = twiml.Response()
+        response.play('test_url')
+        self.twiml_server.add_response('default.xml', response)
+        yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        ack = self.app_helper.make_ack(msg)
+        yield self.app_helper.dispatch_event(ack)
+        self.worker.capture.close()
+
+        [call, outbound, event, fetch, play] = list(read_capture(path))
+        self.assertEqual(call['type'], 'call')
+        self.assertEqual(call['fields']['To'], '+54321')
+        self.assertEqual(outbound['type'], 'outbound')
+        self.assertEqual(
+            outbound['message']['message_id'], msg['message_id'])
+        self.assertEqual(event['type'], 'event')
+        self.assertEqual(event['event'], ack.payload)
+        self.assertEqual(fetch['type'], 'twiml')
+        self.assertEqual(
+            fetch['url'], '%s/default.xml' % (self.twiml_server.url,))
+        self.assertEqual(fetch['method'], 'POST')
+        self.assertEqual(fetch['code'], 200)
+        self.assertEqual(fetch['body'], str(response))
+        self.assertEqual(play['type'], 'outbound')
+        self.assertEqual(
+            play['message']['helper_metadata']['voice']['speech_url'],
+            'test_url')
+
     @inlineCallbacks
     def test_make_call_nack_response(self):
         response = twiml.Response()
@@ -506,6 +1018,21 @@ class TestTwilioAPIServer(VumiTestCase):
         self.assertEqual(req['filename'], 'default.xml')
         self.assertEqual(req['request'].args['CallStatus'], ['failed'])
 
+    @inlineCallbacks
+    def test_make_call_duplicate_ack(self):
+        response = twiml.Response()
+        self.twiml_server.add_response('default.xml', response)
+        yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        [req] = self.twiml_server.requests
+        self.assertEqual(req['filename'], 'default.xml')
+        lookup = yield self.worker.session_lookup.get_address(
+            msg['message_id'])
+        self.assertEqual(lookup, None)
+
     @inlineCallbacks
     def test_make_call_parsing_play_verb(self):
         response = twiml.Response()
@@ -638,6 +1165,46 @@ class TestTwilioAPIServer(VumiTestCase):
         self.assertEqual(request['filename'], 'reply.xml')
         self.assertEqual(request['request'].method, 'GET')
 
+    @inlineCallbacks
+    def test_make_call_gather_falls_through_on_empty_action(self):
+        response = twiml.Response()
+        response.gather(action='reply.xml')
+        response.play('after_url')
+        self.twiml_server.add_response('default.xml', response)
+        self.twiml_server.add_response('reply.xml', twiml.Response())
+
+        yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        [_, rep] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.app_helper.dispatch_inbound(rep.reply('123'))
+        [_, _, play] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(
+            play['helper_metadata']['voice']['speech_url'], 'after_url')
+        [_, req] = self.twiml_server.requests
+        self.assertEqual(req['filename'], 'reply.xml')
+
+    @inlineCallbacks
+    def test_make_call_gather_action_replaces_document(self):
+        response = twiml.Response()
+        response.gather(action='reply.xml')
+        response.play('after_url')
+        self.twiml_server.add_response('default.xml', response)
+        response = twiml.Response()
+        response.hangup()
+        self.twiml_server.add_response('reply.xml', response)
+
+        yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        [_, rep] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.app_helper.dispatch_inbound(rep.reply('123'))
+        [_, _, hangup] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(
+            hangup['session_event'], TransportUserMessage.SESSION_CLOSE)
+
     @inlineCallbacks
     def test_receive_call(self):
         response = twiml.Response()
@@ -667,91 +1234,388 @@ class TestTwilioAPIServer(VumiTestCase):
         self.assertEqual(reply['in_reply_to'], msg['message_id'])
 
     @inlineCallbacks
-    def test_receive_call_parsing_hangup_verb(self):
+    def test_receive_call_parsing_play_verb_media_cache(self):
+        self.worker.media_cache = MediaCache(
+            self.mktemp(), 'http://localhost/media')
+        self.twiml_server.add_response('prompt.wav', 'audio')
         response = twiml.Response()
-        response.hangup()
+        response.play('%sprompt.wav' % self.twiml_server.url)
         self.twiml_server.add_response('', response)
 
         msg = self.app_helper.make_inbound(
-            '', from_addr='+54321', to_addr='+12345',
+            None, from_addr='+54321', to_addr='+12345',
             session_event=TransportUserMessage.SESSION_NEW)
         yield self.app_helper.dispatch_inbound(msg)
         [reply] = yield self.app_helper.wait_for_dispatched_outbound(1)
 
-        self.assertEqual(
-            reply['session_event'], TransportUserMessage.SESSION_CLOSE)
-        self.assertEqual(reply['in_reply_to'], msg['message_id'])
+        url = reply['helper_metadata']['voice']['speech_url']
+        self.assertTrue(url.startswith('http://localhost/media/'))
+        self.assertTrue(url.endswith('.wav'))
 
     @inlineCallbacks
-    def test_receive_call_parsing_gather_verb_defaults(self):
+    def test_receive_call_parsing_say_verb(self):
         response = twiml.Response()
-        response.gather()
+        response.say('Hello')
+        response.say('Hello')
         self.twiml_server.add_response('', response)
 
         msg = self.app_helper.make_inbound(
-            '', from_addr='+54321', to_addr='+12345',
+            None, from_addr='+54321', to_addr='+12345',
             session_event=TransportUserMessage.SESSION_NEW)
         yield self.app_helper.dispatch_inbound(msg)
-        [gather] = yield self.app_helper.wait_for_dispatched_outbound(1)
-        self.assertEqual(gather['helper_metadata']['voice']['wait_for'], '#')
-        self.assertEqual(gather['in_reply_to'], msg['message_id'])
+        [say1, say2] = yield self.app_helper.wait_for_dispatched_outbound(1)
+
+        url = say1['helper_metadata']['voice']['speech_url']
+        self.assertEqual(say2['helper_metadata']['voice']['speech_url'], url)
+        self.assertTrue(urlparse(url).path.startswith('/api/speech/'))
+        response = yield treq.get(url, persistent=False)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            response.headers.getRawHeaders('content-type'), ['audio/x-wav'])
+        content = yield response.content()
+        self.assertTrue(content.startswith('RIFF'))
 
     @inlineCallbacks
-    def test_receive_call_parsing_gather_verb_nondefaults(self):
+    def test_receive_call_parsing_gather_verb_with_say(self):
         response = twiml.Response()
-        response.gather(action='/test_url', method='GET', finishOnKey='*')
+        with response.gather() as g:
+            g.say('Press a key')
         self.twiml_server.add_response('', response)
 
         msg = self.app_helper.make_inbound(
-            '', from_addr='+54321', to_addr='+12345',
+            None, from_addr='+54321', to_addr='+12345',
             session_event=TransportUserMessage.SESSION_NEW)
         yield self.app_helper.dispatch_inbound(msg)
         [gather] = yield self.app_helper.wait_for_dispatched_outbound(1)
-        self.assertEqual(gather['helper_metadata']['voice']['wait_for'], '*')
-        session = yield self.worker.session_manager.load_session('+54321')
-        self.assertEqual(session['Gather_Method'], 'GET')
-        self.assertEqual(
-            session['Gather_Action'], self.twiml_server.url + 'test_url')
-        self.assertEqual(gather['in_reply_to'], msg['message_id'])
+        voice = gather['helper_metadata']['voice']
+        self.assertTrue(
+            urlparse(voice['speech_url']).path.startswith('/api/speech/'))
+        self.assertEqual(voice['wait_for'], '#')
+
+    def advance_timers(self, seconds):
+        """Moves the worker's clock forward, and waits for any timers that
+        are due to finish running"""
+        self.clock.advance(seconds)
+        return self.worker.scheduler.wait_for_running()
+
+    def receive_call(self):
+        msg = self.app_helper.make_inbound(
+            None, from_addr='+54321', to_addr='+12345',
+            session_event=TransportUserMessage.SESSION_NEW)
+        return self.app_helper.dispatch_inbound(msg)
 
     @inlineCallbacks
-    def test_receive_call_parsing_gather_verb_with_subverbs(self):
+    def test_receive_call_gather_timeout(self):
+        """The rest of the document is run if no digits arrive before the
+        Gather times out"""
         response = twiml.Response()
-        with response.gather() as g:
-            g.play('test_url')
-            g.play('test_url2')
+        response.gather(action='reply.xml', timeout=3)
+        response.play('after_url')
         self.twiml_server.add_response('', response)
 
-        msg = self.app_helper.make_inbound(
-            '', from_addr='+54231', to_addr='+12345',
-            session_event=TransportUserMessage.SESSION_NEW)
-        yield self.app_helper.dispatch_inbound(msg)
-        [gather1, gather2] = (
-            yield self.app_helper.wait_for_dispatched_outbound(1))
+        yield self.receive_call()
+        [gather] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(gather['helper_metadata']['voice']['wait_for'], '#')
+        yield self.advance_timers(2.9)
         self.assertEqual(
-            gather1['helper_metadata']['voice']['speech_url'], 'test_url')
+            len(self.app_helper.get_dispatched_outbound()), 1)
+        yield self.advance_timers(0.1)
+        [_, play, hangup] = yield self.app_helper.wait_for_dispatched_outbound(
+            3)
         self.assertEqual(
-            gather2['helper_metadata']['voice']['speech_url'], 'test_url2')
+            play['helper_metadata']['voice']['speech_url'], 'after_url')
+        self.assertEqual(play['to_addr'], '+54321')
+        self.assertEqual(play['from_addr'], '+12345')
+
+        # The call is hung up once the document runs out
         self.assertEqual(
-            gather2['helper_metadata']['voice']['wait_for'], '#')
+            hangup['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(hangup['to_addr'], '+54321')
+        session = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(session, {})
+
+        # Digits that arrive after the timeout are ignored
+        yield self.app_helper.dispatch_inbound(gather.reply('123'))
+        self.assertEqual(len(self.twiml_server.requests), 1)
 
     @inlineCallbacks
-    def test_receive_call_parsing_gather_verb_with_reply(self):
+    def test_receive_call_gather_prompt_allowance(self):
+        """A Gather with prompts is given extra time for them to play before
+        it times out, so that the caller has time to reply"""
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, gather_prompt_allowance=20))
         response = twiml.Response()
-        response.gather(action='reply.xml')
+        with response.gather(action='reply.xml') as g:
+            g.say('A long prompt')
+        response.play('after_url')
+        self.twiml_server.add_response('', response)
+
+        yield self.receive_call()
+        [gather] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.advance_timers(24.9)
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 1)
+        yield self.advance_timers(0.1)
+        [_, play, _] = yield self.app_helper.wait_for_dispatched_outbound(3)
+        self.assertEqual(
+            play['helper_metadata']['voice']['speech_url'], 'after_url')
+
+    @inlineCallbacks
+    def test_receive_call_gather_digits_cancel_timeout(self):
+        response = twiml.Response()
+        response.gather(action='reply.xml', timeout=3)
+        response.play('after_url')
         self.twiml_server.add_response('', response)
         response = twiml.Response()
-        response.play('test_url')
+        response.play('reply_url')
         self.twiml_server.add_response('reply.xml', response)
 
-        msg = self.app_helper.make_inbound(
-            '', from_addr='+54231', to_addr='+12345',
-            session_event=TransportUserMessage.SESSION_NEW)
-        yield self.app_helper.dispatch_inbound(msg)
-        [rep] = yield self.app_helper.wait_for_dispatched_outbound(1)
-        reply = rep.reply('123')
-        yield self.app_helper.dispatch_inbound(reply)
-        [_, play] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.receive_call()
+        [gather] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.app_helper.dispatch_inbound(gather.reply('123'))
+        [_, reply] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(
+            reply['helper_metadata']['voice']['speech_url'], 'reply_url')
+        session = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(session['Timer'], '')
+
+        yield self.advance_timers(3)
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 2)
+
+    @inlineCallbacks
+    def test_receive_call_parsing_pause_verb(self):
+        response = twiml.Response()
+        response.play('before_url')
+        response.pause(length=2)
+        response.play('after_url')
+        self.twiml_server.add_response('', response)
+
+        yield self.receive_call()
+        [before] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(
+            before['helper_metadata']['voice']['speech_url'], 'before_url')
+        yield self.advance_timers(1)
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 1)
+        yield self.advance_timers(1)
+        [_, after, _] = yield self.app_helper.wait_for_dispatched_outbound(3)
+        self.assertEqual(
+            after['helper_metadata']['voice']['speech_url'], 'after_url')
+        # Sent to the caller rather than to the number they called
+        self.assertEqual(after['to_addr'], '+54321')
+        self.assertEqual(after['from_addr'], '+12345')
+
+    @inlineCallbacks
+    def test_receive_call_expires(self):
+        """Calls that go on for too long are hung up"""
+        response = twiml.Response()
+        response.gather(timeout=0)
+        self.twiml_server.add_response('', response)
+
+        yield self.receive_call()
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.advance_timers(3600)
+        [_, hangup] = yield self.app_helper.wait_for_dispatched_outbound(2)
+        self.assertEqual(
+            hangup['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(hangup['to_addr'], '+54321')
+        session = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(session, {})
+
+    @inlineCallbacks
+    def test_hangup_cancels_timers(self):
+        response = twiml.Response()
+        response.hangup()
+        self.twiml_server.add_response('', response)
+
+        yield self.receive_call()
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+        timers = yield self.worker.scheduler.redis.zrange('timers', 0, -1)
+        self.assertEqual(timers, [])
+        self.assertEqual(len(self.worker.scheduler), 0)
+
+    @inlineCallbacks
+    def test_receive_call_parsing_redirect_verb(self):
+        response = twiml.Response()
+        response.redirect('first.xml')
+        self.twiml_server.add_response('', response)
+        response = twiml.Response()
+        response.redirect('second.xml', method='GET')
+        self.twiml_server.add_response('first.xml', response)
+        response = twiml.Response()
+        response.play('test_url')
+        self.twiml_server.add_response('second.xml', response)
+
+        yield self.receive_call()
+        [reply] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(
+            reply['helper_metadata']['voice']['speech_url'], 'test_url')
+        self.assertEqual(
+            [(r['filename'], r['request'].method)
+             for r in self.twiml_server.requests],
+            [('', 'POST'), ('first.xml', 'POST'), ('second.xml', 'GET')])
+        self.assertEqual(
+            self.twiml_server.requests[1]['request'].args['CallSid'],
+            self.twiml_server.requests[0]['request'].args['CallSid'])
+
+    @inlineCallbacks
+    def test_receive_call_redirect_chain_not_cached(self):
+        """Redirects are fetched for every call unless the cache is turned
+        on, since they may depend on the call"""
+        response = twiml.Response()
+        response.redirect('first.xml')
+        self.twiml_server.add_response('', response)
+        response = twiml.Response()
+        response.play('test_url')
+        self.twiml_server.add_response('first.xml', response)
+
+        yield self.receive_call()
+        yield self.receive_call()
+        self.assertEqual(
+            [r['filename'] for r in self.twiml_server.requests],
+            ['', 'first.xml', '', 'first.xml'])
+        self.assertEqual(len(self.worker.redirect_graph), 0)
+
+    @inlineCallbacks
+    def test_receive_call_redirect_chain_cached(self):
+        self.worker.redirect_graph.ttl = 60
+        response = twiml.Response()
+        response.redirect('first.xml')
+        self.twiml_server.add_response('', response)
+        response = twiml.Response()
+        response.redirect('second.xml')
+        self.twiml_server.add_response('first.xml', response)
+        response = twiml.Response()
+        response.play('test_url')
+        self.twiml_server.add_response('second.xml', response)
+
+        yield self.receive_call()
+        yield self.receive_call()
+        self.assertEqual(
+            [r['filename'] for r in self.twiml_server.requests],
+            ['', 'first.xml', 'second.xml', '', 'second.xml'])
+
+    @inlineCallbacks
+    def test_receive_call_redirect_loop(self):
+        response = twiml.Response()
+        response.play('test_url')
+        response.redirect('')
+        self.twiml_server.add_response('', response)
+
+        yield self.receive_call()
+        [play1, play2, hangup] = (
+            yield self.app_helper.wait_for_dispatched_outbound(1))
+        self.assertEqual(
+            hangup['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(len(self.twiml_server.requests), 2)
+        sessions = yield self.worker.session_manager.active_sessions()
+        self.assertEqual(sessions, [])
+
+    @inlineCallbacks
+    def test_receive_call_redirect_limit(self):
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, max_redirects=3))
+        for i in range(5):
+            response = twiml.Response()
+            response.play('test_url')
+            response.redirect('%s.xml' % (i + 1))
+            self.twiml_server.add_response(
+                '%s.xml' % i if i else '', response)
+
+        yield self.receive_call()
+        msgs = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(len(msgs), 5)
+        self.assertEqual(
+            msgs[-1]['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(len(self.twiml_server.requests), 4)
+
+    @inlineCallbacks
+    def test_receive_call_parsing_hangup_verb(self):
+        response = twiml.Response()
+        response.hangup()
+        self.twiml_server.add_response('', response)
+
+        msg = self.app_helper.make_inbound(
+            '', from_addr='+54321', to_addr='+12345',
+            session_event=TransportUserMessage.SESSION_NEW)
+        yield self.app_helper.dispatch_inbound(msg)
+        [reply] = yield self.app_helper.wait_for_dispatched_outbound(1)
+
+        self.assertEqual(
+            reply['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(reply['in_reply_to'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_receive_call_parsing_gather_verb_defaults(self):
+        response = twiml.Response()
+        response.gather()
+        self.twiml_server.add_response('', response)
+
+        msg = self.app_helper.make_inbound(
+            '', from_addr='+54321', to_addr='+12345',
+            session_event=TransportUserMessage.SESSION_NEW)
+        yield self.app_helper.dispatch_inbound(msg)
+        [gather] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(gather['helper_metadata']['voice']['wait_for'], '#')
+        self.assertEqual(gather['in_reply_to'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_receive_call_parsing_gather_verb_nondefaults(self):
+        response = twiml.Response()
+        response.gather(action='/test_url', method='GET', finishOnKey='*')
+        self.twiml_server.add_response('', response)
+
+        msg = self.app_helper.make_inbound(
+            '', from_addr='+54321', to_addr='+12345',
+            session_event=TransportUserMessage.SESSION_NEW)
+        yield self.app_helper.dispatch_inbound(msg)
+        [gather] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(gather['helper_metadata']['voice']['wait_for'], '*')
+        session = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(session['Gather_Method'], 'GET')
+        self.assertEqual(
+            session['Gather_Action'], self.twiml_server.url + 'test_url')
+        self.assertEqual(gather['in_reply_to'], msg['message_id'])
+
+    @inlineCallbacks
+    def test_receive_call_parsing_gather_verb_with_subverbs(self):
+        response = twiml.Response()
+        with response.gather() as g:
+            g.play('test_url')
+            g.play('test_url2')
+        self.twiml_server.add_response('', response)
+
+        msg = self.app_helper.make_inbound(
+            '', from_addr='+54231', to_addr='+12345',
+            session_event=TransportUserMessage.SESSION_NEW)
+        yield self.app_helper.dispatch_inbound(msg)
+        [gather1, gather2] = (
+            yield self.app_helper.wait_for_dispatched_outbound(1))
+        self.assertEqual(
+            gather1['helper_metadata']['voice']['speech_url'], 'test_url')
+        self.assertEqual(
+            gather2['helper_metadata']['voice']['speech_url'], 'test_url2')
+        self.assertEqual(
+            gather2['helper_metadata']['voice']['wait_for'], '#')
+
+    @inlineCallbacks
+    def test_receive_call_parsing_gather_verb_with_reply(self):
+        response = twiml.Response()
+        response.gather(action='reply.xml')
+        self.twiml_server.add_response('', response)
+        response = twiml.Response()
+        response.play('test_url')
+        self.twiml_server.add_response('reply.xml', response)
+
+        msg = self.app_helper.make_inbound(
+            '', from_addr='+54231', to_addr='+12345',
+            session_event=TransportUserMessage.SESSION_NEW)
+        yield self.app_helper.dispatch_inbound(msg)
+        [rep] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        reply = rep.reply('123')
+        yield self.app_helper.dispatch_inbound(reply)
+        [_, play] = yield self.app_helper.wait_for_dispatched_outbound(1)
         self.assertEqual(
             play['helper_metadata']['voice']['speech_url'], 'test_url')
         request = self.twiml_server.requests[-1]
@@ -820,6 +1684,775 @@ class TestTwilioAPIServer(VumiTestCase):
         sessions = yield self.worker.session_manager.active_sessions()
         self.assertEqual(len(sessions), 0)
 
+    def read_cdrs(self):
+        self.worker.cdr_writer.flush()
+        with open(self.worker.app_config.cdr_log_path) as f:
+            return [json.loads(line) for line in f]
+
+    @inlineCallbacks
+    def test_outgoing_call_cdr(self):
+        """A call detail record is kept for every call that ends"""
+        self.twiml_server.add_response('default.xml', twiml.Response())
+        self.twiml_server.add_response('callback.xml', twiml.Response())
+        call = yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321',
+            status_callback='callback.xml')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.clock.advance(5)
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        self.clock.advance(10)
+        msg = self.app_helper.make_inbound(
+            None, from_addr='+54321', to_addr='+12345',
+            session_event=TransportUserMessage.SESSION_CLOSE)
+        yield self.app_helper.dispatch_inbound(msg)
+
+        [cdr] = self.read_cdrs()
+        self.assertEqual(cdr['CallSid'], call.sid)
+        self.assertEqual(cdr['Status'], 'completed')
+        self.assertEqual(cdr['Direction'], 'outbound-api')
+        self.assertEqual(cdr['StartTime'], 0)
+        self.assertEqual(cdr['AnswerTime'], 5)
+        self.assertEqual(cdr['EndTime'], 15)
+        self.assertEqual(cdr['Duration'], 10)
+        callback = self.twiml_server.requests[-1]
+        self.assertEqual(callback['filename'], 'callback.xml')
+        self.assertEqual(callback['request'].args['CallDuration'], ['10'])
+
+    @inlineCallbacks
+    def test_hangup_cdr(self):
+        response = twiml.Response()
+        response.pause(length=3)
+        response.hangup()
+        self.twiml_server.add_response('', response)
+
+        yield self.receive_call()
+        yield self.advance_timers(3)
+        [cdr] = self.read_cdrs()
+        self.assertEqual(cdr['Status'], 'completed')
+        self.assertEqual(cdr['Direction'], 'inbound')
+        self.assertEqual(cdr['Duration'], 3)
+
+    @inlineCallbacks
+    def test_ring_timeout_cdr(self):
+        yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321', timeout=30)
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.advance_timers(30)
+        [cdr] = self.read_cdrs()
+        self.assertEqual(cdr['Status'], 'no-answer')
+        self.assertEqual(cdr['AnswerTime'], None)
+        self.assertEqual(cdr['Duration'], 0)
+
+    @inlineCallbacks
+    def start_call(self, response):
+        """Makes an outbound call to the given TwiML, and answers it"""
+        self.twiml_server.add_response('default.xml', response)
+        call = yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        returnValue(call)
+
+    def test_admin_not_served(self):
+        """The admin endpoints are only served if a port is set for them"""
+        self.assertEqual(self.worker.admin_webserver, None)
+
+    @inlineCallbacks
+    def test_latency(self):
+        """How long callers wait for prompts after answering and after
+        entering digits is tracked for each account"""
+        http_request = self.worker._http_request
+
+        def slow_http_request(*args, **kw):
+            self.clock.advance(0.5)
+            return http_request(*args, **kw)
+
+        self.patch(self.worker, '_http_request', slow_http_request)
+        response = twiml.Response()
+        response.play('first_url')
+        response.gather(action='reply.xml', timeout=10)
+        reply = twiml.Response()
+        reply.play('reply_url')
+        self.twiml_server.add_response('reply.xml', reply)
+        yield self.start_call(response)
+        [_, _, gather] = yield self.app_helper.wait_for_dispatched_outbound(3)
+        self.clock.advance(4)
+        yield self.app_helper.dispatch_inbound(gather.reply('123'))
+        yield self.app_helper.wait_for_dispatched_outbound(4)
+
+        response = yield self._server_request(
+            'Accounts/test_account/Latency.json')
+        self.assertEqual(response.code, 200)
+        latency = yield response.json()
+        self.assertEqual(latency['sid'], 'test_account')
+        self.assertEqual(latency['slow'], False)
+        first_prompt = latency['first_prompt']
+        self.assertEqual(first_prompt['count'], 1)
+        self.assertEqual(first_prompt['threshold'], 3)
+        self.assertEqual(first_prompt['mean'], 0.5)
+        self.assertEqual(first_prompt['twiml_fetch_share'], 1.0)
+        next_prompt = latency['next_prompt']
+        self.assertEqual(next_prompt['count'], 1)
+        self.assertEqual(next_prompt['mean'], 0.5)
+        self.assertEqual(next_prompt['slow'], 0)
+
+    @inlineCallbacks
+    def test_latency_inbound(self):
+        """Waits of inbound calls are kept for the host of the client, since
+        each call gets an account SID of its own"""
+        response = twiml.Response()
+        response.play('first_url')
+        self.twiml_server.add_response('', response)
+        for caller in ('+54321', '+11111'):
+            msg = self.app_helper.make_inbound(
+                None, from_addr=caller, to_addr='+12345',
+                session_event=TransportUserMessage.SESSION_NEW)
+            yield self.app_helper.dispatch_inbound(msg)
+        yield self.app_helper.wait_for_dispatched_outbound(2)
+
+        host = urlparse(self.twiml_server.url).netloc
+        self.assertEqual(self.worker.slo_tracker.accounts(), [host])
+        latency = self.worker.slo_tracker.account(host)
+        self.assertEqual(latency['metrics']['first_prompt']['count'], 2)
+
+    @inlineCallbacks
+    def test_latency_turn_without_prompt(self):
+        """Waits that last past the end of a turn aren't counted"""
+        response = twiml.Response()
+        response.pause(length=5)
+        response.play('after_url')
+        yield self.start_call(response)
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.advance_timers(5)
+        yield self.app_helper.wait_for_dispatched_outbound(2)
+        self.assertEqual(self.worker.slo_tracker.accounts(), [])
+        self.assertEqual(self.worker._prompt_waits, {})
+
+    @inlineCallbacks
+    def test_latencies(self):
+        slo_tracker = self.worker.slo_tracker
+        slo_tracker.min_samples = 1
+        slo_tracker.record('AC1', 'first_prompt', 10)
+        slo_tracker.record('AC2', 'first_prompt', 0.1)
+
+        response = yield self._server_request('Latency.json')
+        latencies = yield response.json()
+        self.assertEqual(latencies['total'], 2)
+        [slow, fast] = latencies['latencies']
+        self.assertEqual((slow['sid'], slow['slow']), ('AC1', True))
+        self.assertEqual((fast['sid'], fast['slow']), ('AC2', False))
+
+        response = yield self._server_request('Latency?Slow=true')
+        root = ET.fromstring((yield response.content()))
+        [latency] = root.findall('./Latencies/Latency')
+        self.assertEqual(latency.find('Sid').text, 'AC1')
+        self.assertEqual(latency.find('FirstPrompt/Slow').text, '1')
+
+    @inlineCallbacks
+    def test_modify_call_redirect(self):
+        response = twiml.Response()
+        response.gather(action='reply.xml', timeout=10)
+        call = yield self.start_call(response)
+        response = twiml.Response()
+        response.play('redirect_url')
+        self.twiml_server.add_response('redirect.xml', response)
+
+        updated = yield self._twilio_client_update_call(
+            call.sid, url='redirect.xml', method='GET')
+        self.assertEqual(updated.sid, call.sid)
+        self.assertEqual(updated.status, 'in-progress')
+        [_, _, play] = yield self.app_helper.wait_for_dispatched_outbound(3)
+        self.assertEqual(
+            play['helper_metadata']['voice']['speech_url'], 'redirect_url')
+        request = self.twiml_server.requests[-1]
+        self.assertEqual(request['filename'], 'redirect.xml')
+        self.assertEqual(request['request'].method, 'GET')
+
+        # The Gather that was interrupted no longer applies
+        session = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(session['Gather_Action'], '')
+        self.assertEqual(session['Timer'], '')
+        yield self.advance_timers(10)
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 3)
+
+    @inlineCallbacks
+    def test_modify_call_redirect_inbound(self):
+        """Prompts for a redirected inbound call are sent to the caller"""
+        response = twiml.Response()
+        response.gather(action='reply.xml')
+        self.twiml_server.add_response('', response)
+        response = twiml.Response()
+        response.play('redirect_url')
+        self.twiml_server.add_response('redirect.xml', response)
+        yield self.receive_call()
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+        session = yield self.worker.session_manager.load_session('+54321')
+        session = yield self.worker.load_call(session['CallId'])
+
+        yield self.worker.modify_call(
+            session, self.twiml_server.url + 'redirect.xml')
+        [_, play] = yield self.app_helper.wait_for_dispatched_outbound(2)
+        self.assertEqual(
+            play['helper_metadata']['voice']['speech_url'], 'redirect_url')
+        self.assertEqual(play['to_addr'], '+54321')
+        self.assertEqual(play['from_addr'], '+12345')
+
+    @inlineCallbacks
+    def test_modify_call_redirect_queued(self):
+        """Queued calls use the new URL once they're answered"""
+        self.twiml_server.add_response('default.xml', twiml.Response())
+        response = twiml.Response()
+        response.play('redirect_url')
+        self.twiml_server.add_response('redirect.xml', response)
+        call = yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+
+        updated = yield self._twilio_client_update_call(
+            call.sid, url='redirect.xml')
+        self.assertEqual(updated.status, 'queued')
+        self.assertEqual(self.twiml_server.requests, [])
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        [_, play] = yield self.app_helper.wait_for_dispatched_outbound(2)
+        self.assertEqual(
+            play['helper_metadata']['voice']['speech_url'], 'redirect_url')
+
+    @inlineCallbacks
+    def test_modify_call_hangup(self):
+        response = twiml.Response()
+        response.gather()
+        call = yield self.start_call(response)
+
+        updated = yield deferToThread(self.client.calls.hangup, call.sid)
+        self.assertEqual(updated.status, 'completed')
+        [_, _, close] = yield self.app_helper.wait_for_dispatched_outbound(3)
+        self.assertEqual(
+            close['session_event'], TransportUserMessage.SESSION_CLOSE)
+        sessions = yield self.worker.session_manager.active_sessions()
+        self.assertEqual(len(sessions), 0)
+        session_id = yield self.worker.call_index.get_address(call.sid)
+        self.assertEqual(session_id, None)
+
+    @inlineCallbacks
+    def test_modify_call_cancel(self):
+        """Canceling only ends calls that haven't been answered"""
+        call = yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+        updated = yield deferToThread(self.client.calls.cancel, call.sid)
+        self.assertEqual(updated.status, 'canceled')
+        [_, close] = yield self.app_helper.wait_for_dispatched_outbound(2)
+        self.assertEqual(
+            close['session_event'], TransportUserMessage.SESSION_CLOSE)
+
+        self.app_helper.clear_all_dispatched()
+        response = twiml.Response()
+        response.gather()
+        call = yield self.start_call(response)
+        updated = yield deferToThread(self.client.calls.cancel, call.sid)
+        self.assertEqual(updated.status, 'in-progress')
+        self.assertEqual(
+            len(self.app_helper.get_dispatched_outbound()), 2)
+
+    @inlineCallbacks
+    def test_modify_call_not_found(self):
+        e = yield self.assertFailure(
+            deferToThread(self.client.calls.hangup, 'CA-unknown'),
+            TwilioRestException)
+        self.assertEqual(e.status, 404)
+        message = json.loads(e.msg)
+        self.assertEqual(
+            message['error_type'], 'TwilioAPINotFoundException')
+        self.assertEqual(
+            message['error_message'], 'Call CA-unknown not found')
+
+        # Calls are only found through the account they belong to
+        call = yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        response = yield self._server_request(
+            'Accounts/other/Calls/%s.json' % call.sid, method='POST',
+            data={'Status': 'completed'})
+        self.assertEqual(response.code, 404)
+
+    @inlineCallbacks
+    def test_modify_call_invalid(self):
+        call = yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        url = 'Accounts/test_account/Calls/%s.json' % call.sid
+        yield self.assert_parameter_missing(
+            url, method='POST', error={
+                'error_type': 'TwilioAPIUsageException',
+                'error_message':
+                    "Request must have an 'Url' or a 'Status' field",
+            })
+        yield self.assert_parameter_missing(
+            url, method='POST', data={'Status': 'busy'}, error={
+                'error_type': 'TwilioAPIUsageException',
+                'error_message':
+                    "Status value must be one of ['canceled', 'completed']",
+            })
+
+    @inlineCallbacks
+    def publish_queued_calls(self):
+        """Moves the worker's clock on to the next send of queued calls, and
+        waits for it to finish"""
+        self.clock.advance(self.worker.app_config.call_publish_interval)
+        yield self.worker._publishing
+
+    @inlineCallbacks
+    def test_make_call_async(self):
+        """Calls are queued and accepted straight away, and started in the
+        background"""
+        self.twiml_server.add_response('default.xml', twiml.Response())
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, async_make_call=True))
+        response = yield self._server_request(
+            'Accounts/test-account/Calls.json', method='POST', data={
+                'To': '+54321',
+                'From': '+12345',
+                'Url': '%s/default.xml' % (self.twiml_server.url,),
+            })
+        self.assertEqual(response.code, 202)
+        call = yield response.json()
+        self.assertEqual(call['status'], 'queued')
+        self.assertEqual(self.app_helper.get_dispatched_outbound(), [])
+        self.assertEqual(len(self.worker.call_queue), 1)
+
+        url = 'Accounts/test-account/Calls/%s.json' % (call['sid'],)
+        response = yield self._server_request(url)
+        self.assertEqual(response.code, 200)
+        queued = yield response.json()
+        self.assertEqual(queued['sid'], call['sid'])
+        self.assertEqual(queued['status'], 'queued')
+
+        yield self.publish_queued_calls()
+        [msg] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(msg['to_addr'], '+54321')
+        self.assertEqual(msg['from_addr'], '+12345')
+        self.assertEqual(len(self.worker.call_queue), 0)
+        session = yield self.worker.load_call(call['sid'])
+        self.assertEqual(session['Status'], 'queued')
+        self.assertNotEqual(session['RingTimer'], '')
+
+        response = yield self._server_request(url)
+        self.assertEqual(response.code, 200)
+        started = yield response.json()
+        self.assertEqual(started['sid'], call['sid'])
+
+        yield self.app_helper.dispatch_event(self.app_helper.make_ack(msg))
+        response = yield self._server_request(url)
+        started = yield response.json()
+        self.assertEqual(started['status'], 'in-progress')
+
+    @inlineCallbacks
+    def test_make_call_async_start_failure(self):
+        """Calls that can't be started stay queued until the next send"""
+        self.twiml_server.add_response('default.xml', twiml.Response())
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, async_make_call=True))
+        response = yield self._server_request(
+            'Accounts/test-account/Calls.json', method='POST', data={
+                'To': '+54321',
+                'From': '+12345',
+                'Url': '%s/default.xml' % (self.twiml_server.url,),
+            })
+        call = yield response.json()
+
+        start_call = self.worker.start_call
+        self.worker.start_call = Mock(
+            side_effect=lambda fields: fail(Exception('broker down')))
+        yield self.publish_queued_calls()
+        [err] = self.flushLoggedErrors(Exception)
+        self.assertEqual(err.getErrorMessage(), 'broker down')
+        self.assertEqual(len(self.worker.call_queue), 1)
+
+        self.worker.start_call = start_call
+        yield self.publish_queued_calls()
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(len(self.worker.call_queue), 0)
+        session = yield self.worker.load_call(call['sid'])
+        self.assertEqual(session['CallId'], call['sid'])
+
+    def make_call_request(self, idempotency_key, to='+54321'):
+        return self._server_request(
+            'Accounts/test-account/Calls.json', method='POST', data={
+                'To': to,
+                'From': '+12345',
+                'Url': '%s/default.xml' % (self.twiml_server.url,),
+            }, headers={'Idempotency-Key': idempotency_key})
+
+    @inlineCallbacks
+    def test_make_call_idempotency_key(self):
+        """Retried requests get the original call back, without another call
+        being made"""
+        response = yield self.make_call_request('retry-1')
+        self.assertEqual(response.code, 200)
+        call = yield response.json()
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+
+        response = yield self.make_call_request('retry-1')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            response.headers.getRawHeaders('idempotent-replayed'), ['true'])
+        replayed = yield response.json()
+        self.assertEqual(replayed, call)
+        self.assertEqual(len(self.app_helper.get_dispatched_outbound()), 1)
+
+        # Other keys make new calls
+        response = yield self.make_call_request('retry-2')
+        other = yield response.json()
+        self.assertNotEqual(other['sid'], call['sid'])
+        yield self.app_helper.wait_for_dispatched_outbound(2)
+
+    @inlineCallbacks
+    def test_make_call_idempotency_key_async(self):
+        """Replays of queued calls keep the 202 response code"""
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, async_make_call=True))
+        response = yield self.make_call_request('retry-1')
+        self.assertEqual(response.code, 202)
+        call = yield response.json()
+        response = yield self.make_call_request('retry-1')
+        self.assertEqual(response.code, 202)
+        replayed = yield response.json()
+        self.assertEqual(replayed['sid'], call['sid'])
+        self.assertEqual(len(self.worker.call_queue), 1)
+
+    @inlineCallbacks
+    def test_make_call_idempotency_key_mismatch(self):
+        yield self.make_call_request('retry-1')
+        response = yield self.make_call_request('retry-1', to='+11111')
+        self.assertEqual(response.code, 400)
+        error = yield response.json()
+        self.assertEqual(
+            error['error_message'],
+            'Idempotency-Key retry-1 was used for a request with different '
+            'parameters')
+
+    @inlineCallbacks
+    def test_make_call_idempotency_key_in_progress(self):
+        """Requests made while the first request with the key is still
+        running are rejected"""
+        started = Deferred()
+        self.worker.start_call = Mock(side_effect=lambda fields: started)
+        first = self.make_call_request('retry-1')
+        while not self.worker.start_call.called:
+            yield deferLater(reactor, 0.01, lambda: None)
+
+        response = yield self.make_call_request('retry-1')
+        self.assertEqual(response.code, 409)
+        error = yield response.json()
+        self.assertEqual(
+            error['error_message'],
+            'A request with Idempotency-Key retry-1 is in progress')
+
+        started.callback(None)
+        response = yield first
+        self.assertEqual(response.code, 200)
+        call = yield response.json()
+        response = yield self.make_call_request('retry-1')
+        replayed = yield response.json()
+        self.assertEqual(replayed['sid'], call['sid'])
+
+    @inlineCallbacks
+    def test_make_call_idempotency_key_failure(self):
+        """Requests that fail can be retried with the same key"""
+        start_call = self.worker.start_call
+        self.worker.start_call = Mock(
+            side_effect=lambda fields: fail(Exception('broker down')))
+        response = yield self.make_call_request('retry-1')
+        self.assertEqual(response.code, 500)
+        self.flushLoggedErrors(Exception)
+
+        self.worker.start_call = start_call
+        response = yield self.make_call_request('retry-1')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            response.headers.getRawHeaders('idempotent-replayed'), None)
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+
+    @inlineCallbacks
+    def test_make_call_overloaded(self):
+        """Calls are turned away while too many are waiting to be sent"""
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, async_make_call=True))
+        self.worker.load_shedder.set_maximum('pending_calls', 1)
+        response = yield self.make_call_request('call-1')
+        self.assertEqual(response.code, 202)
+
+        response = yield self.make_call_request('call-2')
+        self.assertEqual(response.code, 503)
+        error = yield response.json()
+        self.assertEqual(
+            error['error_type'], 'TwilioAPIOverloadedException')
+        self.assertEqual(
+            error['error_message'],
+            'Too many calls in progress, try again later')
+        self.assertEqual(len(self.worker.call_queue), 1)
+
+        # The rejected request can be retried with the same key
+        yield self.publish_queued_calls()
+        response = yield self.make_call_request('call-2')
+        self.assertEqual(response.code, 202)
+
+    @inlineCallbacks
+    def test_pending_calls_starting(self):
+        """Queued calls that are being started are only counted once"""
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, async_make_call=True))
+        yield self.make_call_request('call-1')
+        yield self.make_call_request('call-2')
+        self.assertEqual(self.worker._pending_calls(), 2)
+
+        sending = Deferred()
+        self.worker.send_to = Mock(side_effect=lambda *a, **kw: sending)
+        self.clock.advance(self.worker.app_config.call_publish_interval)
+        while self.worker.send_to.call_count < 2:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.assertEqual(self.worker._pending_calls(), 2)
+
+        sending.callback(None)
+        yield self.worker._publishing
+        self.assertEqual(self.worker._pending_calls(), 0)
+
+    @inlineCallbacks
+    def test_receive_call_overloaded(self):
+        """Inbound calls are hung up straight away while too many calls are
+        live"""
+        self.worker.load_shedder.set_maximum('live_sessions', 1)
+        response = twiml.Response()
+        response.gather(action='reply.xml', timeout=10)
+        yield self.start_call(response)
+        yield self.app_helper.wait_for_dispatched_outbound(2)
+        self.app_helper.clear_dispatched_outbound()
+
+        msg = self.app_helper.make_inbound(
+            None, from_addr='+11111', to_addr='+12345',
+            session_event=TransportUserMessage.SESSION_NEW)
+        yield self.app_helper.dispatch_inbound(msg)
+        [close] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(
+            close['session_event'], TransportUserMessage.SESSION_CLOSE)
+        self.assertEqual(close['in_reply_to'], msg['message_id'])
+        session = yield self.worker.session_manager.load_session('+11111')
+        self.assertEqual(session, {})
+        self.assertEqual(
+            self.worker.load_shedder.rejected, {'inbound': 1})
+
+    @inlineCallbacks
+    def test_health(self):
+        self.worker.load_shedder.set_maximum('live_sessions', 2)
+        response = yield self._server_request('Health.json')
+        self.assertEqual(response.code, 200)
+        health = yield response.json()
+        self.assertEqual(health['overloaded'], False)
+        self.assertEqual(health['limits']['live_sessions'], {
+            'in_use': 0, 'limit': 2, 'utilisation': 0.0})
+        self.assertEqual(health['limits']['twiml_fetches'], {
+            'in_use': 0, 'limit': 0, 'utilisation': 0.0})
+
+        response = twiml.Response()
+        response.gather(action='reply.xml', timeout=10)
+        yield self.start_call(response)
+        yield self.app_helper.wait_for_dispatched_outbound(2)
+        response = yield self._server_request('Health.json')
+        health = yield response.json()
+        self.assertEqual(health['limits']['live_sessions'], {
+            'in_use': 1, 'limit': 2, 'utilisation': 0.5})
+        # The fetch of the call's TwiML has finished
+        self.assertEqual(health['limits']['twiml_fetches']['in_use'], 0)
+
+        self.worker.load_shedder.set_maximum('live_sessions', 1)
+        response = yield self._server_request('Health')
+        self.assertEqual(response.code, 503)
+        root = ET.fromstring((yield response.content()))
+        self.assertEqual(root.find('Health/Overloaded').text, 'True')
+
+    @inlineCallbacks
+    def test_prune_live_sessions(self):
+        """Calls that ended without this worker being told stop counting as
+        live"""
+        response = twiml.Response()
+        response.gather(action='reply.xml')
+        self.twiml_server.add_response('', response)
+        for caller in ('+54321', '+11111', '+22222'):
+            msg = self.app_helper.make_inbound(
+                None, from_addr=caller, to_addr='+12345',
+                session_event=TransportUserMessage.SESSION_NEW)
+            yield self.app_helper.dispatch_inbound(msg)
+        self.assertEqual(len(self.worker._live_sessions), 3)
+        self.assertTrue(self.worker._live_session_pruner.running)
+
+        # Hung up elsewhere, and replaced by a call on another worker
+        yield self.worker.session_manager.clear_session('+54321')
+        yield self.worker.session_manager.create_call_session(
+            '+11111', CallId='CA2')
+        yield self.worker._prune_live_sessions()
+        self.assertEqual(self.worker._live_sessions.keys(), ['+22222'])
+
+    @inlineCallbacks
+    def test_drain_rejects_new_calls(self):
+        yield self.worker.drain()
+        response = yield self.make_call_request('call-1')
+        self.assertEqual(response.code, 503)
+        error = yield response.json()
+        self.assertEqual(
+            error['error_message'], 'Not accepting new calls, try again later')
+
+        yield self.receive_call()
+        [close] = yield self.app_helper.wait_for_dispatched_outbound(1)
+        self.assertEqual(
+            close['session_event'], TransportUserMessage.SESSION_CLOSE)
+
+        response = yield self._server_request('Health.json')
+        self.assertEqual(response.code, 503)
+        health = yield response.json()
+        self.assertEqual(health['overloaded'], True)
+
+    @inlineCallbacks
+    def test_drain_publishes_queued_calls(self):
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, async_make_call=True))
+        yield self.make_call_request('call-1')
+        yield self.make_call_request('call-2')
+        yield self.worker.drain()
+        self.assertEqual(len(self.worker.call_queue), 0)
+        yield self.app_helper.wait_for_dispatched_outbound(2)
+
+    @inlineCallbacks
+    def test_drain_waits_for_status_callbacks(self):
+        session = yield self.worker._create_call_session(
+            '+54321', CallId='CA1', AccountSid='AC1', From='+12345',
+            To='+54321', Status='completed', Direction='inbound',
+            StatusCallback='callback.xml', StatusCallbackMethod='POST')
+        request = Deferred()
+        self.worker._http_request = Mock(return_value=request)
+        self.worker._send_status_callback(session)
+
+        drained = self.worker.drain()
+        self.assertNoResult(drained)
+        request.callback(None)
+        yield drained
+
+    @inlineCallbacks
+    def test_drain_waits_for_gather_action(self):
+        """Draining waits for the TwiML of a Gather's digits to be fetched
+        and run"""
+        response = twiml.Response()
+        response.gather(action='reply.xml')
+        response.play('after_url')
+        self.twiml_server.add_response('', response)
+        yield self.receive_call()
+        [gather] = yield self.app_helper.wait_for_dispatched_outbound(1)
+
+        fetched = Deferred()
+        self.worker._get_program_from_client = Mock(return_value=fetched)
+        handled = self.worker.consume_user_message(gather.reply('123'))
+        while not self.worker._get_program_from_client.called:
+            yield deferLater(reactor, 0.01, lambda: None)
+        self.assertTrue(len(self.worker.in_flight) > 0)
+        drained = self.worker.drain()
+        self.assertNoResult(drained)
+
+        fetched.callback(TwiMLProgram())
+        yield handled
+        yield drained
+        [_, play] = self.app_helper.get_dispatched_outbound()
+        self.assertEqual(
+            play['helper_metadata']['voice']['speech_url'], 'after_url')
+
+    @inlineCallbacks
+    def test_drain_timeout(self):
+        """Turns that don't finish in time have their progress written, so
+        that the call can be resumed"""
+        session = yield self.worker._create_call_session(
+            '+54321', CallId='CA1', AccountSid='AC1', From='+12345',
+            To='+54321', Status='in-progress', Direction='inbound',
+            Url='default.xml', Method='POST')
+        self.worker._get_program_from_client = Mock(return_value=Deferred())
+        self.worker._run_turn(session)
+        session['PC'] = 3
+
+        drained = self.worker.drain()
+        self.clock.advance(self.worker.app_config.drain_timeout - 1)
+        self.assertNoResult(drained)
+        self.clock.advance(1)
+        yield drained
+        stored = yield self.worker.session_manager.load_session('+54321')
+        self.assertEqual(stored['PC'], '3')
+
+    @inlineCallbacks
+    def test_ready(self):
+        response = yield self._server_request('Ready.json')
+        self.assertEqual(response.code, 200)
+        readiness = yield response.json()
+        self.assertEqual(readiness['ready'], True)
+        self.assertEqual(
+            sorted(readiness['startup_times']),
+            ['call_queue', 'media_cache', 'redis', 'total', 'web'])
+
+        yield self.worker.drain()
+        response = yield self._server_request('Ready')
+        self.assertEqual(response.code, 503)
+        root = ET.fromstring((yield response.content()))
+        self.assertEqual(root.find('Readiness/Ready').text, 'False')
+
+    def test_load_media_cache(self):
+        self.assertEqual(self.worker._load_media_cache(), None)
+        self.worker.app_config = self.worker.CONFIG_CLASS(
+            dict(self.worker.config, media_cache_dir=self.mktemp()))
+        self.assertTrue(
+            isinstance(self.worker._load_media_cache(), MediaCache))
+
+    @inlineCallbacks
+    def test_config_cache(self):
+        """The config is only resolved once for calls to the same number"""
+        response = twiml.Response()
+        response.hangup()
+        self.twiml_server.add_response('', response)
+        yield self.receive_call()
+        yield self.app_helper.wait_for_dispatched_outbound(1)
+        yield self.receive_call()
+        yield self.app_helper.wait_for_dispatched_outbound(2)
+        self.assertEqual(self.worker.config_cache.builds, 1)
+        self.assertEqual(self.worker.config_cache.hits, 1)
+
+        response = yield self._server_request('Health.json')
+        health = yield response.json()
+        self.assertEqual(health['config_cache'], {
+            'entries': 1,
+            'hits': 1,
+            'builds': 1,
+            'expired': 0,
+            'invalidated': 0,
+        })
+
+    @inlineCallbacks
+    def test_make_call_idempotency_key_failure_error(self):
+        """The error of a request that fails is returned once its key is
+        released"""
+        self.worker.start_call = Mock(side_effect=lambda fields: fail(
+            TwilioAPIUsageException('No route to the transport', 'json')))
+        response = yield self.make_call_request('retry-1')
+        self.assertEqual(response.code, 400)
+        error = yield response.json()
+        self.assertEqual(error['error_message'], 'No route to the transport')
+
+    @inlineCallbacks
+    def test_get_call_not_found(self):
+        response = yield self._server_request(
+            'Accounts/test-account/Calls/CA-unknown.json')
+        self.assertEqual(response.code, 404)
+        error = yield response.json()
+        self.assertEqual(error['error_message'], 'Call CA-unknown not found')
+
+        call = yield self._twilio_client_create_call(
+            'default.xml', from_='+12345', to='+54321')
+        response = yield self._server_request(
+            'Accounts/other/Calls/%s.json' % (call.sid,))
+        self.assertEqual(response.code, 404)
+
 
 class TestResponseFormatting(TestCase):
 
@@ -1003,6 +2636,15 @@ class TestListResponse(TestCase):
         self.assertEqual(i.tag, 'Sid')
         self.assertEqual(i.text, '2')
 
+    def test_format_json_aftersid_past_end(self):
+        """An AfterSid after every item gives an empty page"""
+        o = ListResponse([Response(Sid=str(i)) for i in range(3)])
+        response = json.loads(
+            o.format_json('test_url', pagesize=2, aftersid='9'))
+        self.assertEqual(response['start'], 3)
+        self.assertEqual(response['end'], 3)
+        self.assertEqual(response['list_response'], [])
+
     def test_format_xml_maximum_pages(self):
         o = ListResponse([Response(Sid=str(i)) for i in range(1001)])
         xml = o.format_xml('test_url', pagesize=1001)
@@ -0,0 +1,164 @@
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twilio import twiml
+
+from vxtwinio.twiml_engine import (
+    RedirectGraph, TwiMLProgram, TwiMLCompiler, TwiMLCompileError)
+from vxtwinio.twiml_parser import TwiMLParser, Verb
+
+
+class TestTwiMLProgram(TestCase):
+    def setUp(self):
+        self.parser = TwiMLParser('http://example.com/twiml.xml')
+        self.response = twiml.Response()
+
+    def compile(self):
+        return TwiMLProgram.compile(self.parser.parse(str(self.response)))
+
+    def test_compile_empty(self):
+        """An empty document compiles to an empty program"""
+        program = self.compile()
+        self.assertEqual(len(program), 0)
+        self.assertEqual(program.instructions, [])
+
+    def test_compile_play(self):
+        self.response.play('test_url')
+        program = self.compile()
+        self.assertEqual(program.instructions, [['play', 'test_url']])
+
+    def test_compile_say(self):
+        self.response.say('Hello', voice='woman', language='fr')
+        program = self.compile()
+        self.assertEqual(
+            program.instructions, [['say', 'Hello', 'woman', 'fr']])
+
+    def test_compile_say_loop(self):
+        """Prompts are repeated as many times as their loop asks for"""
+        self.response.say('Hello', loop=2)
+        self.response.play('test_url', loop=3)
+        program = self.compile()
+        self.assertEqual(program.instructions, [
+            ['say', 'Hello', 'man', 'en'],
+            ['say', 'Hello', 'man', 'en'],
+            ['play', 'test_url'],
+            ['play', 'test_url'],
+            ['play', 'test_url'],
+        ])
+
+    def test_compile_say_loop_forever(self):
+        """A loop of 0 repeats the prompt a fixed number of times"""
+        self.response.say('Hello', loop=0)
+        program = self.compile()
+        self.assertEqual(len(program), TwiMLCompiler.max_loop)
+
+    def test_compile_gather_say_loop(self):
+        with self.response.gather() as g:
+            g.say('Press a key', loop=2)
+        program = self.compile()
+        [[_, _, prompts]] = program.instructions
+        self.assertEqual(prompts, [['say', 'Press a key', 'man', 'en']] * 2)
+
+    def test_compile_gather_say(self):
+        with self.response.gather() as g:
+            g.say('Press a key')
+        program = self.compile()
+        [[_, _, prompts]] = program.instructions
+        self.assertEqual(prompts, [['say', 'Press a key', 'man', 'en']])
+
+    def test_compile_redirect(self):
+        self.response.redirect('next.xml', method='GET')
+        program = self.compile()
+        self.assertEqual(
+            program.instructions,
+            [['redirect', 'http://example.com/next.xml', 'GET']])
+
+    def test_compile_pause(self):
+        self.response.pause(length=2)
+        program = self.compile()
+        self.assertEqual(program.instructions, [['pause', 2]])
+
+    def test_compile_hangup(self):
+        self.response.hangup()
+        program = self.compile()
+        self.assertEqual(program.instructions, [['hangup']])
+
+    def test_compile_gather(self):
+        with self.response.gather(action='reply.xml', finishOnKey='*') as g:
+            g.play('prompt1')
+            g.play('prompt2')
+        program = self.compile()
+        self.assertEqual(program.instructions, [[
+            'gather', {
+                'action': 'http://example.com/reply.xml',
+                'method': 'POST',
+                'finishOnKey': '*',
+                'timeout': 5,
+            }, [['play', 'prompt1'], ['play', 'prompt2']]]])
+
+    def test_compile_document_order(self):
+        """Instructions are kept in document order"""
+        self.response.play('first')
+        self.response.gather()
+        self.response.play('second')
+        self.response.hangup()
+        program = self.compile()
+        self.assertEqual(
+            [i[0] for i in program.instructions],
+            ['play', 'gather', 'play', 'hangup'])
+        self.assertEqual(program[2], ['play', 'second'])
+
+    def test_compile_unknown_verb(self):
+        """Verbs that have no compiler raise an error"""
+        e = self.assertRaises(
+            TwiMLCompileError, TwiMLCompiler().compile_verb, Verb())
+        self.assertEqual(e.args[0], "Cannot compile verb 'Verb'")
+
+    def test_serialize_round_trip(self):
+        self.response.play('first')
+        self.response.gather()
+        program = self.compile()
+        data = program.serialize()
+        self.assertTrue(isinstance(data, str))
+        self.assertEqual(TwiMLProgram.deserialize(data), program)
+
+
+class TestRedirectGraph(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.graph = RedirectGraph(60, clock=self.clock)
+
+    def test_resolve_unknown(self):
+        self.assertEqual(self.graph.resolve(('a', 'POST')), [('a', 'POST')])
+
+    def test_resolve_chain(self):
+        """Known redirects are followed to the end of the chain"""
+        self.graph.add(('a', 'POST'), ('b', 'GET'))
+        self.graph.add(('b', 'GET'), ('c', 'POST'))
+        self.assertEqual(
+            self.graph.resolve(('a', 'POST')),
+            [('a', 'POST'), ('b', 'GET'), ('c', 'POST')])
+        self.assertEqual(
+            self.graph.resolve(('b', 'POST')), [('b', 'POST')])
+
+    def test_resolve_loop(self):
+        """A loop ends the path at the first repeated node"""
+        self.graph.add(('a', 'POST'), ('b', 'POST'))
+        self.graph.add(('b', 'POST'), ('a', 'POST'))
+        self.assertEqual(
+            self.graph.resolve(('a', 'POST')),
+            [('a', 'POST'), ('b', 'POST'), ('a', 'POST')])
+
+    def test_expiry(self):
+        """Redirects are forgotten once they expire"""
+        self.graph.add(('a', 'POST'), ('b', 'POST'))
+        self.clock.advance(59)
+        self.assertEqual(self.graph.get(('a', 'POST')), ('b', 'POST'))
+        self.clock.advance(1)
+        self.assertEqual(self.graph.get(('a', 'POST')), None)
+        self.assertEqual(len(self.graph), 0)
+
+    def test_disabled(self):
+        """Nothing is remembered if the ttl is 0"""
+        graph = RedirectGraph(0, clock=self.clock)
+        graph.add(('a', 'POST'), ('b', 'POST'))
+        self.assertEqual(graph.get(('a', 'POST')), None)
@@ -0,0 +1,148 @@
+import json
+import os
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+
+from vxtwinio.twiml_lint import iter_documents, lint, lint_twiml, main
+
+
+BAD_TWIML = """<Response>
+  <Say>Hello</Say>
+  <Gather timeout="soon">
+    <Say>Enter a number</Say>
+  </Gather>
+  <Pause length="0"/>
+</Response>
+"""
+
+
+class TestLintTwiML(TestCase):
+    def test_valid(self):
+        self.assertEqual(
+            lint_twiml('<Response><Say>Hello</Say><Hangup/></Response>'), [])
+
+    def test_every_verb_checked(self):
+        """Each verb with a problem is reported, with where it is"""
+        self.assertEqual(lint_twiml(BAD_TWIML), [
+            {
+                'error': 'TwiMLParseError',
+                'message':
+                    "Invalid value 'soon' for timeout parameter. Must be an "
+                    "integer.",
+                'line': 3,
+                'location': '/Response/Gather[1]',
+            },
+            {
+                'error': 'TwiMLParseError',
+                'message':
+                    "Invalid value 0 for length parameter. Must be >= 1",
+                'line': 6,
+                'location': '/Response/Pause[1]',
+            },
+        ])
+
+    def test_location_counts_tags(self):
+        [error] = lint_twiml(
+            '<Response><Say/><Play/><Say voice="robot"/></Response>')
+        self.assertEqual(error['location'], '/Response/Say[2]')
+
+    def test_invalid_root(self):
+        [error] = lint_twiml('<Request/>')
+        self.assertEqual(error['location'], '/Request')
+        self.assertEqual(error['line'], 1)
+
+    def test_invalid_xml(self):
+        [error] = lint_twiml('<Response>\n<Say>')
+        self.assertEqual(error['error'], 'ParseError')
+        self.assertEqual(error['line'], 2)
+
+    def test_unicode(self):
+        self.assertEqual(
+            lint_twiml(u'<Response><Say>H\xe9llo</Say></Response>'), [])
+
+
+class TestLint(TestCase):
+    def setUp(self):
+        self.directory = self.mktemp()
+        os.makedirs(os.path.join(self.directory, 'sub'))
+        self.write('good.xml', '<Response><Say>Hello</Say></Response>')
+        self.write(os.path.join('sub', 'bad.xml'), BAD_TWIML)
+        self.write('notes.txt', 'not TwiML')
+        self.dump = self.write('dump.ndjson', '\n'.join([
+            json.dumps({'twiml': '<Response><Hangup/></Response>'}),
+            json.dumps({'twiml': '<Response><Dial/></Response>', 'id': 'c1'}),
+            '',
+            'not json',
+        ]))
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_iter_documents(self):
+        documents = list(iter_documents([self.directory], url='http://x/'))
+        self.assertEqual(
+            [(source, url) for source, url, _ in documents], [
+                (os.path.join(self.directory, 'good.xml'), 'http://x/'),
+                (os.path.join(self.directory, 'sub', 'bad.xml'),
+                 'http://x/'),
+            ])
+
+    def test_iter_documents_ndjson(self):
+        documents = list(iter_documents([self.dump]))
+        self.assertEqual(documents, [
+            ('%s:1' % self.dump, '', '<Response><Hangup/></Response>'),
+            ('%s:2 (c1)' % self.dump, '', '<Response><Dial/></Response>'),
+            ('%s:4' % self.dump, "Not a JSON object with a 'twiml' field",
+             None),
+        ])
+
+    def test_lint_processes(self):
+        """Results come back in order from the process pool"""
+        documents = list(iter_documents([self.directory, self.dump]))
+        results = list(lint(documents, processes=2, chunksize=1))
+        self.assertEqual(
+            [source for source, _ in results],
+            [source for source, _, _ in documents])
+        self.assertEqual(results, list(lint(documents, processes=1)))
+        self.assertEqual(
+            [len(errors) for _, errors in results], [0, 2, 0, 1, 1])
+
+    def test_main(self):
+        stdout, stderr = StringIO(), StringIO()
+        code = main(
+            ['--processes', '1', self.directory, self.dump],
+            stdout=stdout, stderr=stderr)
+        self.assertEqual(code, 1)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(
+            lines[0],
+            "%s: line 3: /Response/Gather[1]: TwiMLParseError: Invalid value "
+            "'soon' for timeout parameter. Must be an integer." % (
+                os.path.join(self.directory, 'sub', 'bad.xml'),))
+        self.assertTrue(stderr.getvalue().startswith('Checked 5 documents'))
+        self.assertIn('4 errors in 3 documents', stderr.getvalue())
+
+    def test_main_json(self):
+        stdout, stderr = StringIO(), StringIO()
+        code = main(
+            ['--processes', '1', '--json', self.dump],
+            stdout=stdout, stderr=stderr)
+        self.assertEqual(code, 1)
+        [dial, invalid] = [
+            json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(dial['source'], '%s:2 (c1)' % (self.dump,))
+        self.assertEqual(dial['location'], '/Response/Dial[1]')
+        self.assertEqual(invalid['error'], 'InvalidDocument')
+
+    def test_main_valid(self):
+        stdout, stderr = StringIO(), StringIO()
+        code = main(
+            ['--processes', '1', os.path.join(self.directory, 'good.xml')],
+            stdout=stdout, stderr=stderr)
+        self.assertEqual(code, 0)
+        self.assertEqual(stdout.getvalue(), '')
@@ -3,7 +3,8 @@ from twilio import twiml
 import xml.etree.ElementTree as ET
 
 from vxtwinio.twiml_parser import (
-    TwiMLParser, TwiMLParseError, Verb, Play, Hangup, Gather)
+    TwiMLParser, TwiMLParseError, Verb, Play, Say, Hangup, Gather, Pause,
+    Redirect)
 
 
 class TestVerb(TestCase):
@@ -56,6 +57,38 @@ class TestParser(TestCase):
         self.assertEqual(result.attributes['loop'], 2)
         self.assertEqual(result.attributes['digits'], '123w')
 
+    def test_parse_say(self):
+        """The say verb is correctly parsed and returned"""
+        self.response.say('Hello', voice='woman', language='fr', loop=2)
+
+        [result] = self.parser.parse(str(self.response))
+
+        self.assertEqual(result.name, "Say")
+        self.assertEqual(result.nouns, ["Hello"])
+        self.assertEqual(result.attributes['voice'], 'woman')
+        self.assertEqual(result.attributes['language'], 'fr')
+        self.assertEqual(result.attributes['loop'], 2)
+
+    def test_parse_redirect(self):
+        """The redirect verb is correctly parsed and returned"""
+        self.response.redirect('next.xml', method='GET')
+
+        [result] = self.parser.parse(str(self.response))
+
+        self.assertEqual(result.name, "Redirect")
+        self.assertEqual(result.nouns, ["next.xml"])
+        self.assertEqual(result.attributes['method'], 'GET')
+
+    def test_parse_pause(self):
+        """The pause verb is correctly parsed and returned"""
+        self.response.pause(length=3)
+
+        [result] = self.parser.parse(str(self.response))
+
+        self.assertEqual(result.name, "Pause")
+        self.assertEqual(result.nouns, [])
+        self.assertEqual(result.attributes['length'], 3)
+
     def test_parse_hangup(self):
         """The hangup verb is correctly parsed and returned"""
         self.response.hangup()
@@ -118,6 +151,37 @@ class TestPlay(TestCase):
             "verb. Must be one of '0123456789w'")
 
 
+class TestSay(TestCase):
+    def test_say_from_xml_defaults(self):
+        """Defaults set according to API documentation"""
+        root = ET.Element("Say")
+        say = Say.from_xml(root)
+
+        self.assertEqual(say.name, "Say")
+        self.assertEqual(say.attributes['voice'], 'man')
+        self.assertEqual(say.attributes['language'], 'en')
+        self.assertEqual(say.attributes['loop'], 1)
+        self.assertEqual(say.nouns, [''])
+
+    def test_say_from_xml_invalid_voice(self):
+        """Error should be raised for unknown voices"""
+        root = ET.Element("Say", {'voice': 'robot'})
+
+        e = self.assertRaises(TwiMLParseError, Say.from_xml, root)
+        self.assertEqual(
+            str(e), "Invalid value 'robot' for 'voice' attribute in Say "
+            "verb. Must be one of ['man', 'woman', 'alice']")
+
+    def test_say_from_xml_loop_non_int(self):
+        """Error should be raised when loop attribute is not an integer"""
+        root = ET.Element("Say", {'loop': 'a'})
+
+        e = self.assertRaises(TwiMLParseError, Say.from_xml, root)
+        self.assertEqual(
+            str(e), "Invalid value 'a' for loop parameter. "
+            "Must be an integer.")
+
+
 class TestHangup(TestCase):
     def test_hangup_from_xml(self):
         """There are no attributes or nouns for the hangup verb"""
@@ -243,3 +307,45 @@ class TestGather(TestCase):
         self.assertEqual(
             str(e), "Invalid sub verb 'Hangup' for Gather verb. "
             "Must be one of ['Say', 'Play']")
+
+
+class TestRedirect(TestCase):
+    def test_redirect_from_xml_defaults(self):
+        """Defaults set according to API documentation"""
+        root = ET.Element("Redirect")
+        root.text = 'next.xml'
+        redirect = Redirect.from_xml(root, 'http://example.com/twiml.xml')
+        self.assertEqual(redirect.name, "Redirect")
+        self.assertEqual(redirect.attributes['method'], 'POST')
+        self.assertEqual(redirect.nouns, ['http://example.com/next.xml'])
+
+    def test_redirect_from_xml_no_url(self):
+        """The document URL is used if no URL is given"""
+        root = ET.Element("Redirect")
+        redirect = Redirect.from_xml(root, 'http://example.com/twiml.xml')
+        self.assertEqual(redirect.nouns, ['http://example.com/twiml.xml'])
+
+    def test_redirect_from_xml_invalid_method(self):
+        """Error should be raised for invalid method attribute values"""
+        root = ET.Element("Redirect", {'method': 'PUT'})
+        e = self.assertRaises(
+            TwiMLParseError, Redirect.from_xml, root, 'test_url')
+        self.assertEqual(
+            str(e), "Invalid value 'PUT' for method attribute. "
+            "Must be one of ['GET', 'POST']")
+
+
+class TestPause(TestCase):
+    def test_pause_from_xml_defaults(self):
+        """Defaults set according to API documentation"""
+        root = ET.Element("Pause")
+        pause = Pause.from_xml(root)
+        self.assertEqual(pause.name, "Pause")
+        self.assertEqual(pause.attributes['length'], 1)
+
+    def test_pause_from_xml_invalid_length(self):
+        """Error should be raised when length is less than one"""
+        root = ET.Element("Pause", {'length': '0'})
+        e = self.assertRaises(TwiMLParseError, Pause.from_xml, root)
+        self.assertEqual(
+            str(e), "Invalid value 0 for length parameter. Must be >= 1")
@@ -0,0 +1,117 @@
+from hashlib import sha1
+import json
+import os
+from StringIO import StringIO
+import wave
+
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, maybeDeferred, succeed)
+from twisted.python.failure import Failure
+
+from vxtwinio.media_cache import UnlistedFile
+
+
+class TTSEngine(object):
+    """Base class for text-to-speech engines used to render the Say verb.
+
+    Subclasses implement :meth:`synthesize`, which may return either the
+    audio data or a deferred that fires with it."""
+    extension = 'wav'
+    content_type = 'audio/x-wav'
+
+    def __init__(self, config=None):
+        self.config = config or {}
+
+    def synthesize(self, text, voice, language):
+        raise NotImplementedError()
+
+
+class StubTTSEngine(TTSEngine):
+    """Local engine that renders silence, one tenth of a second per
+    character. Useful for testing without a real speech service."""
+    sample_rate = 8000
+
+    def synthesize(self, text, voice, language):
+        output = StringIO()
+        audio = wave.open(output, 'wb')
+        audio.setnchannels(1)
+        audio.setsampwidth(1)
+        audio.setframerate(self.sample_rate)
+        audio.writeframes('\x80' * (self.sample_rate / 10) * len(text))
+        audio.close()
+        return output.getvalue()
+
+
+class SpeechCache(object):
+    """Caches rendered speech on disk, so that each unique (text, voice,
+    language) is only synthesized once."""
+
+    def __init__(self, engine, directory, base_url):
+        """
+        :param TTSEngine engine: The engine used to render speech
+        :param str directory: The directory to store rendered speech in
+        :param str base_url: The URL that the directory is served on
+        """
+        self.engine = engine
+        self.directory = directory
+        self.base_url = base_url.rstrip('/')
+        self._pending = {}
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def _get_key(self, text, voice, language):
+        data = json.dumps([text, voice, language])
+        return sha1(data.encode('utf-8')).hexdigest()
+
+    def _get_filename(self, key):
+        return '%s.%s' % (key, self.engine.extension)
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, self._get_filename(key))
+
+    def _get_url(self, key):
+        return '%s/%s' % (self.base_url, self._get_filename(key))
+
+    def _write(self, key, data):
+        # Write to a temporary file first so that the transport never sees
+        # a partially written file
+        path = self._get_path(key)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    @inlineCallbacks
+    def _synthesize(self, key, text, voice, language):
+        try:
+            data = yield maybeDeferred(
+                self.engine.synthesize, text, voice, language)
+            self._write(key, data)
+        except Exception:
+            failure = Failure()
+            for d in self._pending.pop(key):
+                d.errback(failure)
+        else:
+            for d in self._pending.pop(key):
+                d.callback(self._get_url(key))
+
+    def get_url(self, text, voice, language):
+        """Returns a deferred that fires with the URL of the rendered speech,
+        rendering it first if it isn't already cached."""
+        key = self._get_key(text, voice, language)
+        if os.path.exists(self._get_path(key)):
+            return succeed(self._get_url(key))
+
+        d = Deferred()
+        if key in self._pending:
+            self._pending[key].append(d)
+        else:
+            self._pending[key] = [d]
+            self._synthesize(key, text, voice, language)
+        return d
+
+    def resource(self):
+        """Returns a web resource that serves the cached speech"""
+        return UnlistedFile(
+            self.directory, defaultType=self.engine.content_type)
+
@@ -1,21 +1,55 @@
+from bisect import bisect_right
+from collections import OrderedDict
 from datetime import datetime
 from dateutil.tz import tzutc
 import json
 from klein import Klein
+from klein.interfaces import IKleinRequest
 from math import ceil
 import os
 import re
+import tempfile
 import treq
-from twisted.internet.defer import inlineCallbacks, returnValue
-import uuid
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    DeferredList, gatherResults, inlineCallbacks, returnValue, succeed)
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.http import CACHED
+from twisted.web.server import Site
 from vumi.application import ApplicationWorker
-from vumi.components.session import SessionManager
-from vumi.config import ConfigDict, ConfigInt, ConfigText
+from vumi.config import (
+    ConfigBool, ConfigClassName, ConfigDict, ConfigFloat, ConfigInt,
+    ConfigText)
 from vumi.message import TransportUserMessage
 from vumi.persist.txredis_manager import TxRedisManager
+from urlparse import urlparse
+from werkzeug.exceptions import HTTPException
 import xml.etree.ElementTree as ET
 
+from vxtwinio.admin import AdminServer
+from vxtwinio.applications import ApplicationStore
+from vxtwinio.breaker import CircuitBreakers
+from vxtwinio.call_queue import DurableQueue
+from vxtwinio.capture import CaptureWriter
+from vxtwinio.config_cache import ConfigCache
+from vxtwinio.cdr import CDRWriter, call_duration, make_cdr
+from vxtwinio.drain import InFlightTracker
+from vxtwinio.encoding import (
+    CompressionStats, compress, negotiate_encoding, negotiate_format)
+from vxtwinio.idempotency import IdempotencyStore, fingerprint
+from vxtwinio.load import LoadShedder
+from vxtwinio.media_cache import MediaCache
+from vxtwinio.scheduler import Scheduler, TimerWheel
+from vxtwinio.sids import SIDGenerator
+from vxtwinio.session import CallSession, CallSessionManager
+from vxtwinio.slo import PromptWait, SLOTracker
+from vxtwinio.twiml_engine import (
+    RedirectGraph, RedirectLoopError, TwiMLProgram, TwiMLUnavailableError)
 from vxtwinio.twiml_parser import TwiMLParser
+from vxtwinio.tts import SpeechCache
 
 
 c2s = re.compile('(?!^)([A-Z+])')
@@ -25,6 +59,10 @@ def camel_to_snake(string):
     return c2s.sub(r'_\1', string).lower()
 
 
+def snake_to_camel(string):
+    return ''.join(part.capitalize() for part in string.split('_'))
+
+
 def convert_dict_keys(dct):
     res = {}
     for key, value in dct.iteritems():
@@ -73,6 +111,27 @@ class TwilioAPIConfig(ApplicationWorker.CONFIG_CLASS):
     session_lookup_namespace = ConfigText(
         "The redis namespace to use for storing session ID lookups",
         default="session_id", static=True)
+    shard_id = ConfigInt(
+        "The ID, from 0 to 65535, that this worker puts in the SIDs it "
+        "creates, so that they can be traced back to it",
+        default=0, static=True)
+    call_index_namespace = ConfigText(
+        "The redis namespace to use for looking up sessions by Call SID",
+        default="call_sid", static=True)
+    idempotency_ttl = ConfigInt(
+        "Seconds to remember the Idempotency-Key of a request that made a "
+        "call, so that retries of it get the same call back",
+        default=24 * 60 * 60, static=True)
+    config_cache_ttl = ConfigInt(
+        "Seconds to cache the config resolved for each tenant for. 0 "
+        "disables the cache.",
+        default=60, static=True)
+    config_cache_size = ConfigInt(
+        "The maximum number of tenant configs to cache",
+        default=1000, static=True)
+    application_cache_size = ConfigInt(
+        "The maximum number of formatted Applications responses to cache",
+        default=1000, static=True)
     client_path = ConfigText(
         "The web path that the API worker should send requests to",
         required=True)
@@ -85,35 +144,491 @@ class TwilioAPIConfig(ApplicationWorker.CONFIG_CLASS):
     status_callback_method = ConfigText(
         "The HTTP method to use when sending the callback status",
         default='POST')
+    public_url = ConfigText(
+        "The base URL that the voice transport can reach the worker's web "
+        "port on. Defaults to the local address of the web port.",
+        default=None, static=True)
+    tts_engine = ConfigClassName(
+        "The text-to-speech engine used to render the Say verb",
+        default='vxtwinio.tts.StubTTSEngine', static=True)
+    tts_engine_config = ConfigDict(
+        "Config passed to the text-to-speech engine", default={}, static=True)
+    speech_cache_dir = ConfigText(
+        "The directory to cache rendered speech in. Defaults to a new "
+        "temporary directory.",
+        default=None, static=True)
+    speech_path = ConfigText(
+        "The path, relative to web_path, that rendered speech is served on",
+        default='speech', static=True)
+    media_cache_dir = ConfigText(
+        "The directory to cache the media of Play verbs in. If not set, the "
+        "transport is given the media URLs as is.",
+        default=None, static=True)
+    media_cache_max_entries = ConfigInt(
+        "The maximum number of files to keep in the media cache",
+        default=1000, static=True)
+    media_cache_max_bytes = ConfigInt(
+        "The maximum total size in bytes of the files in the media cache",
+        default=512 * 1024 * 1024, static=True)
+    media_fetch_timeout = ConfigFloat(
+        "Seconds to wait for media to download into the media cache before "
+        "the transport is given the media URL as is",
+        default=5, static=True)
+    media_failure_ttl = ConfigFloat(
+        "Seconds to give the transport a media URL as is, without trying to "
+        "download it again, once downloading it has failed",
+        default=60, static=True)
+    media_path = ConfigText(
+        "The path, relative to web_path, that cached media is served on",
+        default='media', static=True)
+    max_redirects = ConfigInt(
+        "The maximum number of redirects to follow before the caller has to "
+        "respond again. Calls that go over this are hung up.",
+        default=10, static=True)
+    redirect_cache_ttl = ConfigInt(
+        "Seconds to remember documents that only contain a Redirect, so "
+        "that chains of them can be skipped. A document seen to redirect "
+        "on one call is skipped for every call, so only set this if the "
+        "client's redirect-only documents are static, and don't depend on "
+        "the caller or the digits they entered. 0 disables this.",
+        default=0, static=True)
+    timer_resolution = ConfigFloat(
+        "Seconds between ticks of the timer wheel that runs Gather timeouts, "
+        "Pause verbs and call expiry",
+        default=0.1, static=True)
+    timer_recovery_interval = ConfigInt(
+        "Seconds between checks for overdue timers left behind by other "
+        "workers. 0 disables the checks.",
+        default=30, static=True)
+    gather_prompt_allowance = ConfigFloat(
+        "Seconds added to the timeout of a Gather that has prompts, to allow "
+        "for them to play before the caller's timeout starts",
+        default=30, static=True)
+    max_call_duration = ConfigInt(
+        "Seconds after which a call is hung up and its session removed. 0 "
+        "disables this.",
+        default=3600, static=True)
+    ring_timeout = ConfigInt(
+        "Seconds to wait for the transport to answer an outbound call before "
+        "it is given up as no-answer, if the request has no Timeout",
+        default=60, static=True)
+    cdr_log_path = ConfigText(
+        "The file to append a call detail record to for every call that "
+        "ends. If not set, no records are kept.",
+        default=None, static=True)
+    cdr_flush_interval = ConfigFloat(
+        "Seconds between writes of call detail records to disk",
+        default=1.0, static=True)
+    cdr_batch_size = ConfigInt(
+        "The number of waiting call detail records that causes them to be "
+        "written to disk straight away",
+        default=1000, static=True)
+    compress_responses = ConfigBool(
+        "Whether to compress API responses for clients that accept gzip or "
+        "deflate",
+        default=True, static=True)
+    compression_min_size = ConfigInt(
+        "The size in bytes below which API responses aren't compressed",
+        default=1024, static=True)
+    compression_level = ConfigInt(
+        "The compression level, from 1 (fastest) to 9 (smallest)",
+        default=6, static=True)
+    compression_report_interval = ConfigInt(
+        "Seconds between logging the bytes saved by compression for each "
+        "API route. 0 disables this.",
+        default=300, static=True)
+    max_twiml_fetches = ConfigInt(
+        "The number of TwiML fetches in progress at which new calls are "
+        "turned away. 0 means there is no limit.",
+        default=0, static=True)
+    max_live_sessions = ConfigInt(
+        "The number of live calls on the worker at which new calls are "
+        "turned away. 0 means there is no limit.",
+        default=0, static=True)
+    live_session_prune_interval = ConfigFloat(
+        "Seconds between checks for live calls that have ended on another "
+        "worker, or whose sessions have expired. 0 disables the checks.",
+        default=60, static=True)
+    max_pending_calls = ConfigInt(
+        "The number of outbound calls waiting to be sent to the transport "
+        "at which new calls are turned away. 0 means there is no limit.",
+        default=0, static=True)
+    drain_timeout = ConfigFloat(
+        "Seconds to wait for calls and status callbacks in progress to "
+        "finish when the worker stops",
+        default=30, static=True)
+    async_make_call = ConfigBool(
+        "Whether making a call should respond with 202 Accepted once the call "
+        "is queued on local disk, instead of waiting for it to be sent to "
+        "the transport",
+        default=False, static=True)
+    call_queue_path = ConfigText(
+        "The file that queued calls are kept in until they are sent. If not "
+        "set, a temporary file is used.",
+        default=None, static=True)
+    call_queue_compact_after = ConfigInt(
+        "The number of records the call queue file may hold before it is "
+        "compacted to only the calls that are still queued. 0 disables "
+        "compaction.",
+        default=10000, static=True)
+    call_publish_interval = ConfigFloat(
+        "Seconds between sends of queued calls to the transport",
+        default=0.1, static=True)
+    call_publish_batch_size = ConfigInt(
+        "The maximum number of queued calls to send at a time",
+        default=100, static=True)
+    capture_path = ConfigText(
+        "The file to record the messages, events and TwiML the worker "
+        "handles to, so that they can be replayed with vxtwinio-replay. "
+        "Nothing is recorded if this isn't set.",
+        default=None, static=True)
+    slo_first_prompt = ConfigFloat(
+        "Seconds a caller should wait at most between the call being "
+        "answered and hearing the first prompt",
+        default=3, static=True)
+    slo_next_prompt = ConfigFloat(
+        "Seconds a caller should wait at most between entering digits and "
+        "hearing the next prompt",
+        default=2, static=True)
+    slo_slow_fraction = ConfigFloat(
+        "The share of waits longer than their objective at which an "
+        "account is flagged as slow",
+        default=0.05, static=True)
+    slo_min_samples = ConfigInt(
+        "The number of waits an account needs before it can be flagged as "
+        "slow",
+        default=20, static=True)
+    slo_max_accounts = ConfigInt(
+        "The number of accounts to keep prompt waits for at most. Waits of "
+        "inbound calls are kept for the host of their client_path.",
+        default=1000, static=True)
+    admin_port = ConfigInt(
+        "The port to serve the admin endpoints for profiling the worker and "
+        "reporting its memory use on. They aren't served if this isn't set.",
+        default=None, static=True)
+    admin_interface = ConfigText(
+        "The interface to serve the admin endpoints on. Only the local host "
+        "can reach them by default.",
+        default='127.0.0.1', static=True)
+    admin_max_profile_seconds = ConfigFloat(
+        "The longest a profile started through the admin endpoints can run "
+        "for",
+        default=300, static=True)
+    circuit_breaker_window = ConfigInt(
+        "The number of recent TwiML requests to each client host that its "
+        "circuit breaker counts",
+        default=20, static=True)
+    circuit_breaker_min_requests = ConfigInt(
+        "The number of recent TwiML requests to a client host needed before "
+        "its circuit breaker can open",
+        default=10, static=True)
+    circuit_breaker_error_rate = ConfigFloat(
+        "The share of recent TwiML requests to a client host that have to "
+        "fail for its circuit breaker to open. Requests fail if they error, "
+        "respond with a status other than 2xx, or are slow.",
+        default=0.5, static=True)
+    circuit_breaker_slow_seconds = ConfigFloat(
+        "TwiML requests that take longer than this many seconds count as "
+        "failed, and are given up on",
+        default=5, static=True)
+    circuit_breaker_reset_timeout = ConfigFloat(
+        "Seconds that a circuit breaker stays open for before a request is "
+        "let through to check whether the client host has recovered",
+        default=30, static=True)
+    circuit_breaker_max_hosts = ConfigInt(
+        "The number of client hosts to keep circuit breakers for",
+        default=1000, static=True)
+    default_twiml = ConfigText(
+        "The TwiML to use when a call's TwiML can't be fetched from the "
+        "client and the call has no FallbackUrl, such as while the client "
+        "host's circuit breaker is open",
+        default=None, static=True)
 
 
 class TwilioAPIWorker(ApplicationWorker):
     """Emulates the Twilio API to use vumi as if it was Twilio"""
     CONFIG_CLASS = TwilioAPIConfig
+    clock = reactor
 
     @inlineCallbacks
     def setup_application(self):
-        """Application specific setup"""
+        """Application specific setup. Everything that requests depend on is
+        set up before the web server starts, and the slow parts run
+        together."""
+        self.ready = False
+        self.startup_times = OrderedDict()
+        started = self.clock.seconds()
         self.app_config = self.get_static_config()
+        self.sid_generator = SIDGenerator(
+            self.app_config.shard_id, clock=self.clock)
         self.server = TwilioAPIServer(self, self.app_config.api_version)
-        path = os.path.join(
-            self.app_config.web_path, self.app_config.api_version)
-        self.webserver = self.start_web_resources([
-            (self.server.app.resource(), path)],
-            self.app_config.web_port)
-        redis = yield TxRedisManager.from_config(self.app_config.redis_manager)
-        self.session_manager = SessionManager(
+        self.config_cache = ConfigCache(
+            lambda msg: super(TwilioAPIWorker, self).get_config(msg),
+            self.app_config.config_cache_ttl,
+            max_entries=self.app_config.config_cache_size, clock=self.clock)
+        speech_cache_dir = (
+            self.app_config.speech_cache_dir or
+            tempfile.mkdtemp(prefix='vxtwinio-speech-'))
+        tts_engine = self.app_config.tts_engine(
+            self.app_config.tts_engine_config)
+        self.speech_cache = SpeechCache(tts_engine, speech_cache_dir, '')
+        call_queue_path = (
+            self.app_config.call_queue_path or
+            os.path.join(
+                tempfile.mkdtemp(prefix='vxtwinio-calls-'), 'calls.log'))
+        self.call_queue = DurableQueue(
+            call_queue_path,
+            compact_after=self.app_config.call_queue_compact_after)
+        self.capture = None
+        if self.app_config.capture_path is not None:
+            self.capture = CaptureWriter(
+                self.app_config.capture_path, clock=self.clock)
+            self.capture.open()
+
+        # Connect to Redis while the caches and queue left on disk by a
+        # previous run are loaded in threads
+        redis, self.media_cache, _ = yield gatherResults([
+            self._time_startup(
+                'redis',
+                TxRedisManager.from_config(self.app_config.redis_manager)),
+            self._time_startup(
+                'media_cache', deferToThread(self._load_media_cache)),
+            self._time_startup(
+                'call_queue', deferToThread(self.call_queue.open)),
+            ], consumeErrors=True)
+
+        self.session_manager = CallSessionManager(
             redis, self.app_config.redis_timeout)
+        self.circuit_breakers = CircuitBreakers(
+            max_hosts=self.app_config.circuit_breaker_max_hosts,
+            window=self.app_config.circuit_breaker_window,
+            min_requests=self.app_config.circuit_breaker_min_requests,
+            error_rate=self.app_config.circuit_breaker_error_rate,
+            slow_seconds=self.app_config.circuit_breaker_slow_seconds,
+            reset_timeout=self.app_config.circuit_breaker_reset_timeout,
+            clock=self.clock)
+        self.redirect_graph = RedirectGraph(
+            self.app_config.redirect_cache_ttl, clock=self.clock)
         self.session_lookup = SessionIDLookup(
             redis, self.app_config.redis_timeout,
             self.app_config.session_lookup_namespace)
+        self.application_store = ApplicationStore(
+            redis, self.app_config.application_cache_size)
+        self.call_index = SessionIDLookup(
+            redis, self.app_config.redis_timeout,
+            self.app_config.call_index_namespace)
+        self.idempotency_store = IdempotencyStore(
+            redis, self.app_config.idempotency_ttl)
+        wheel = TimerWheel(self.app_config.timer_resolution, clock=self.clock)
+        self.scheduler = Scheduler(
+            redis, wheel, 'timers',
+            recovery_interval=self.app_config.timer_recovery_interval)
+        self.scheduler.register('resume', self._timer_resume)
+        self.scheduler.register('expire', self._timer_expire)
+        self.scheduler.register('ring_timeout', self._timer_ring_timeout)
+        self.scheduler.start()
+        self.cdr_writer = None
+        if self.app_config.cdr_log_path is not None:
+            self.cdr_writer = CDRWriter(
+                self.app_config.cdr_log_path,
+                flush_interval=self.app_config.cdr_flush_interval,
+                batch_size=self.app_config.cdr_batch_size,
+                clock=self.clock)
+            self.cdr_writer.start()
+        self._compression_report = LoopingCall(self._report_compression)
+        self._compression_report.clock = self.clock
+        if self.app_config.compression_report_interval:
+            self._compression_report.start(
+                self.app_config.compression_report_interval, now=False)
+        self._publishing = succeed(None)
+        self._call_publisher = LoopingCall(self._publish_queued_calls)
+        self._call_publisher.clock = self.clock
+        self._call_publisher.start(
+            self.app_config.call_publish_interval, now=False)
+        self.in_flight = InFlightTracker(clock=self.clock)
+        self._draining = None
+        self._twiml_fetches = 0
+        # Session IDs of the calls started on this worker, mapped to their
+        # call SIDs
+        self._live_sessions = {}
+        self._live_session_pruner = LoopingCall(self._prune_live_sessions)
+        self._live_session_pruner.clock = self.clock
+        if self.app_config.live_session_prune_interval:
+            self._live_session_pruner.start(
+                self.app_config.live_session_prune_interval, now=False)
+        self._calls_starting = 0
+        # Calls that are being started, but are still in the call queue
+        self._queued_calls_starting = 0
+        self.slo_tracker = SLOTracker(
+            {
+                'first_prompt': self.app_config.slo_first_prompt,
+                'next_prompt': self.app_config.slo_next_prompt,
+            },
+            slow_fraction=self.app_config.slo_slow_fraction,
+            min_samples=self.app_config.slo_min_samples,
+            max_accounts=self.app_config.slo_max_accounts)
+        # Call SIDs mapped to the PromptWait of the caller
+        self._prompt_waits = {}
+        self.load_shedder = LoadShedder()
+        self.load_shedder.add_limit(
+            'twiml_fetches', self.app_config.max_twiml_fetches,
+            lambda: self._twiml_fetches)
+        self.load_shedder.add_limit(
+            'live_sessions', self.app_config.max_live_sessions,
+            lambda: len(self._live_sessions))
+        self.load_shedder.add_limit(
+            'pending_calls', self.app_config.max_pending_calls,
+            self._pending_calls)
+
+        web_started = self.clock.seconds()
+        self._start_web_server()
+        self._start_admin_server()
+        self.startup_times['web'] = self.clock.seconds() - web_started
+        self.startup_times['total'] = self.clock.seconds() - started
+        self.ready = True
+        log.msg("Worker ready in %.3fs (%s)" % (
+            self.startup_times['total'],
+            ', '.join(
+                '%s %.3fs' % (name, seconds)
+                for name, seconds in self.startup_times.iteritems()
+                if name != 'total')))
+
+    def get_config(self, msg, ctxt=None):
+        """Returns the config for the tenant that ``msg`` is for, from the
+        config cache if it has been resolved recently"""
+        if ctxt is not None:
+            return super(TwilioAPIWorker, self).get_config(msg, ctxt)
+        return self.config_cache.get(self._config_key(msg), msg)
+
+    def _config_key(self, msg):
+        """Returns the identity of the tenant that ``msg`` is for: the
+        transport and endpoint it came in on, and the number it called"""
+        return (
+            msg['transport_name'], msg.get_routing_endpoint(),
+            msg['to_addr'])
+
+    def _time_startup(self, name, d):
+        """Records how long the startup step that ``d`` fires for takes"""
+        started = self.clock.seconds()
+
+        def done(result):
+            self.startup_times[name] = self.clock.seconds() - started
+            return result
+
+        return d.addCallback(done)
+
+    def _load_media_cache(self):
+        if self.app_config.media_cache_dir is None:
+            return None
+        return MediaCache(
+            self.app_config.media_cache_dir, '',
+            max_entries=self.app_config.media_cache_max_entries,
+            max_bytes=self.app_config.media_cache_max_bytes,
+            fetch_timeout=self.app_config.media_fetch_timeout,
+            failure_ttl=self.app_config.media_failure_ttl,
+            clock=self.clock)
+
+    def _start_web_server(self):
+        path = os.path.join(
+            self.app_config.web_path, self.app_config.api_version)
+        speech_path = os.path.join(
+            self.app_config.web_path, self.app_config.speech_path)
+        resources = [
+            (self.server.app.resource(), path),
+            (self.speech_cache.resource(), speech_path)]
+        if self.media_cache is not None:
+            media_path = os.path.join(
+                self.app_config.web_path, self.app_config.media_path)
+            resources.append((self.media_cache.resource(), media_path))
+        self.webserver = self.start_web_resources(
+            resources, self.app_config.web_port)
+        self.speech_cache.base_url = self._get_public_url(speech_path)
+        if self.media_cache is not None:
+            self.media_cache.base_url = self._get_public_url(media_path)
+
+    def _start_admin_server(self):
+        self.admin_server = None
+        self.admin_webserver = None
+        if self.app_config.admin_port is None:
+            return
+        self.admin_server = AdminServer(
+            self, self.app_config.admin_max_profile_seconds)
+        self.admin_webserver = reactor.listenTCP(
+            self.app_config.admin_port,
+            Site(self.admin_server.app.resource()),
+            interface=self.app_config.admin_interface)
 
     @inlineCallbacks
     def teardown_application(self):
         """Clean-up of setup done in `setup_application`"""
+        yield self.drain()
         yield self.webserver.loseConnection()
+        if self.admin_webserver is not None:
+            self.admin_server.profiler.stop()
+            yield self.admin_webserver.stopListening()
+        if self._compression_report.running:
+            self._compression_report.stop()
+        if self._live_session_pruner.running:
+            self._live_session_pruner.stop()
+        self.call_queue.close()
+        if self.capture is not None:
+            self.capture.close()
+        yield self.scheduler.stop()
+        if self.cdr_writer is not None:
+            self.cdr_writer.stop()
         yield self.session_manager.stop()
 
+    def drain(self):
+        """Stops taking on new calls, and waits up to ``drain_timeout``
+        seconds for the work in progress to finish, so that the worker can
+        be stopped without dropping calls. Live calls carry on with other
+        workers, which pick up their sessions and timers from Redis."""
+        if self._draining is None:
+            self._draining = self._drain()
+        return self._draining
+
+    @inlineCallbacks
+    def _drain(self):
+        self.ready = False
+        self.load_shedder.accepting = False
+        if self._call_publisher.running:
+            self._call_publisher.stop()
+        yield self._publishing
+        # Send the queued calls while the transport can still be reached.
+        # Any that can't be sent stay queued on disk for the next start.
+        while len(self.call_queue):
+            queued = len(self.call_queue)
+            yield self._publish_queued_calls()
+            if len(self.call_queue) >= queued:
+                break
+        finished = yield self.in_flight.wait(self.app_config.drain_timeout)
+        if not finished:
+            # Write what the unfinished turns have done so far, so that the
+            # calls can be resumed from there
+            sessions = self.in_flight.subjects()
+            log.msg(
+                "Drain timed out with %s turns in progress" % (
+                    len(sessions),))
+            yield gatherResults([
+                self.session_manager.flush(session) for session in sessions
+                ], consumeErrors=True)
+
+    def _report_compression(self):
+        summary = self.server.compression_stats.summary()
+        for route, stats in sorted(summary.iteritems()):
+            log.msg(
+                "Compression for %s: %s of %s responses compressed, %s bytes "
+                "saved" % (
+                    route, stats['compressed'], stats['responses'],
+                    stats['bytes_saved']))
+
+    def _get_public_url(self, path):
+        base_url = self.app_config.public_url
+        if base_url is None:
+            addr = self.webserver.getHost()
+            base_url = 'http://127.0.0.1:%s' % addr.port
+        return '%s/%s' % (base_url.rstrip('/'), path.strip('/'))
+
     def _http_request(self, url='', method='GET', data={}):
         return treq.request(method, url, persistent=False, data=data)
 
@@ -128,192 +643,758 @@ class TwilioAPIWorker(ApplicationWorker):
             'Direction': session['Direction'],
         }
 
+    @inlineCallbacks
+    def _fetch_twiml(self, url, method, data):
+        """Returns the response code and body of a TwiML request"""
+        started = self.clock.seconds()
+        response = yield self._http_request(url, method, data)
+        body = yield response.content()
+        if self.capture is not None:
+            self.capture.twiml(
+                url, method, response.code, body,
+                self.clock.seconds() - started)
+        returnValue((response.code, body))
+
+    @inlineCallbacks
+    def _fetch_twiml_from_client(self, url, method, data):
+        """Fetches TwiML through the circuit breaker of the client's host.
+        Returns the response code and body, or ``None`` if the request
+        failed or the breaker is open."""
+        breaker = self.circuit_breakers.get(url)
+        if not breaker.allow():
+            returnValue(None)
+        started = self.clock.seconds()
+        # Without a timeout, a request that hangs would never be recorded,
+        # and a half-open breaker would wait on its probe forever
+        d = self._fetch_twiml(url, method, data)
+        d.addTimeout(self.app_config.circuit_breaker_slow_seconds, self.clock)
+        try:
+            code, body = yield d
+        except Exception:
+            log.err(None, 'Error fetching TwiML from %s' % (url,))
+            breaker.record(False, self.clock.seconds() - started)
+            returnValue(None)
+        breaker.record(200 <= code < 300, self.clock.seconds() - started)
+        returnValue((code, body))
+
     @inlineCallbacks
     def _get_twiml_from_client(self, session, data=None):
+        """Fetches the call's TwiML, falling back to its FallbackUrl or to
+        the default TwiML. Raises :class:`TwiMLUnavailableError` if neither
+        is set and the TwiML can't be fetched."""
         if data is None:
             data = self._request_data_from_session(session)
-        twiml_raw = yield self._http_request(
-            session['Url'], session['Method'], data)
-        if twiml_raw.code < 200 or twiml_raw.code >= 300:
-            twiml_raw = yield self._http_request(
-                session['FallbackUrl'], session['FallbackMethod'], data)
-        twiml_raw = yield twiml_raw.content()
+        self._twiml_fetches += 1
+        started = self.clock.seconds()
+        try:
+            response = yield self._fetch_twiml_from_client(
+                session['Url'], session['Method'], data)
+            fallback_url = session.get('FallbackUrl')
+            if response is not None and 200 <= response[0] < 300:
+                twiml_raw = response[1]
+            elif fallback_url and fallback_url != 'None':
+                _, twiml_raw = yield self._fetch_twiml(
+                    fallback_url, session['FallbackMethod'], data)
+            elif self.app_config.default_twiml is not None:
+                twiml_raw = self.app_config.default_twiml
+            else:
+                raise TwiMLUnavailableError(
+                    "No TwiML from %s" % (session['Url'],))
+        finally:
+            self._twiml_fetches -= 1
+            wait = self._prompt_waits.get(session.get('CallId'))
+            if wait is not None:
+                wait.fetch_time += self.clock.seconds() - started
         twiml_parser = TwiMLParser(session['Url'])
         returnValue(twiml_parser.parse(twiml_raw))
 
     @inlineCallbacks
+    def _get_program_from_client(self, session, data=None):
+        twiml = yield self._get_twiml_from_client(session, data=data)
+        returnValue(TwiMLProgram.compile(twiml))
+
+    def _store_program(self, session, program, pc):
+        """Stores the program and the position to resume it from in the
+        session. The program itself is only rewritten when it changes."""
+        serialized = program.serialize()
+        if session.get('Program') != serialized:
+            session['Program'] = serialized
+        session['PC'] = pc
+
+    def _load_program(self, session):
+        """Returns the program stored in the session and the position to
+        resume it from"""
+        if not session.get('Program'):
+            return TwiMLProgram(), 0
+        return (
+            TwiMLProgram.deserialize(session['Program']),
+            int(session.get('PC', 0)))
+
+    @inlineCallbacks
+    def _run_program(self, session, program, pc=0, message=None):
+        """Executes ``program`` from the instruction at ``pc`` until either
+        the program ends or the call has to wait for the caller.
+
+        If ``message`` is given, messages are sent as replies to it."""
+        while pc < len(program):
+            instruction = program[pc]
+            pc += 1
+            execute = getattr(self, '_execute_%s' % instruction[0])
+            keep_going = yield execute(
+                session, instruction[1:], program, pc, message)
+            if not keep_going:
+                break
+
+    @inlineCallbacks
+    def _execute_play(self, session, args, program, pc, message):
+        url = yield self._get_prompt_url(['play'] + list(args))
+        yield self._send_message(url, session, message=message)
+        returnValue(True)
+
+    @inlineCallbacks
+    def _execute_say(self, session, args, program, pc, message):
+        url = yield self._get_prompt_url(['say'] + list(args))
+        yield self._send_message(url, session, message=message)
+        returnValue(True)
+
+    @inlineCallbacks
+    def _execute_pause(self, session, args, program, pc, message):
+        [length] = args
+        self._store_program(session, program, pc)
+        yield self._set_resume_timer(session, length)
+        returnValue(False)
+
+    @inlineCallbacks
+    def _execute_hangup(self, session, args, program, pc, message):
+        if session.get('Status') == 'in-progress':
+            session['Status'] = 'completed'
+        yield self._send_message(
+            None, session, TransportUserMessage.SESSION_CLOSE,
+            message=message)
+        yield self._clear_call(session)
+        returnValue(False)
+
+    @inlineCallbacks
+    def _execute_gather(self, session, args, program, pc, message):
+        attributes, prompts = args
+        session['Gather_Action'] = attributes['action']
+        session['Gather_Method'] = attributes['method']
+        self._store_program(session, program, pc)
+        if attributes['timeout']:
+            # Counted from when the prompts are sent rather than from when
+            # they finish playing, since we don't know how long they take.
+            # The allowance gives the caller time to hear them first.
+            timeout = attributes['timeout']
+            if prompts:
+                timeout += self.app_config.gather_prompt_allowance
+            yield self._set_resume_timer(session, timeout)
+        # The caller's digits may arrive as soon as the prompts are sent, so
+        # the gather state has to be stored first
+        yield self.session_manager.flush(session)
+        urls = []
+        for prompt in prompts:
+            urls.append((yield self._get_prompt_url(prompt)))
+        urls = urls or [None]
+        for url in urls[:-1]:
+            yield self._send_message(url, session, message=message)
+        yield self._send_message(
+            urls[-1], session, wait_for=attributes['finishOnKey'],
+            message=message)
+        returnValue(False)
+
+    @inlineCallbacks
+    def _execute_redirect(self, session, args, program, pc, message):
+        url, method = args
+        try:
+            program = yield self._follow_redirect(session, url, method)
+        except RedirectLoopError as e:
+            log.msg("Hanging up call %s: %s" % (session.get('CallId'), e))
+            yield self._execute_hangup(session, [], program, pc, message)
+        else:
+            yield self._run_program(session, program, 0, message)
+        returnValue(False)
+
+    @inlineCallbacks
+    def _follow_redirect(self, session, url, method):
+        """Returns the program that a redirect leads to. Documents known to
+        only contain a redirect are skipped rather than fetched."""
+        visited = session.redirects
+        target = (url, method)
+        while True:
+            for node in self.redirect_graph.resolve(target):
+                if node in visited:
+                    raise RedirectLoopError(
+                        "Redirect loop through %r" % (node[0],))
+                visited.append(node)
+                if len(visited) > self.app_config.max_redirects:
+                    raise RedirectLoopError(
+                        "More than %s redirects" % (
+                            self.app_config.max_redirects,))
+            target = visited[-1]
+            program = yield self._get_program_from_client(
+                dict(session, Url=target[0], Method=target[1]))
+            if len(program) == 1 and program[0][0] == 'redirect':
+                next_target = tuple(program[0][1:])
+                self.redirect_graph.add(target, next_target)
+                target = next_target
+            else:
+                returnValue(program)
+
+    @inlineCallbacks
+    def _set_resume_timer(self, session, delay):
+        """Schedules the stored program to be resumed after ``delay``
+        seconds, unless the caller responds first"""
+        session['Timer'] = yield self.scheduler.schedule(
+            delay, 'resume', {'session_id': session.session_id})
+
+    @inlineCallbacks
+    def _timer_resume(self, timer_id, payload):
+        session = yield self.session_manager.load_call_session(
+            payload['session_id'])
+        if session.get('Timer') != timer_id:
+            # The call has moved on since the timer was set
+            return
+        session['Timer'] = ''
+        session['Gather_Action'] = ''
+        session['Gather_Method'] = ''
+        program, pc = self._load_program(session)
+        yield self._run_turn(session, program, pc, hangup_at_end=True)
+
+    @inlineCallbacks
+    def _timer_expire(self, timer_id, payload):
+        session = yield self.session_manager.load_call_session(
+            payload['session_id'])
+        if session.get('CallId') != payload['call_id']:
+            return
+        log.msg("Hanging up call %s: Call is too long" % (session['CallId'],))
+        session['ExpiryTimer'] = ''
+        yield self._execute_hangup(session, [], TwiMLProgram(), 0, None)
+
+    @inlineCallbacks
+    def _timer_ring_timeout(self, timer_id, payload):
+        # Consuming the lookup means a late ack or nack for the call is
+        # ignored, and that an ack that got here first wins
+        session_id, session = yield self._claim_session(payload['message_id'])
+        if session is None or session.get('CallId') != payload['call_id']:
+            return
+        if session.get('Status') != 'queued':
+            return
+        log.msg("Giving up on unanswered call %s" % (session['CallId'],))
+        yield self._end_call(session, 'no-answer')
+
+    def _abort_call(self, session, reason):
+        """Ends a call that can't go on, such as because its TwiML can't be
+        fetched"""
+        log.msg("Hanging up call %s: %s" % (session.get('CallId'), reason))
+        return self._end_call(session, 'completed')
+
+    @inlineCallbacks
+    def _end_call(self, session, status):
+        """Ends the call with ``status``, telling both the transport and the
+        client"""
+        session['Status'] = status
+        yield gatherResults([
+            self._send_message(
+                None, session, TransportUserMessage.SESSION_CLOSE),
+            self._clear_call(session),
+            ], consumeErrors=True)
+        yield self._send_status_callback(session)
+
+    @inlineCallbacks
+    def _create_call_session(self, session_id, **fields):
+        """Creates a new call session, which is hung up once it is older than
+        ``max_call_duration``"""
+        fields['StartTime'] = self.clock.seconds()
+        self._live_sessions[session_id] = fields['CallId']
+        if self.app_config.max_call_duration:
+            fields['ExpiryTimer'] = yield self.scheduler.schedule(
+                self.app_config.max_call_duration, 'expire', {
+                    'session_id': session_id,
+                    'call_id': fields['CallId'],
+                })
+        session, _ = yield gatherResults([
+            self.session_manager.create_call_session(session_id, **fields),
+            self.call_index.set_id(fields['CallId'], session_id),
+            ], consumeErrors=True)
+        returnValue(session)
+
+    @inlineCallbacks
+    def start_call(self, fields):
+        """Sends a new outbound call to the transport, and creates its
+        session. ``fields`` are the fields of the Call resource."""
+        if self.capture is not None:
+            self.capture.call(fields)
+        self._calls_starting += 1
+        try:
+            # Everything an ack or nack for the call needs is stored before
+            # the call is sent, so that one that arrives straight away finds
+            # the session
+            message_id = TransportUserMessage.generate_id()
+            yield self.session_lookup.set_id(message_id, fields['To'])
+            fields['RingTimer'] = yield self.scheduler.schedule(
+                fields['Timeout'], 'ring_timeout', {
+                    'message_id': message_id,
+                    'call_id': fields['CallId'],
+                })
+            session = yield self._create_call_session(fields['To'], **fields)
+            try:
+                yield self.send_to(
+                    fields['To'], '',
+                    from_addr=fields['From'],
+                    message_id=message_id,
+                    session_event=TransportUserMessage.SESSION_NEW,
+                    to_addr_type=TransportUserMessage.AT_MSISDN,
+                    from_addr_type=TransportUserMessage.AT_MSISDN
+                )
+            except Exception:
+                # A bare raise after the yield would lose the exception
+                failure = Failure()
+                yield self._abandon_call(session, message_id)
+                failure.raiseException()
+        finally:
+            self._calls_starting -= 1
+        returnValue(session)
+
+    def _abandon_call(self, session, message_id):
+        """Removes the session of a call that couldn't be sent"""
+        self._live_sessions.pop(session.session_id, None)
+        return gatherResults([
+            self._cancel_timers(session, ('ExpiryTimer', 'RingTimer')),
+            self.session_manager.clear_call_session(session),
+            self.call_index.delete_id(session['CallId']),
+            self.session_lookup.delete_id(message_id),
+            ], consumeErrors=True)
+
+    def _pending_calls(self):
+        """Returns the number of calls that are queued or being started.
+        Queued calls stay in the queue until they have been started, so they
+        are only counted once."""
+        return (
+            len(self.call_queue) - self._queued_calls_starting +
+            self._calls_starting)
+
+    def _publish_queued_calls(self):
+        self._publishing = self._publish_call_batch()
+        return self._publishing
+
+    @inlineCallbacks
+    def _publish_call_batch(self):
+        """Starts the next batch of calls that were queued by the API, and
+        removes those that were started from the queue"""
+        batch = self.call_queue.pending(
+            self.app_config.call_publish_batch_size)
+        if not batch:
+            return
+        self._queued_calls_starting = len(batch)
+        try:
+            results = yield DeferredList(
+                [self.start_call(dict(fields)) for _, fields in batch],
+                consumeErrors=True)
+            started = []
+            for (call_id, _), (success, result) in zip(batch, results):
+                if success:
+                    started.append(call_id)
+                else:
+                    log.err(
+                        result, "Error starting queued call %s" % (call_id,))
+            try:
+                yield self.call_queue.ack(started)
+            except Exception:
+                # The calls are no longer queued in memory, so they are only
+                # started again if the worker restarts before the queue is
+                # next written to disk
+                log.err(None, "Error removing started calls from the queue")
+        finally:
+            self._queued_calls_starting = 0
+
+    @inlineCallbacks
+    def load_call(self, call_sid):
+        """Returns the session of the live call with the given SID, or
+        ``None`` if there is no such call"""
+        session_id = yield self.call_index.get_address(call_sid)
+        if session_id is None:
+            returnValue(None)
+        session = yield self.session_manager.load_call_session(session_id)
+        if session.get('CallId') != call_sid:
+            # The session has since been replaced by another call
+            returnValue(None)
+        returnValue(session)
+
+    @inlineCallbacks
+    def modify_call(self, session, url=None, method='POST', status=None):
+        """Modifies a live call. If ``status`` is given, the call is ended.
+        Otherwise it is redirected to the TwiML at ``url``."""
+        if status == 'canceled':
+            # Only calls that haven't been answered yet can be canceled
+            if session['Status'] == 'queued':
+                yield self._end_call(session, 'canceled')
+        elif status == 'completed':
+            if session['Status'] == 'queued':
+                yield self._end_call(session, 'canceled')
+            else:
+                yield self._end_call(session, 'completed')
+        elif session['Status'] == 'queued':
+            # Used once the call is answered
+            session['Url'] = url
+            session['Method'] = method
+            yield self.session_manager.flush(session)
+        else:
+            # Abandon whatever the call was waiting on
+            yield self._cancel_timers(session, ['Timer'])
+            session['Timer'] = ''
+            session['Gather_Action'] = ''
+            session['Gather_Method'] = ''
+            session['Url'] = url
+            session['Method'] = method
+            yield self._run_turn(session)
+
+    @inlineCallbacks
+    def _prune_live_sessions(self):
+        """Forgets live calls whose sessions are gone from Redis or belong to
+        another call. Calls can be hung up by another worker, or be lost
+        when their sessions expire, without this worker being told."""
+        live = self._live_sessions.items()
+        try:
+            call_ids = yield gatherResults([
+                self.session_manager.get_field(session_id, 'CallId')
+                for session_id, _ in live], consumeErrors=True)
+        except Exception:
+            log.err(None, "Error checking for ended calls")
+            return
+        for (session_id, call_id), current in zip(live, call_ids):
+            if (current != call_id and
+                    self._live_sessions.get(session_id) == call_id):
+                del self._live_sessions[session_id]
+
+    def _cancel_timers(self, session, fields=('Timer', 'ExpiryTimer')):
+        return gatherResults([
+            self.scheduler.cancel(session[field])
+            for field in fields if session.get(field)])
+
+    def _clear_call(self, session):
+        """Ends the call, removing its session and cancelling its timers"""
+        session['EndTime'] = self.clock.seconds()
+        self._live_sessions.pop(session.session_id, None)
+        self._prompt_waits.pop(session['CallId'], None)
+        if self.cdr_writer is not None:
+            self.cdr_writer.write(make_cdr(session))
+        return gatherResults([
+            self._cancel_timers(
+                session, ('Timer', 'ExpiryTimer', 'RingTimer')),
+            self.session_manager.clear_call_session(session),
+            self.call_index.delete_id(session['CallId']),
+            ], consumeErrors=True)
+
+    def _get_prompt_url(self, prompt):
+        """Returns a deferred that fires with the speech URL for a Play or
+        Say instruction"""
+        if prompt[0] == 'say':
+            _, text, voice, language = prompt
+            return self.speech_cache.get_url(text, voice, language)
+        if self.media_cache is not None:
+            return self.media_cache.get_url(prompt[1])
+        return succeed(prompt[1])
+
+    def _run_turn(self, session, program=None, pc=0, message=None,
+                  hangup_at_end=False):
+        """Runs one turn of the call, fetching the program from the client if
+        it isn't given. Session changes made during the turn are written in
+        one go when it ends.
+
+        If ``hangup_at_end`` is set, the call is hung up if the program runs
+        off its end, as it is at the end of a document on Twilio."""
+        return self.in_flight.track(
+            self._run_turn_program(
+                session, program, pc, message, hangup_at_end),
+            session)
+
+    @inlineCallbacks
+    def _run_turn_program(self, session, program, pc, message, hangup_at_end):
+        session.redirects = []
+        try:
+            if program is None:
+                program = yield self._get_program_from_client(session)
+            yield self._run_program(session, program, pc, message)
+            if hangup_at_end and self._is_idle(session):
+                yield self._execute_hangup(
+                    session, [], program, len(program), message)
+        except TwiMLUnavailableError as e:
+            yield self._abort_call(session, e)
+        finally:
+            # Waits that last past the end of the turn, such as through a
+            # Pause, are up to the client rather than to us
+            self._prompt_waits.pop(session.get('CallId'), None)
+            yield self.session_manager.flush(session)
+
+    def _is_idle(self, session):
+        """Returns whether the call is in progress without waiting on a
+        timer or on the caller"""
+        return (
+            session.get('Status') == 'in-progress' and
+            not session.get('Timer') and not session.get('Gather_Action'))
+
+    def _start_prompt_wait(self, session, metric, started=None):
+        """Starts timing how long the caller waits for the next prompt"""
+        if started is None:
+            started = self.clock.seconds()
+        # Inbound calls each get an account SID of their own, so their waits
+        # are kept for the client's host instead
+        self._prompt_waits[session['CallId']] = PromptWait(
+            session.get('ClientHost') or session['AccountSid'], metric,
+            started)
+
+    def _end_prompt_wait(self, session):
+        """Records how long the caller waited, once a prompt is sent"""
+        wait = self._prompt_waits.pop(session.get('CallId'), None)
+        if wait is not None:
+            self.slo_tracker.record(
+                wait.account_sid, wait.metric,
+                self.clock.seconds() - wait.started, wait.fetch_time)
+
     def _handle_connected_call(
-            self, session_id, session, status='in-progress', twiml=None):
+            self, session_id, session, status='in-progress', program=None,
+            pc=0):
         # TODO: Support sending ForwardedFrom parameter
         # TODO: Support sending CallerName parameter
         # TODO: Support sending geographic data parameters
         session['Status'] = status
-        self.session_manager.save_session(session_id, session)
-        if twiml is None:
-            twiml = yield self._get_twiml_from_client(session)
-        for verb in twiml:
-            if verb.name == "Play":
-                # TODO: Support loop and digit attributes
-                yield self._send_message(verb.nouns[0], session)
-            elif verb.name == "Hangup":
-                yield self._send_message(
-                    None, session, TransportUserMessage.SESSION_CLOSE)
-                yield self.session_manager.clear_session(session_id)
-                break
-            elif verb.name == "Gather":
-                # TODO: Support timeout and numDigits attributes
-                msgs = []
-                for subverb in verb.nouns:
-                    # TODO: Support Say and Pause subverbs
-                    if subverb.name == "Play":
-                        msgs.append({'speech_url': subverb.nouns[0]})
-                session['Gather_Action'] = verb.attributes['action']
-                session['Gather_Method'] = verb.attributes['method']
-                yield self.session_manager.save_session(session_id, session)
-                if len(msgs) == 0:
-                    msgs.append({'speech_url': None})
-                msgs[-1]['wait_for'] = verb.attributes['finishOnKey']
-                for msg in msgs:
-                    yield self._send_message(
-                        msg['speech_url'], session,
-                        wait_for=msg.get('wait_for'))
-                break
-
-    def _send_message(self, url, session, session_event=None, wait_for=None):
+        if status == 'in-progress' and not session.get('AnswerTime'):
+            session['AnswerTime'] = self.clock.seconds()
+            self._start_prompt_wait(session, 'first_prompt')
+        return self._run_turn(session, program, pc)
+
+    def _send_message(
+            self, url, session, session_event=None, wait_for=None,
+            message=None):
         helper_metadata = {'voice': {}}
         if url is not None:
             helper_metadata['voice']['speech_url'] = url
+            self._end_prompt_wait(session)
         if wait_for is not None:
             helper_metadata['voice']['wait_for'] = wait_for
 
+        if message is not None:
+            return self.reply_to(
+                message, None, session_event=session_event,
+                helper_metadata=helper_metadata)
+        # Messages that aren't replies, such as those sent by timers and
+        # through the API, go to the caller whichever way the call was made
+        if session.get('Direction') == 'inbound':
+            to_addr, from_addr = session['From'], session['To']
+        else:
+            to_addr, from_addr = session['To'], session['From']
         return self.send_to(
-            session['To'], None,
-            from_addr=session['From'],
+            to_addr, None,
+            from_addr=from_addr,
             session_event=session_event,
             to_addr_type=TransportUserMessage.AT_MSISDN,
             from_addr_type=TransportUserMessage.AT_MSISDN,
             helper_metadata=helper_metadata)
 
-    @inlineCallbacks
+    def dispatch_user_message(self, message):
+        if self.capture is not None:
+            self.capture.inbound(message)
+        return super(TwilioAPIWorker, self).dispatch_user_message(message)
+
+    def dispatch_event(self, event):
+        if self.capture is not None:
+            self.capture.event(event)
+        return super(TwilioAPIWorker, self).dispatch_event(event)
+
+    def _publish_message(self, message, endpoint_name=None):
+        if self.capture is not None:
+            self.capture.outbound(message)
+        return super(TwilioAPIWorker, self)._publish_message(
+            message, endpoint_name=endpoint_name)
+
     def consume_user_message(self, message):
+        # Messages and events are tracked from before their session is
+        # loaded until it is written, so that a drain waits for all of it
+        return self.in_flight.track(self._consume_user_message(message))
+
+    @inlineCallbacks
+    def _consume_user_message(self, message):
+        received = self.clock.seconds()
         # At the moment there is no way to determine whether or not a message
         # is the result of a wait_for or just a single digit, so if the Gather
         # data exists inside the current session data, then we assume that it
         # is the result of a Gather
         # TODO: Fix this
-        session = yield self.session_manager.load_session(message['from_addr'])
+        session = yield self.session_manager.load_call_session(
+            message['from_addr'])
         if session.get('Gather_Action') and session.get('Gather_Method'):
-            data = self._request_data_from_session(session)
-            data['Digits'] = message['content']
-            twiml = yield self._get_twiml_from_client({
+            if session.get('Timer'):
+                cancelled = yield self.scheduler.cancel(session['Timer'])
+                if not cancelled:
+                    # The Gather timed out before the digits arrived
+                    return
+                session['Timer'] = ''
+            self._start_prompt_wait(session, 'next_prompt', received)
+            # Tracked with the session, so that a drain that times out while
+            # the action is being fetched still writes the session
+            yield self.in_flight.track(
+                self._run_gather_action(session, message['content']),
+                session)
+
+    @inlineCallbacks
+    def _run_gather_action(self, session, digits):
+        """Fetches the TwiML for the digits the caller entered for a Gather,
+        and runs it"""
+        data = self._request_data_from_session(session)
+        data['Digits'] = digits
+        try:
+            program = yield self._get_program_from_client({
+                'CallId': session['CallId'],
                 'Url': session['Gather_Action'],
                 'Method': session['Gather_Method'],
-                'Fallback_Url': None,
-                'Fallback_Method': None, },
+                'FallbackUrl': None,
+                'FallbackMethod': None, },
                 data=data)
-            yield self._handle_connected_call(
-                message['from_addr'], session, twiml=twiml)
+        except TwiMLUnavailableError as e:
+            yield self._abort_call(session, e)
+            return
+        session['Gather_Action'] = ''
+        session['Gather_Method'] = ''
+        pc = 0
+        if len(program) == 0:
+            # Nothing was returned for the digits, so carry on with the
+            # rest of the document that contained the Gather
+            program, pc = self._load_program(session)
+        yield self._handle_connected_call(
+            session.session_id, session, program=program, pc=pc)
 
     @inlineCallbacks
-    def consume_ack(self, event):
-        message_id = event['user_message_id']
+    def _claim_session(self, message_id):
+        """Resolves and consumes the session lookup for an ack or nack.
+
+        The lookup delete and the session load are sent together once the
+        address is known, so this costs two round trips instead of three. Only
+        the caller whose delete actually removed the lookup gets the session
+        back, so duplicate events for one message can't both act on it.
+
+        Returns a ``(session_id, session)`` tuple, with ``session`` as
+        ``None`` if the lookup was already consumed."""
         session_id = yield self.session_lookup.get_address(message_id)
-        yield self.session_lookup.delete_id(message_id)
-        session = yield self.session_manager.load_session(session_id)
+        if session_id is None:
+            returnValue((None, None))
+        deleted, session = yield gatherResults([
+            self.session_lookup.delete_id(message_id),
+            self.session_manager.load_session(session_id),
+            ], consumeErrors=True)
+        if not deleted:
+            returnValue((session_id, None))
+        returnValue((session_id, CallSession(session_id, session)))
 
-        if session['Status'] == 'queued':
-            yield self._handle_connected_call(session_id, session)
+    def consume_ack(self, event):
+        return self.in_flight.track(self._consume_ack(event))
 
     @inlineCallbacks
+    def _consume_ack(self, event):
+        session_id, session = yield self._claim_session(
+            event['user_message_id'])
+
+        if session and session['Status'] == 'queued':
+            yield self._cancel_timers(session, ['RingTimer'])
+            session['RingTimer'] = ''
+            yield self._handle_connected_call(session_id, session)
+
     def consume_nack(self, event):
-        message_id = event['user_message_id']
-        session_id = yield self.session_lookup.get_address(message_id)
-        yield self.session_lookup.delete_id(message_id)
-        session = yield self.session_manager.load_session(session_id)
+        return self.in_flight.track(self._consume_nack(event))
+
+    @inlineCallbacks
+    def _consume_nack(self, event):
+        session_id, session = yield self._claim_session(
+            event['user_message_id'])
 
-        if session['Status'] == 'queued':
+        if session and session['Status'] == 'queued':
+            yield self._cancel_timers(session, ['RingTimer'])
+            session['RingTimer'] = ''
             yield self._handle_connected_call(
                 session_id, session, status='failed')
 
-    @inlineCallbacks
     def new_session(self, message):
+        return self.in_flight.track(self._new_session(message))
+
+    @inlineCallbacks
+    def _new_session(self, message):
+        if not self.load_shedder.admit('inbound'):
+            # Hang up straight away, rather than slow down the live calls
+            yield self._send_message(
+                None, None, TransportUserMessage.SESSION_CLOSE,
+                message=message)
+            return
         yield self.session_lookup.set_id(
             message['message_id'], message['from_addr'])
         config = yield self.get_config(message)
-        session = {
-            'CallId': self.server._get_sid(),
-            'AccountSid': self.server._get_sid(),
-            'From': message['from_addr'],
-            'To': message['to_addr'],
-            'Status': 'in-progress',
-            'Direction': 'inbound',
-            'Url': config.client_path,
-            'Method': config.client_method,
-            'StatusCallback': config.status_callback_path,
-            'StatusCallbackMethod': config.status_callback_method,
-        }
-        yield self.session_manager.create_session(
-            message['from_addr'], **session)
-
-        twiml = yield self._get_twiml_from_client(session)
-        for verb in twiml:
-            if verb.name == "Play":
-                yield self.reply_to(message, None, helper_metadata={
-                    'voice': {
-                        'speech_url': verb.nouns[0],
-                        }
-                    })
-            elif verb.name == "Hangup":
-                yield self.reply_to(
-                    message, None,
-                    session_event=TransportUserMessage.SESSION_CLOSE)
-                yield self.session_manager.clear_session(message['from_addr'])
-                break
-            elif verb.name == "Gather":
-                # TODO: Support timeout and numDigits attributes
-                msgs = []
-                for subverb in verb.nouns:
-                    # TODO: Support Say and Pause subverbs
-                    if subverb.name == "Play":
-                        msgs.append({'speech_url': subverb.nouns[0]})
-                session['Gather_Action'] = verb.attributes['action']
-                session['Gather_Method'] = verb.attributes['method']
-                yield self.session_manager.save_session(
-                    message['from_addr'], session)
-                if len(msgs) == 0:
-                    msgs.append({'speech_url': None})
-                msgs[-1]['wait_for'] = verb.attributes['finishOnKey']
-                for msg in msgs:
-                    yield self.reply_to(message, None, helper_metadata={
-                        'voice': {
-                            'speech_url': msg.get('speech_url'),
-                            'wait_for': msg.get('wait_for'),
-                        }})
-                break
+        session = yield self._create_call_session(
+            message['from_addr'],
+            CallId=self.server._get_sid(),
+            AccountSid=self.server._get_sid('AC'),
+            From=message['from_addr'],
+            To=message['to_addr'],
+            Status='in-progress',
+            AnswerTime=self.clock.seconds(),
+            Direction='inbound',
+            Url=config.client_path,
+            Method=config.client_method,
+            ClientHost=urlparse(config.client_path).netloc,
+            StatusCallback=config.status_callback_path,
+            StatusCallbackMethod=config.status_callback_method)
+
+        self._start_prompt_wait(session, 'first_prompt')
+        yield self._run_turn(session, message=message)
 
-    @inlineCallbacks
     def close_session(self, message):
-        # TODO: Implement call duration parameters
+        return self.in_flight.track(self._close_session(message))
+
+    @inlineCallbacks
+    def _close_session(self, message):
         # TODO: Implement recording parameters
-        session = yield self.session_manager.load_session(message['from_addr'])
-        yield self.session_manager.clear_session(message['from_addr'])
+        session = yield self.session_manager.load_call_session(
+            message['from_addr'])
+        if not session:
+            # Already ended by us
+            return
+        session['Status'] = 'completed'
+        yield self._clear_call(session)
+        yield self._send_status_callback(session)
+
+    def _send_status_callback(self, session):
+        """Tells the client that the call has ended, if it asked to be"""
         url = session.get('StatusCallback')
-
-        if url and url != 'None':
-            session['Status'] = 'completed'
-            data = self._request_data_from_session(session)
-            yield self._http_request(
-                session['StatusCallback'], session['StatusCallbackMethod'],
-                data)
+        if not url or url == 'None':
+            return succeed(None)
+        data = self._request_data_from_session(session)
+        if session.get('EndTime'):
+            data['CallDuration'] = str(call_duration(session))
+        return self.in_flight.track(self._http_request(
+            url, session['StatusCallbackMethod'], data))
 
 
 class TwilioAPIUsageException(Exception):
     """Called when in incorrect query is sent to the API"""
+    code = 400
+
     def __init__(self, message, format_='xml'):
         super(TwilioAPIUsageException, self).__init__(message)
         self.format_ = format_
 
 
+class TwilioAPINotFoundException(TwilioAPIUsageException):
+    """Called when the API is queried for a resource that doesn't exist"""
+    code = 404
+
+
+class TwilioAPIConflictException(TwilioAPIUsageException):
+    """Called when a request conflicts with one that is in progress"""
+    code = 409
+
+
+class TwilioAPIOverloadedException(TwilioAPIUsageException):
+    """Called when the worker is too busy to take on new work"""
+    code = 503
+
+
 class Response(object):
     """Base Response object used for HTTP responses"""
     name = 'Response'
@@ -333,6 +1414,8 @@ class Response(object):
                     format_xml_rec(value, sub)
                 else:
                     sub = ET.SubElement(root, key)
+                    if value is not None and not isinstance(value, basestring):
+                        value = str(value)
                     sub.text = value
             return root
 
@@ -364,13 +1447,13 @@ class ListResponse(object):
         :param list items: A list of Response items to be returned
         """
         self.items = sorted(items, key=lambda k: k.sid)
+        self._sids = [item.sid for item in self.items]
 
     def _get_page_attributes(self, uri, page, pagesize, aftersid):
         pagesize = min(pagesize, 1000)
         numpages = int(ceil(len(self.items) * 1.0 / pagesize)) or 1
         if aftersid is not None:
-            start = (
-                n for n, i in enumerate(self.items) if i.sid > aftersid).next()
+            start = bisect_right(self._sids, aftersid)
             page = int(start/pagesize)
         else:
             start = page * pagesize
@@ -485,26 +1568,122 @@ class Call(Response):
     name = 'Call'
 
 
+class Health(Response):
+    """Health HTTP response object, returned for the health endpoint"""
+    name = 'Health'
+
+
+class Readiness(Response):
+    """Readiness HTTP response object, returned for the readiness endpoint"""
+    name = 'Readiness'
+
+
+class Latency(Response):
+    """How long the callers of an account waited for prompts"""
+    name = 'Latency'
+
+
+class Latencies(ListResponse):
+    """Used for responding with the Latency of each account"""
+    name = 'Latencies'
+
+    def __init__(self, url, latencies):
+        self.url = url
+        super(Latencies, self).__init__(latencies)
+
+    def format_xml(self):
+        return super(Latencies, self).format_xml(self.url)
+
+    def format_json(self):
+        return super(Latencies, self).format_json(self.url)
+
+
+class CircuitBreakerState(Response):
+    """The circuit breaker of a client host"""
+    name = 'CircuitBreaker'
+
+
+class CircuitBreakerStates(ListResponse):
+    """Used for responding with the CircuitBreaker of each client host"""
+    name = 'CircuitBreakers'
+
+    def __init__(self, url, breakers):
+        self.url = url
+        super(CircuitBreakerStates, self).__init__(breakers)
+
+    def format_xml(self):
+        return super(CircuitBreakerStates, self).format_xml(self.url)
+
+    def format_json(self):
+        return super(CircuitBreakerStates, self).format_json(self.url)
+
+
 class TwilioAPIServer(object):
     app = Klein()
 
     def __init__(self, vumi_worker, version):
         self.vumi_worker = vumi_worker
         self.version = version
-
-    def _format_response(self, request, response, format_):
-        format_ = str(format_.lstrip('.').lower()) or 'xml'
+        self.compression_stats = CompressionStats()
+
+    def _get_format(self, request, format_):
+        """Returns the format asked for by the URL suffix, or else by the
+        Accept header"""
+        format_ = str(format_.lstrip('.').lower())
+        if not format_:
+            format_ = negotiate_format(request.getHeader('Accept'))
+        return format_
+
+    def _format_body(self, request, response, format_):
+        format_ = self._get_format(request, format_)
         func = getattr(
             response, 'format_' + format_, None)
         if not func:
             raise TwilioAPIUsageException(
                 '%r is not a valid request format' % format_)
-        request.setHeader('Content-Type', 'application/%s' % format_)
+        self._set_content_type(request, format_)
         return func()
 
+    def _format_response(self, request, response, format_):
+        body = self._format_body(request, response, format_)
+        return self._encode_body(
+            request, body, self._get_encoding(request, body))
+
+    def _set_content_type(self, request, format_):
+        request.setHeader('Content-Type', 'application/%s' % format_)
+
+    def _get_encoding(self, request, body):
+        """Returns the encoding to compress ``body`` with, or ``None`` if it
+        shouldn't be compressed"""
+        request.setHeader('Vary', 'Accept, Accept-Encoding')
+        config = self.vumi_worker.app_config
+        if not config.compress_responses:
+            return None
+        if len(body) < config.compression_min_size:
+            return None
+        return negotiate_encoding(request.getHeader('Accept-Encoding'))
+
+    def _encode_body(self, request, body, encoding):
+        route = self._get_route(request)
+        if encoding is None:
+            self.compression_stats.record(route, len(body))
+            return body
+        compressed = compress(
+            body, encoding, self.vumi_worker.app_config.compression_level)
+        request.setHeader('Content-Encoding', encoding)
+        self.compression_stats.record(route, len(body), len(compressed))
+        return compressed
+
+    def _get_route(self, request):
+        try:
+            rule, _ = IKleinRequest(request).mapper.match(return_rule=True)
+        except HTTPException:
+            return None
+        return rule.rule
+
     @app.handle_errors(TwilioAPIUsageException)
     def usage_exception(self, request, failure):
-        request.setResponseCode(400)
+        request.setResponseCode(failure.value.code)
         return self._format_response(
             request, Error.from_exception(failure.value),
             failure.value.format_)
@@ -518,6 +1697,199 @@ class TwilioAPIServer(object):
             Accounts='/%s/Accounts%s' % (self.version, format_))
         return self._format_response(request, version, format_)
 
+    @app.route('/Health', defaults={'format_': ''}, methods=['GET'])
+    @app.route('/Health<string:format_>', methods=['GET'])
+    def health(self, request, format_):
+        """Reports how close the worker is to its load limits. Responds with
+        503 while new work is being turned away."""
+        status = self.vumi_worker.load_shedder.status()
+        if status['overloaded']:
+            request.setResponseCode(503)
+        config_cache = self.vumi_worker.config_cache.stats()
+        circuit_breakers = self.vumi_worker.circuit_breakers.counts()
+        health = Health(
+            CircuitBreakers=dict(
+                (snake_to_camel(name), count)
+                for name, count in circuit_breakers.iteritems()),
+            ConfigCache=dict(
+                (snake_to_camel(name), count)
+                for name, count in config_cache.iteritems()),
+            Overloaded=status['overloaded'],
+            Limits=dict(
+                (snake_to_camel(name), {
+                    'InUse': limit['in_use'],
+                    'Limit': limit['limit'],
+                    'Utilisation': limit['utilisation'],
+                })
+                for name, limit in status['limits'].iteritems()),
+            Rejected=dict(
+                (snake_to_camel(kind), count)
+                for kind, count in status['rejected'].iteritems()))
+        return self._format_response(request, health, format_)
+
+    @app.route(
+        '/CircuitBreakers', defaults={'format_': ''}, methods=['GET'])
+    @app.route('/CircuitBreakers<string:format_>', methods=['GET'])
+    def get_circuit_breakers(self, request, format_):
+        """Reports the state of the circuit breaker of each client host.
+        ``State=open`` only reports the breakers in that state."""
+        circuit_breakers = self.vumi_worker.circuit_breakers
+        state = self._get_field(request, 'State')
+        items = []
+        for host in circuit_breakers.hosts():
+            status = circuit_breakers.status(host)
+            if state is not None and status['state'] != state:
+                continue
+            items.append(CircuitBreakerState(Sid=host, **dict(
+                (snake_to_camel(name), value)
+                for name, value in status.iteritems())))
+        return self._format_response(
+            request, CircuitBreakerStates(request.uri, items), format_)
+
+    @app.route('/Ready', defaults={'format_': ''}, methods=['GET'])
+    @app.route('/Ready<string:format_>', methods=['GET'])
+    def ready(self, request, format_):
+        """Reports whether the worker is ready to take requests, and how long
+        each step of its startup took. Responds with 503 while it isn't."""
+        worker = self.vumi_worker
+        if not worker.ready:
+            request.setResponseCode(503)
+        readiness = Readiness(
+            Ready=worker.ready,
+            StartupTimes=dict(
+                (snake_to_camel(name), round(seconds, 3))
+                for name, seconds in worker.startup_times.iteritems()))
+        return self._format_response(request, readiness, format_)
+
+    def _latency_response(self, account_sid):
+        latency = self.vumi_worker.slo_tracker.account(account_sid)
+        fields = {'Sid': account_sid, 'Slow': latency['slow']}
+        for metric, stats in latency['metrics'].iteritems():
+            fields[snake_to_camel(metric)] = dict(
+                (snake_to_camel(name), value)
+                for name, value in stats.iteritems() if name != 'buckets')
+        return Latency(**fields)
+
+    @app.route('/Latency', defaults={'format_': ''}, methods=['GET'])
+    @app.route('/Latency<string:format_>', methods=['GET'])
+    def get_latencies(self, request, format_):
+        """Reports how long the callers of each account waited for prompts.
+        ``Slow=true`` only reports the accounts flagged as slow."""
+        slo_tracker = self.vumi_worker.slo_tracker
+        slow = self._get_field(request, 'Slow', '').lower() == 'true'
+        latencies = Latencies(request.uri, [
+            self._latency_response(account_sid)
+            for account_sid in slo_tracker.accounts()
+            if not slow or slo_tracker.is_slow(account_sid)])
+        return self._format_response(request, latencies, format_)
+
+    @app.route(
+        '/Accounts/<string:account_sid>/Latency',
+        defaults={'format_': ''}, methods=['GET'])
+    @app.route(
+        '/Accounts/<string:account_sid>/Latency<string:format_>',
+        methods=['GET'])
+    def get_latency(self, request, account_sid, format_):
+        """Reports how long the callers of an account waited for prompts,
+        against the latency objectives"""
+        return self._format_response(
+            request, self._latency_response(account_sid), format_)
+
+    # The fields of an Application that can be set through the API, and
+    # their defaults. ApiVersion defaults to the version of the API.
+    application_fields = [
+        ('FriendlyName', None),
+        ('ApiVersion', None),
+        ('VoiceUrl', None),
+        ('VoiceMethod', 'POST'),
+        ('VoiceFallbackUrl', None),
+        ('VoiceFallbackMethod', 'POST'),
+        ('StatusCallback', None),
+        ('StatusCallbackMethod', None),
+        ('VoiceCallerIdLookup', False),
+        ('SmsUrl', None),
+        ('SmsMethod', 'POST'),
+        ('SmsFallbackUrl', None),
+        ('SmsFallbackMethod', 'POST'),
+        ('SmsStatusCallback', None),
+    ]
+
+    def _get_application_fields(self, request, fields):
+        """Updates ``fields`` with the Application fields given in the
+        request"""
+        for field, _ in self.application_fields:
+            value = self._get_field(request, field)
+            if value is None:
+                continue
+            if field == 'VoiceCallerIdLookup':
+                value = value.lower() == 'true'
+            fields[field] = value
+        return fields
+
+    def _new_application(self, account_sid, sid):
+        fields = dict(self.application_fields)
+        fields.update({
+            'Sid': sid,
+            'AccountSid': account_sid,
+            'ApiVersion': self.version,
+            'DateCreated': self._get_timestamp(),
+            'DateUpdated': self._get_timestamp(),
+        })
+        return fields
+
+    def _application_response(self, fields, format_):
+        return Application(Uri='/Accounts/%s/Applications/%s%s' % (
+            fields['AccountSid'], fields['Sid'], format_), **fields)
+
+    @inlineCallbacks
+    def _load_application(self, account_sid, sid, format_):
+        yield self._get_applications_version(account_sid)
+        fields = yield self.vumi_worker.application_store.get(
+            account_sid, sid)
+        if fields is None:
+            raise TwilioAPINotFoundException(
+                'Application %s not found' % (sid,), format_)
+        returnValue(fields)
+
+    @inlineCallbacks
+    def _get_applications_version(self, account_sid):
+        """Returns the version of the account's Applications, storing the
+        account's first Application if it has none yet"""
+        store = self.vumi_worker.application_store
+        version = yield store.get_version(account_sid)
+        if version is None:
+            # Accounts start with an Application that has the same Sid as
+            # the account
+            yield store.save(
+                account_sid, self._new_application(account_sid, account_sid))
+            version = yield store.get_version(account_sid)
+        returnValue(version)
+
+    @inlineCallbacks
+    def _cached_response(self, request, account_sid, format_, render):
+        """Responds with the body cached for the request if the account's
+        Applications haven't changed since, otherwise with the result of
+        ``render``. Clients that already have the body get a 304."""
+        store = self.vumi_worker.application_store
+        version = yield self._get_applications_version(account_sid)
+        format_ = self._get_format(request, format_)
+        key = '%s:%s' % (format_, request.uri)
+        cached = store.get_cached(account_sid, key, version)
+        if cached is None:
+            response = yield render()
+            body = self._format_body(request, response, format_)
+            etag = store.set_cached(account_sid, key, version, body)
+        else:
+            body, etag = cached
+            self._set_content_type(request, format_)
+        encoding = self._get_encoding(request, body)
+        if encoding is not None:
+            # Each encoding of the body is a different representation
+            etag = '%s-%s"' % (etag[:-1], encoding)
+        if request.setETag(etag) == CACHED:
+            returnValue('')
+        returnValue(self._encode_body(request, body, encoding))
+
     @app.route(
         '/Accounts/<string:account_sid>/Applications',
         defaults={'format_': ''}, methods=['GET'])
@@ -525,31 +1897,78 @@ class TwilioAPIServer(object):
         '/Accounts/<string:account_sid>/Applications<string:format_>',
         methods=['GET'])
     def get_applications(self, request, account_sid, format_):
-        application = Application(
-            # Application sid the same as Account sid to ensure consistency
-            # between calls.
-            Sid=account_sid,
-            DateCreated=self._get_timestamp(),
-            DateUpdated=self._get_timestamp(),
-            AccountSid=account_sid,
-            FriendlyName=self._get_field(request, 'FriendlyName'),
-            ApiVersion=self.version,
-            VoiceUrl=None,
-            VoiceMethod='POST',
-            VoiceFallbackUrl=None,
-            VoiceFallbackMethod='POST',
-            StatusCallback=None,
-            StatusCallbackMethod=None,
-            VoiceCallerIdLookup=False,
-            SmsUrl=None,
-            SmsMethod='POST',
-            SmsFallbackUrl=None,
-            SmsFallbackMethod='POST',
-            SmsStatusCallback=None,
-            Uri='/Accounts/%s/Applications/%s%s' % (
-                account_sid, account_sid, format_))
-        applications = Applications(request.uri, [application])
-        return self._format_response(request, applications, format_)
+        friendly_name = self._get_field(request, 'FriendlyName')
+
+        @inlineCallbacks
+        def render():
+            applications = yield self.vumi_worker.application_store.list(
+                account_sid)
+            returnValue(Applications(request.uri, [
+                self._application_response(fields, format_)
+                for fields in applications
+                if friendly_name in (None, fields['FriendlyName'])]))
+
+        return self._cached_response(request, account_sid, format_, render)
+
+    @app.route(
+        '/Accounts/<string:account_sid>/Applications',
+        defaults={'format_': ''}, methods=['POST'])
+    @app.route(
+        '/Accounts/<string:account_sid>/Applications<string:format_>',
+        methods=['POST'])
+    @inlineCallbacks
+    def create_application(self, request, account_sid, format_):
+        fields = self._get_application_fields(
+            request, self._new_application(account_sid, self._get_sid('AP')))
+        if not fields['FriendlyName']:
+            raise TwilioAPIUsageException(
+                "Required field 'FriendlyName' not supplied", format_)
+        yield self._get_applications_version(account_sid)
+        yield self.vumi_worker.application_store.save(account_sid, fields)
+        request.setResponseCode(201)
+        returnValue(self._format_response(
+            request, self._application_response(fields, format_), format_))
+
+    @app.route(
+        '/Accounts/<string:account_sid>/Applications/<string:sid>',
+        methods=['GET'])
+    def get_application(self, request, account_sid, sid):
+        sid, format_ = os.path.splitext(sid)
+
+        @inlineCallbacks
+        def render():
+            fields = yield self._load_application(account_sid, sid, format_)
+            returnValue(self._application_response(fields, format_))
+
+        return self._cached_response(request, account_sid, format_, render)
+
+    @app.route(
+        '/Accounts/<string:account_sid>/Applications/<string:sid>',
+        methods=['POST'])
+    @inlineCallbacks
+    def update_application(self, request, account_sid, sid):
+        sid, format_ = os.path.splitext(sid)
+        fields = yield self._load_application(account_sid, sid, format_)
+        self._get_application_fields(request, fields)
+        fields['DateUpdated'] = self._get_timestamp()
+        yield self.vumi_worker.application_store.save(account_sid, fields)
+        returnValue(self._format_response(
+            request, self._application_response(fields, format_), format_))
+
+    @app.route(
+        '/Accounts/<string:account_sid>/Applications/<string:sid>',
+        methods=['DELETE'])
+    @inlineCallbacks
+    def delete_application(self, request, account_sid, sid):
+        sid, format_ = os.path.splitext(sid)
+        yield self._get_applications_version(account_sid)
+        deleted = yield self.vumi_worker.application_store.delete(
+            account_sid, sid)
+        if not deleted:
+            raise TwilioAPINotFoundException(
+                'Application %s not found' % (sid,), format_)
+        request.setResponseCode(204)
+        returnValue('')
 
     @app.route(
         '/Accounts/<string:account_sid>/Calls',
@@ -565,9 +1984,47 @@ class TwilioAPIServer(object):
         # TODO: Support ApplicationSid field
         # TODO: Support SendDigits field
         # TODO: Support IfMachine field
-        # TODO: Support Timeout field
         # TODO: Support Record field
         fields = self._validate_make_call_fields(request, format_)
+        idempotency_key = request.getHeader('Idempotency-Key')
+        if idempotency_key is None:
+            code = yield self._start_call(account_sid, fields, format_)
+            request.setResponseCode(code)
+            returnValue(self._format_response(
+                request, self._call_response(fields, format_), format_))
+
+        store = self.vumi_worker.idempotency_store
+        digest = fingerprint(fields)
+        record = yield store.claim(account_sid, idempotency_key, digest)
+        if record is not None:
+            returnValue(self._replay_call(
+                request, idempotency_key, digest, record, format_))
+        try:
+            code = yield self._start_call(account_sid, fields, format_)
+        except Exception:
+            # A bare raise after the yield would lose the exception
+            failure = Failure()
+            yield store.release(account_sid, idempotency_key)
+            failure.raiseException()
+        yield store.complete(
+            account_sid, idempotency_key, digest,
+            {'code': code, 'call': fields})
+        request.setResponseCode(code)
+        returnValue(self._format_response(
+            request, self._call_response(fields, format_), format_))
+
+    @inlineCallbacks
+    def _start_call(self, account_sid, fields, format_):
+        """Starts or queues a call with the given validated fields, adding
+        the fields of the Call resource to them. Returns the response
+        code."""
+        load_shedder = self.vumi_worker.load_shedder
+        if not load_shedder.admit('make_call'):
+            if not load_shedder.accepting:
+                raise TwilioAPIOverloadedException(
+                    'Not accepting new calls, try again later', format_)
+            raise TwilioAPIOverloadedException(
+                'Too many calls in progress, try again later', format_)
         fields['AccountSid'] = account_sid
         fields['CallId'] = self._get_sid()
         fields['DateCreated'] = self._get_timestamp()
@@ -575,49 +2032,111 @@ class TwilioAPIServer(object):
             self.version, account_sid, fields['CallId'])
         fields['Status'] = 'queued'
         fields['Direction'] = 'outbound-api'
-        message = yield self.vumi_worker.send_to(
-            fields['To'], '',
-            from_addr=fields['From'],
-            session_event=TransportUserMessage.SESSION_NEW,
-            to_addr_type=TransportUserMessage.AT_MSISDN,
-            from_addr_type=TransportUserMessage.AT_MSISDN
-        )
-        yield self.vumi_worker.session_lookup.set_id(
-            message['message_id'], message['to_addr'])
-        yield self.vumi_worker.session_manager.create_session(
-            message['to_addr'], **fields)
-        returnValue(self._format_response(request, Call(
+        if fields['Timeout'] is None:
+            fields['Timeout'] = self.vumi_worker.app_config.ring_timeout
+        if self.vumi_worker.app_config.async_make_call:
+            yield self.vumi_worker.call_queue.put(fields['CallId'], fields)
+            returnValue(202)
+        yield self.vumi_worker.start_call(fields)
+        returnValue(200)
+
+    def _replay_call(self, request, key, digest, record, format_):
+        """Responds to a request with an idempotency key that was already
+        used, with the response to the request that first used it"""
+        if record['fingerprint'] != digest:
+            raise TwilioAPIUsageException(
+                "Idempotency-Key %s was used for a request with different "
+                "parameters" % (key,), format_)
+        if 'result' not in record:
+            raise TwilioAPIConflictException(
+                "A request with Idempotency-Key %s is in progress" % (key,),
+                format_)
+        request.setResponseCode(record['result']['code'])
+        request.setHeader('Idempotent-Replayed', 'true')
+        return self._format_response(
+            request, self._call_response(record['result']['call'], format_),
+            format_)
+
+    @app.route(
+        '/Accounts/<string:account_sid>/Calls/<string:call_sid>',
+        methods=['GET'])
+    @inlineCallbacks
+    def get_call(self, request, account_sid, call_sid):
+        """Call instance resource
+        https://www.twilio.com/docs/api/rest/call"""
+        call_sid, format_ = os.path.splitext(call_sid)
+        # Calls that are still waiting to be started are only known to the
+        # worker that queued them
+        session = self.vumi_worker.call_queue.get(call_sid)
+        if session is None:
+            session = yield self.vumi_worker.load_call(call_sid)
+        if session is None or session['AccountSid'] != account_sid:
+            raise TwilioAPINotFoundException(
+                'Call %s not found' % (call_sid,), format_)
+        returnValue(self._format_response(
+            request, self._call_response(session, format_), format_))
+
+    @app.route(
+        '/Accounts/<string:account_sid>/Calls/<string:call_sid>',
+        methods=['POST'])
+    @inlineCallbacks
+    def modify_call(self, request, account_sid, call_sid):
+        """Modifying live calls endpoint
+        https://www.twilio.com/docs/api/rest/change-call-state"""
+        call_sid, format_ = os.path.splitext(call_sid)
+        url = self._get_field(request, 'Url')
+        method = self._get_field(request, 'Method', 'POST')
+        status = self._get_field(request, 'Status')
+        if not (url or status):
+            raise TwilioAPIUsageException(
+                "Request must have an 'Url' or a 'Status' field", format_)
+        if status not in (None, 'canceled', 'completed'):
+            raise TwilioAPIUsageException(
+                "Status value must be one of ['canceled', 'completed']",
+                format_)
+
+        session = yield self.vumi_worker.load_call(call_sid)
+        if session is None or session['AccountSid'] != account_sid:
+            raise TwilioAPINotFoundException(
+                'Call %s not found' % (call_sid,), format_)
+        yield self.vumi_worker.modify_call(session, url, method, status)
+        returnValue(self._format_response(
+            request, self._call_response(session, format_), format_))
+
+    def _call_response(self, session, format_):
+        uri = '/%s/Accounts/%s/Calls/%s' % (
+            self.version, session['AccountSid'], session['CallId'])
+        return Call(
             **{
-                'Sid': fields['CallId'],
-                'DateCreated': fields['DateCreated'],
-                'DateUpdated': fields['DateCreated'],
+                'Sid': session['CallId'],
+                'DateCreated': session.get('DateCreated'),
+                'DateUpdated': session.get('DateCreated'),
                 'ParentCallSid': None,
-                'AccountSid': account_sid,
-                'To': fields['To'],
-                'FormattedTo': fields['To'],
-                'From': fields['From'],
-                'FormattedFrom': fields['From'],
+                'AccountSid': session['AccountSid'],
+                'To': session['To'],
+                'FormattedTo': session['To'],
+                'From': session['From'],
+                'FormattedFrom': session['From'],
                 'PhoneNumberSid': None,
-                'Status': fields['Status'],
+                'Status': session['Status'],
                 'StartTime': None,
                 'EndTime': None,
                 'Duration': None,
                 'Price': None,
-                'Direction': fields['Direction'],
+                'Direction': session['Direction'],
                 'AnsweredBy': None,
                 'ApiVersion': self.version,
                 'ForwardedFrom': None,
                 'CallerName': None,
-                'Uri': '%s%s' % (fields['Uri'], format_),
+                'Uri': '%s%s' % (uri, format_),
                 'SubresourceUris': {
-                    'Notifications': '%s/Notifications%s' % (
-                        fields['Uri'], format_),
-                    'Recordings': '%s/Recordings%s' % (fields['Uri'], format_),
+                    'Notifications': '%s/Notifications%s' % (uri, format_),
+                    'Recordings': '%s/Recordings%s' % (uri, format_),
                 }
-            }), format_))
+            })
 
-    def _get_sid(self):
-        return str(uuid.uuid4()).replace('-', '')
+    def _get_sid(self, prefix='CA'):
+        return self.vumi_worker.sid_generator.generate(prefix)
 
     def _get_timestamp(self):
         return datetime.now(tzutc()).strftime('%a, %d %b %Y %H:%M:%S %z')
@@ -652,13 +2171,22 @@ class TwilioAPIServer(object):
         fields = {}
         for field, default in [
                 ('Method', 'POST'), ('FallbackMethod', 'POST'),
-                ('StatusCallbackMethod', 'POST'), ('Timeout', 60),
-                ('Record', False)]:
+                ('StatusCallbackMethod', 'POST'), ('Record', False)]:
             fields[field] = self._get_field(request, field, default)
         for field in [
-                'FallbackUrl', 'StatusCallback', 'SendDigits', 'IfMachine']:
+                'FallbackUrl', 'StatusCallback', 'SendDigits', 'IfMachine',
+                'Timeout']:
             fields[field] = self._get_field(request, field)
 
+        if fields['Timeout'] is not None:
+            try:
+                fields['Timeout'] = int(fields['Timeout'])
+            except ValueError:
+                fields['Timeout'] = 0
+            if fields['Timeout'] < 1:
+                raise TwilioAPIUsageException(
+                    "Timeout value must be a positive integer", format_)
+
         if fields['SendDigits']:
             if not all(re.match('[0-9#*w]', c) for c in fields['SendDigits']):
                 raise TwilioAPIUsageException(
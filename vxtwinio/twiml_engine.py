@@ -0,0 +1,159 @@
+import json
+
+from twisted.internet import reactor
+
+
+class TwiMLCompileError(Exception):
+    """Raised when a parsed verb cannot be compiled into an instruction"""
+
+
+class RedirectLoopError(Exception):
+    """Raised when following a redirect would loop, or would go over the
+    redirect limit"""
+
+
+class TwiMLUnavailableError(Exception):
+    """Raised when a call's TwiML can't be fetched, and there is no fallback
+    to use instead"""
+
+
+class TwiMLProgram(object):
+    """A TwiML document compiled into a flat list of instructions.
+
+    Instructions are JSON-serialisable lists of the form ``[op, args...]``, so
+    that a program and a program counter can be stored in the session and
+    resumed later without refetching or reparsing the document."""
+
+    def __init__(self, instructions=None):
+        self.instructions = instructions or []
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def __getitem__(self, pc):
+        return self.instructions[pc]
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, TwiMLProgram) and
+            self.instructions == other.instructions)
+
+    def __ne__(self, other):
+        return not self == other
+
+    @classmethod
+    def compile(cls, verbs):
+        """Compiles a list of :class:`vxtwinio.twiml_parser.Verb` objects"""
+        return cls(TwiMLCompiler().compile_verbs(verbs))
+
+    def serialize(self):
+        return json.dumps(self.instructions, separators=(',', ':'))
+
+    @classmethod
+    def deserialize(cls, data):
+        return cls(json.loads(data))
+
+
+class TwiMLCompiler(object):
+    """Turns parsed verbs into program instructions"""
+
+    # A loop of 0 asks for a prompt to repeat until the caller hangs up. We
+    # can't tell when a prompt has finished playing, so it is repeated this
+    # many times instead.
+    max_loop = 10
+
+    def compile_verbs(self, verbs):
+        """Compiles a list of verbs. Play and Say are repeated as many times
+        as their loop attribute asks for."""
+        instructions = []
+        for verb in verbs:
+            instruction = self.compile_verb(verb)
+            loop = verb.attributes.get('loop', 1)
+            instructions.extend([instruction] * (loop or self.max_loop))
+        return instructions
+
+    def compile_verb(self, verb):
+        compiler = getattr(
+            self, '_compile_%s' % verb.name.lower(), self._compile_default)
+        return compiler(verb)
+
+    def _compile_default(self, verb):
+        raise TwiMLCompileError("Cannot compile verb %r" % verb.name)
+
+    def _compile_play(self, verb):
+        # TODO: Support digits attribute
+        return ['play', verb.nouns[0]]
+
+    def _compile_say(self, verb):
+        return [
+            'say', verb.nouns[0], verb.attributes['voice'],
+            verb.attributes['language']]
+
+    def _compile_pause(self, verb):
+        return ['pause', verb.attributes['length']]
+
+    def _compile_hangup(self, verb):
+        return ['hangup']
+
+    def _compile_redirect(self, verb):
+        return ['redirect', verb.nouns[0], verb.attributes['method']]
+
+    def _compile_gather(self, verb):
+        # TODO: Support numDigits attribute
+        # TODO: Support Pause subverb
+        prompts = self.compile_verbs(verb.nouns)
+        return ['gather', {
+            'action': verb.attributes['action'],
+            'method': verb.attributes['method'],
+            'finishOnKey': verb.attributes['finishOnKey'],
+            'timeout': verb.attributes['timeout'],
+        }, prompts]
+
+
+class RedirectGraph(object):
+    """Short-lived record of documents that do nothing but redirect, so that
+    a chain of such documents can be skipped instead of fetched one by one.
+
+    Nodes are ``(url, method)`` tuples."""
+
+    def __init__(self, ttl, clock=reactor):
+        """
+        :param int ttl: Seconds to remember each redirect for. Nothing is
+            remembered if this is 0.
+        :param clock: Provider of the current time
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self._edges = {}
+
+    def __len__(self):
+        return len(self._edges)
+
+    def add(self, source, target):
+        """Records that fetching ``source`` only redirects to ``target``"""
+        if self.ttl > 0:
+            self._edges[source] = (target, self.clock.seconds() + self.ttl)
+
+    def get(self, source):
+        """Returns the target that ``source`` redirects to, or ``None`` if
+        it is not known"""
+        edge = self._edges.get(source)
+        if edge is None:
+            return None
+        target, expiry = edge
+        if expiry <= self.clock.seconds():
+            del self._edges[source]
+            return None
+        return target
+
+    def resolve(self, source):
+        """Returns the path of known redirects starting at ``source``. If the
+        known redirects loop, the path ends with the first repeated node."""
+        path = [source]
+        target = self.get(source)
+        while target is not None:
+            path.append(target)
+            if target in path[:-1]:
+                break
+            target = self.get(target)
+        return path
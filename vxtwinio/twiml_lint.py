@@ -0,0 +1,216 @@
+"""Checks TwiML documents on disk with :class:`TwiMLParser`, so that they
+can be validated before they are used for calls.
+
+Documents can be given as XML files, directories of XML files, or NDJSON
+dumps with one ``{"twiml": ..., "url": ..., "id": ...}`` object per line,
+where only ``twiml`` is required. Documents are checked in a pool of
+processes, and problems are printed as they are found."""
+
+import argparse
+from itertools import imap
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+from vxtwinio.twiml_parser import TwiMLParseError, TwiMLParser
+
+
+NDJSON_EXTENSIONS = ('.ndjson', '.jsonl')
+
+
+class _LineTreeBuilder(ET.TreeBuilder):
+    """Tree builder that records the line each element starts on"""
+
+    def start(self, tag, attrs):
+        element = ET.TreeBuilder.start(self, tag, attrs)
+        element.line = self.parser.CurrentLineNumber
+        return element
+
+
+def _parse_xml(xml):
+    builder = _LineTreeBuilder()
+    parser = ET.XMLParser(target=builder)
+    builder.parser = parser.parser
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    parser.feed(xml)
+    return parser.close()
+
+
+def _error(error, message, line=None, location=None):
+    return {
+        'error': error,
+        'message': message,
+        'line': line,
+        'location': location,
+    }
+
+
+def lint_twiml(xml, url=''):
+    """Returns a list of the problems with a TwiML document. Each problem
+    is a dict with the ``error`` type, its ``message``, and the ``line`` and
+    ``location`` of the element it was found in, where known.
+
+    Every verb is checked, so there can be a problem for each of them."""
+    try:
+        root = _parse_xml(xml)
+    except ET.ParseError as e:
+        return [_error('ParseError', str(e), line=e.position[0])]
+    if root.tag != 'Response':
+        return [_error(
+            'TwiMLParseError',
+            "Invalid root %r. Should be 'Response'." % (root.tag,),
+            line=root.line, location='/%s' % (root.tag,))]
+
+    errors = []
+    counts = {}
+    for element in root:
+        counts[element.tag] = counts.get(element.tag, 0) + 1
+        try:
+            TwiMLParser.from_list([element], url)
+        except TwiMLParseError as e:
+            errors.append(_error(
+                'TwiMLParseError', str(e), line=element.line,
+                location='/Response/%s[%s]' % (
+                    element.tag, counts[element.tag])))
+    return errors
+
+
+def lint_document(document):
+    """Checks a ``(source, url, xml)`` document. Returns the source and
+    its problems. If the document couldn't be read, ``xml`` is ``None`` and
+    ``url`` is the reason why."""
+    source, url, xml = document
+    if xml is None:
+        return source, [_error('InvalidDocument', url)]
+    return source, lint_twiml(xml, url)
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _iter_ndjson(path, default_url):
+    with open(path, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            source = '%s:%s' % (path, number)
+            try:
+                record = json.loads(line)
+                xml = record['twiml']
+            except (ValueError, KeyError, TypeError):
+                yield source, "Not a JSON object with a 'twiml' field", None
+                continue
+            if record.get('id') is not None:
+                source = '%s:%s (%s)' % (path, number, record['id'])
+            yield source, record.get('url') or default_url, xml
+
+
+def iter_documents(paths, url=''):
+    """Yields a ``(source, url, xml)`` tuple for each document in the given
+    files and directories"""
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.endswith('.xml'):
+                        filepath = os.path.join(directory, filename)
+                        yield filepath, url, _read_file(filepath)
+        elif path.endswith(NDJSON_EXTENSIONS):
+            for document in _iter_ndjson(path, url):
+                yield document
+        else:
+            yield path, url, _read_file(path)
+
+
+def lint(documents, processes=None, chunksize=64):
+    """Checks documents in a pool of ``processes`` processes, defaulting to
+    one per CPU. Yields ``(source, errors)`` tuples in the order the
+    documents were given, as soon as they are available."""
+    if processes == 1:
+        for result in imap(lint_document, documents):
+            yield result
+        return
+    pool = multiprocessing.Pool(processes, _init_process)
+    try:
+        for result in pool.imap(lint_document, documents, chunksize):
+            yield result
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _init_process():
+    # Leave interrupts to the parent, and don't inherit any handler it has
+    # for being terminated, so that the pool can always be stopped
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def format_error(source, error):
+    parts = [source]
+    if error['line'] is not None:
+        parts.append('line %s' % (error['line'],))
+    if error['location'] is not None:
+        parts.append(error['location'])
+    parts.append('%s: %s' % (error['error'], error['message']))
+    return ': '.join(parts)
+
+
+def main(args=None, stdout=sys.stdout, stderr=sys.stderr):
+    parser = argparse.ArgumentParser(
+        description="Check TwiML documents for errors")
+    parser.add_argument(
+        'paths', nargs='+', metavar='PATH',
+        help="TwiML files, directories of .xml files, or NDJSON dumps")
+    parser.add_argument(
+        '--url', default='',
+        help="The URL to resolve relative URLs in documents against")
+    parser.add_argument(
+        '--processes', type=int, default=None,
+        help="The number of processes to check documents with. Defaults to "
+             "one per CPU.")
+    parser.add_argument(
+        '--json', action='store_true',
+        help="Print each problem as a JSON object on its own line")
+    options = parser.parse_args(args)
+
+    started = time.time()
+    documents = failed = errors = 0
+    results = lint(
+        iter_documents(options.paths, options.url), options.processes)
+    for source, document_errors in results:
+        documents += 1
+        if document_errors:
+            failed += 1
+            errors += len(document_errors)
+        for error in document_errors:
+            if options.json:
+                line = json.dumps(dict(error, source=source), sort_keys=True)
+            else:
+                line = format_error(source, error)
+            stdout.write('%s\n' % (line,))
+        stdout.flush()
+
+    elapsed = time.time() - started
+    stderr.write(
+        "Checked %s documents in %.2fs (%.0f docs/sec): %s errors in %s "
+        "documents\n" % (
+            documents, elapsed, documents / elapsed if elapsed else 0,
+            errors, failed))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
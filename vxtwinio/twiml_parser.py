@@ -38,6 +38,35 @@ class Play(Verb):
         return cls(attributes, nouns)
 
 
+class Say(Verb):
+    """Represents the Say verb"""
+    name = "Say"
+    valid_voices = ['man', 'woman', 'alice']
+
+    @classmethod
+    def from_xml(cls, xml):
+        """Returns a new Say verb given an ElementTree object"""
+        nouns = [xml.text or '']
+
+        voice = xml.attrib.get('voice', 'man')
+        if voice not in cls.valid_voices:
+            raise TwiMLParseError(
+                "Invalid value %r for 'voice' attribute in Say verb. "
+                "Must be one of %r" % (voice, cls.valid_voices))
+
+        language = xml.attrib.get('language', 'en')
+
+        loop = xml.attrib.get('loop', 1)
+        loop = check_integer('loop', loop, 0)
+
+        attributes = {
+            'voice': voice,
+            'language': language,
+            'loop': loop,
+        }
+        return cls(attributes, nouns)
+
+
 class Hangup(Verb):
     """Represents the Hangup verb"""
     name = "Hangup"
@@ -120,6 +149,38 @@ class Gather(Verb):
             }, data)
 
 
+class Pause(Verb):
+    """Represents the Pause verb"""
+    name = "Pause"
+
+    @classmethod
+    def from_xml(cls, xml):
+        """Returns a new Pause verb from the given ElementTree object"""
+        length = xml.attrib.get('length', 1)
+        length = check_integer('length', length, 1)
+        return cls({'length': length})
+
+
+class Redirect(Verb):
+    """Represents the Redirect verb"""
+    name = "Redirect"
+
+    @classmethod
+    def from_xml(cls, xml, url):
+        """Returns a new Redirect verb from the given ElementTree object.
+        The URL is the document url, used to resolve relative URLs."""
+        nouns = [urljoin(url, (xml.text or '').strip())]
+
+        valid_methods = ['GET', 'POST']
+        method = xml.attrib.get('method', 'POST')
+        if method not in valid_methods:
+            raise TwiMLParseError(
+                "Invalid value %r for method attribute. Must be one of %r" % (
+                    method, valid_methods))
+
+        return cls({'method': method}, nouns)
+
+
 class TwiMLParseError(Exception):
     """Raised when trying to parse invalid TwilML"""
 
@@ -158,8 +219,17 @@ class TwiMLParser(object):
     def _parse_play(self, element):
         return Play.from_xml(element)
 
+    def _parse_say(self, element):
+        return Say.from_xml(element)
+
     def _parse_hangup(self, element):
         return Hangup.from_xml(element)
 
     def _parse_gather(self, element):
         return Gather.from_xml(element, self.url)
+
+    def _parse_pause(self, element):
+        return Pause.from_xml(element)
+
+    def _parse_redirect(self, element):
+        return Redirect.from_xml(element, self.url)